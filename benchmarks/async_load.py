@@ -0,0 +1,88 @@
+"""Load test of the threaded and asyncio runtimes against a local fake
+Telegram API server.
+
+A burst of commands is pushed for many group chats at once, as it happens at
+the start of a meeting, and the time until every reply reaches the fake
+server is measured.
+
+Run from the repository root:
+    python -m benchmarks.async_load [--chats 200] [--updates 5] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import time
+from telegram.ext import Updater
+
+import bot
+import botfunctions
+from benchmarks.fake_telegram import FakeTelegram
+from utils.aiobot import AsyncRuntime
+
+TOKEN = '123456:fake'
+
+
+def push_burst(fake, chats, updates_per_chat, first_chat_id):
+    """Push one /unfreeze and 'updates_per_chat' /add for every chat.
+    Return the number of replies to expect"""
+    for chat in range(chats):
+        chat_id = -(first_chat_id + chat)
+        fake.push_update(fake.make_update(chat_id, '/unfreeze', user_id=1))
+        for i in range(updates_per_chat):
+            fake.push_update(fake.make_update(chat_id, '/add item {}'.format(i), user_id=2 + i))
+    return chats * (updates_per_chat + 1)
+
+
+def run_threaded(fake, expected, workers, timeout):
+    updater = Updater(token=TOKEN, base_url=fake.base_url, workers=workers, use_context=True,
+                      request_kwargs={'con_pool_size': workers + 4})
+    bot.add_handlers(updater.dispatcher)
+    start = time.perf_counter()
+    updater.start_polling(poll_interval=0, timeout=1)
+    done = fake.wait_for_messages(expected, timeout)
+    elapsed = time.perf_counter() - start
+    updater.stop()
+    return done, elapsed
+
+
+def run_asyncio(fake, expected, pool_size, timeout):
+    runtime = AsyncRuntime(TOKEN, botfunctions.COMMANDS, base_url=fake.base_url, pool_size=pool_size)
+
+    async def main():
+        start = time.perf_counter()
+        poller = asyncio.ensure_future(runtime.poll(timeout=1))
+        done = await asyncio.get_running_loop().run_in_executor(None, fake.wait_for_messages, expected, timeout)
+        elapsed = time.perf_counter() - start
+        runtime.stop()
+        await poller
+        return done, elapsed
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=5, help="/add commands per chat")
+    parser.add_argument('--latency', type=float, default=0.05, help="fake network latency in seconds")
+    parser.add_argument('--workers', type=int, default=4, help="threads of the threaded runtime")
+    parser.add_argument('--pool-size', type=int, default=100, help="HTTP pool of the asyncio runtime")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio', 'both'], default='both')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    modes = ['threaded', 'asyncio'] if args.mode == 'both' else [args.mode]
+    for i, mode in enumerate(modes):
+        with FakeTelegram(latency=args.latency) as fake:
+            expected = push_burst(fake, args.chats, args.updates, first_chat_id=1 + i * args.chats)
+            if mode == 'threaded':
+                done, elapsed = run_threaded(fake, expected, args.workers, args.timeout)
+            else:
+                done, elapsed = run_asyncio(fake, expected, args.pool_size, args.timeout)
+            replies = len(fake.sent)
+        status = '' if done else ' (timed out)'
+        print("{:<9} {:>6} replies in {:7.2f}s: {:8.1f} updates/s{}".format(
+            mode, replies, elapsed, replies / elapsed, status))
+
+
+if __name__ == '__main__':
+    main()
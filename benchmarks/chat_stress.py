@@ -0,0 +1,210 @@
+"""Stress test of concurrent commands in a single chat.
+
+Thousands of /add, /insert, /next and /rm updates for one chat are run on the
+worker threads of a real telegram.ext.Dispatcher, as with RUN_ASYNC in
+bot.py. Some items are added by several users at once. Once every command has
+replied, the replies and the queue are checked:
+  - every command replied exactly once
+  - replayed in order, the replies never add an item already queued, as
+    when several users add the same item at once, nor remove one that is not
+  - the items the replies leave queued are exactly the ones in the queue
+  - the queue has no duplicate and its index agrees with its order
+An item may be added again once it left the queue.
+--unlocked runs the same load without the per-chat locks, to see it fail.
+Exits with status 1 if a check fails.
+
+Run from the repository root:
+    python -m benchmarks.chat_stress [--commands 5000] [--workers 16] [--unlocked]
+"""
+import argparse
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import warnings
+
+import telegram
+from telegram.ext import Dispatcher
+
+import botfunctions
+from benchmarks.command_bench import FakeBot
+from utils import messages
+from utils.botrequest import BotRequest
+from utils.dispatch import CommandDispatcher
+
+CHAT_ID = -1
+ADMIN = 1
+
+
+class RecordingBot(FakeBot):
+    """Bot keeping the text of every reply"""
+    username = 'fake_qbot'
+
+    def __init__(self):
+        FakeBot.__init__(self)
+        self.replies = []
+        self._cond = threading.Condition()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._cond:
+            self.replies.append(text)
+            self._cond.notify_all()
+
+    def wait_for_replies(self, count, timeout, quiet=2.0):
+        """Wait for 'count' replies. Give up after 'timeout' seconds, or when
+        no reply arrived for 'quiet' seconds, as when commands failed"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.replies) < count:
+                received = len(self.replies)
+                self._cond.wait(min(quiet, max(0, deadline - time.monotonic())))
+                if len(self.replies) == received:
+                    return False
+            return True
+
+
+class NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NoLocks:
+    def lock(self, chat_id):
+        return NoLock()
+
+
+def template_regex(template):
+    """Return a regex matching a message template, with a named group per field"""
+    pattern = re.escape(template)
+    return re.compile('^' + re.sub(r'\\{(\w+)\\}', r'(?P<\1>.+?)', pattern) + '$')
+
+
+ADDED = [template_regex(messages.ADD_SUCCESS_GROUP), template_regex(messages.INSERT_SUCCESS_GROUP)]
+REMOVED = [template_regex(messages.NEXT_CUSTOM_REPLY), template_regex(messages.RM_SUCCESS)]
+
+
+def make_workload(rnd, commands, duplicates):
+    """Return the texts of the commands and the user sending each of them"""
+    workload = []
+    for i in range(commands):
+        kind = rnd.random()
+        if kind < 0.4:
+            workload.append(('/add item {}'.format(i), 10 + i))
+        elif kind < 0.5:
+            # The same item, added by several users at once
+            for user in range(duplicates):
+                workload.append(('/add shared {}'.format(i), 10 + user))
+        elif kind < 0.6:
+            workload.append(('/insert ins {} 1'.format(i), ADMIN))
+        elif kind < 0.85:
+            workload.append(('/next done', ADMIN))
+        else:
+            workload.append(('/rm 1', ADMIN))
+    return workload
+
+
+def make_update(bot, update_id, text, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'User{}'.format(user_id), 'username': 'u{}'.format(user_id)}
+    message = {'message_id': update_id, 'date': 0, 'chat': {'id': CHAT_ID, 'type': 'group', 'title': 'Chat'},
+               'from': user, 'text': text,
+               'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}
+    return telegram.Update.de_json({'update_id': update_id, 'message': message}, bot)
+
+
+def check(replies, expected, chat_queue):
+    """Return the list of the checks that failed"""
+    failures = []
+    if len(replies) != expected:
+        failures.append("{} replies for {} commands".format(len(replies), expected))
+    # Replies are sent while holding the lock of the chat, in the order of the queue operations
+    queued = set()
+    twice_added = []
+    twice_removed = []
+    for text in replies:
+        for regex in ADDED:
+            match = regex.match(text)
+            if match:
+                item = match.group('item')
+                if item in queued:
+                    twice_added.append(item)
+                queued.add(item)
+        for regex in REMOVED:
+            match = regex.match(text)
+            if match:
+                item = match.group('item')
+                if item not in queued:
+                    twice_removed.append(item)
+                queued.discard(item)
+    if twice_added:
+        failures.append("{} items added while queued, as {}".format(len(twice_added), twice_added[0]))
+    if twice_removed:
+        failures.append("{} items removed while not queued, as {}".format(len(twice_removed), twice_removed[0]))
+    items = list(chat_queue)
+    if len(items) != len(chat_queue):
+        failures.append("the queue holds {} items but its length is {}".format(len(items), len(chat_queue)))
+    if len(set(items)) != len(items):
+        failures.append("the queue holds duplicates")
+    if queued != set(items):
+        failures.append("{} items lost, {} items never added".format(len(queued - set(items)),
+                                                                      len(set(items) - queued)))
+    misplaced = sum(1 for position, item in enumerate(items) if chat_queue.index(item) != position)
+    if misplaced:
+        failures.append("{} items at a different position than the index says".format(misplaced))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commands', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=16, help="worker threads of the dispatcher")
+    parser.add_argument('--duplicates', type=int, default=4, help="users adding each shared item at once")
+    parser.add_argument('--switch-interval', type=float, default=1e-5,
+                        help="thread switch interval in seconds, lower values interleave the threads more")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--unlocked', action='store_true', help="run without the per-chat locks")
+    args = parser.parse_args()
+
+    BotRequest.outbox = None
+    if args.unlocked:
+        botfunctions.CHAT_LOCKS = NoLocks()
+    bot = RecordingBot()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        dispatcher = Dispatcher(bot, queue.Queue(), workers=args.workers)
+    dispatcher.add_handler(CommandDispatcher(botfunctions.COMMANDS, run_async=True))
+    chat_data = dispatcher.chat_data[CHAT_ID]
+    chat_data['is_frozen'] = False
+    chat_data['is_protected'] = False
+
+    workload = make_workload(random.Random(args.seed), args.commands, args.duplicates)
+    updates = [make_update(bot, i + 1, text, user_id) for i, (text, user_id) in enumerate(workload)]
+    thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    thread.start()
+    sys.setswitchinterval(args.switch_interval)
+    start = time.perf_counter()
+    for update in updates:
+        dispatcher.update_queue.put(update)
+    done = bot.wait_for_replies(len(updates), args.timeout)
+    elapsed = time.perf_counter() - start
+    dispatcher.stop()
+    thread.join()
+
+    print("{} commands on {} workers in {:.2f}s ({:.0f}/s){}, {} items left".format(
+        len(updates), args.workers, elapsed, len(updates) / elapsed, '' if done else ' (incomplete)',
+        len(chat_data.get('queue', ()))))
+    failures = check(bot.replies, len(updates), chat_data.get('queue', botfunctions.queue.Queue()))
+    for failure in failures:
+        print("FAILED: " + failure)
+    if not failures:
+        print("All checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""Throughput of the COMMANDS handlers, without network.
+
+Handlers are called directly with real telegram Update objects and a fake
+bot that drops the replies, across several scenarios. Each scenario is run
+twice from a fresh state: once to time every call, once under tracemalloc to
+measure the peak memory the handlers allocate on top of the initial state.
+Runs are deterministic for a given seed, and the results can be saved as JSON
+and compared with a previous run.
+
+Run from the repository root:
+    python -m benchmarks.command_bench [--scenarios queue_10k ...] [--scale 1.0]
+        [--output results.json] [--compare previous.json]
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import telegram
+
+import botfunctions
+from utils.botrequest import BotRequest
+
+ADMIN = 1
+BOT_ID = 1000
+
+
+class FakeBot:
+    """Bot answering getChatAdministrators from a dict and counting replies"""
+    id = BOT_ID
+    defaults = None
+
+    def __init__(self):
+        self.sent = 0
+        self.admins = {}
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+    def get_chat_administrators(self, chat_id):
+        return [SimpleNamespace(user=SimpleNamespace(id=user_id))
+                for user_id in self.admins.get(chat_id, (ADMIN, BOT_ID))]
+
+
+class Workload:
+    """A list of prepared handler calls. Building updates is not timed"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.chat_data = {}
+        self.calls = []
+        self._message_ids = 0
+
+    def update(self, chat_id, text, user_id=ADMIN, chat_type=telegram.Chat.GROUP):
+        """Prepare a command, as sent by user_id in chat_id"""
+        self._message_ids += 1
+        user = telegram.User(user_id, 'User{}'.format(user_id), False, username='user{}'.format(user_id))
+        chat = telegram.Chat(chat_id, chat_type)
+        message = telegram.Message(self._message_ids, datetime.datetime.now(), chat, from_user=user, text=text)
+        update = telegram.Update(self._message_ids, message=message)
+        name = text.split(None, 1)[0][1:]
+        context = SimpleNamespace(bot=self.bot, args=text.split()[1:],
+                                  chat_data=self.chat_data.setdefault(chat_id, {}))
+        self.calls.append((name, botfunctions.COMMANDS[name], update, context))
+
+    def queue_of(self, chat_id):
+        """Return the queue of a chat, created directly for setup"""
+        return self.chat_data.setdefault(chat_id, {}).setdefault('queue', botfunctions.queue.Queue())
+
+
+# Scenarios: functions filling a Workload. Initial queues are built directly, outside of the measures
+def many_small_chats(workload, rnd, scale):
+    """Many chats with a handful of items each"""
+    for chat in range(int(5000 * scale)):
+        chat_id = -(1 + chat)
+        workload.update(chat_id, '/unfreeze')
+        for i in range(3):
+            workload.update(chat_id, '/add item {}'.format(i), user_id=10 + i)
+        workload.update(chat_id, '/queue', user_id=10)
+        workload.update(chat_id, '/next')
+
+
+def huge_queue(workload, rnd, scale):
+    """One chat with a very long queue, edited in the middle"""
+    chat_id = -1
+    size = int(200000 * scale)
+    workload.queue_of(chat_id).extend('item {}'.format(i) for i in range(size))
+    workload.chat_data[chat_id]['is_frozen'] = False
+    workload.chat_data[chat_id]['is_protected'] = False
+    for i in range(int(20000 * scale)):
+        op = i % 5
+        if op == 0:
+            workload.update(chat_id, '/add new {}'.format(i), user_id=10)
+        elif op == 1:
+            workload.update(chat_id, '/rm {}'.format(rnd.randrange(1, size // 2)), user_id=10)
+        elif op == 2:
+            workload.update(chat_id, '/insert ins {} {}'.format(i, rnd.randrange(1, size // 2)), user_id=10)
+        elif op == 3:
+            workload.update(chat_id, '/next', user_id=10)
+        else:
+            workload.update(chat_id, '/queue {}'.format(rnd.randrange(1, size // 100)), user_id=10)
+
+
+def admin_heavy(workload, rnd, scale):
+    """Groups with 50 admins and protection on: every protected command
+    checks the admin list, half of them are denied"""
+    chats = int(500 * scale)
+    for chat in range(chats):
+        chat_id = -(1 + chat)
+        workload.bot.admins[chat_id] = list(range(1, 51)) + [BOT_ID]
+        workload.queue_of(chat_id).extend('item {}'.format(i) for i in range(20))
+    for i in range(int(20000 * scale)):
+        chat_id = -(1 + rnd.randrange(chats))
+        user_id = rnd.randrange(1, 101)
+        command = ('/next', '/rm 1', '/insert x{} 2'.format(i), '/freeze', '/unfreeze', '/add y{}'.format(i))[i % 6]
+        workload.update(chat_id, command, user_id=user_id)
+
+
+def queue_10k(workload, rnd, scale):
+    """Pages of a 10k items queue"""
+    chat_id = -1
+    size = int(10000 * scale)
+    workload.queue_of(chat_id).extend('item {}'.format(i) for i in range(size))
+    pages = -(-size // botfunctions.BotFunction.QUEUE_PAGE_SIZE)
+    for i in range(int(5000 * scale)):
+        workload.update(chat_id, '/queue {}'.format(rnd.randrange(1, pages + 1)), user_id=10)
+
+
+SCENARIOS = {
+    'many_small_chats': many_small_chats,
+    'huge_queue': huge_queue,
+    'admin_heavy': admin_heavy,
+    'queue_10k': queue_10k,
+}
+
+
+def prepare(scenario, seed, scale):
+    random.seed(seed)
+    workload = Workload(FakeBot())
+    SCENARIOS[scenario](workload, random.Random(seed), scale)
+    return workload
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run_timed(workload):
+    """Call every handler, return (total seconds, sorted per call latencies)"""
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for _, handler, update, context in workload.calls:
+        t = clock()
+        handler(update, context)
+        latencies.append(clock() - t)
+    total = clock() - start
+    latencies.sort()
+    return total, latencies
+
+
+def run_traced(workload):
+    """Call every handler under tracemalloc, return the peak bytes allocated"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    for _, handler, update, context in workload.calls:
+        handler(update, context)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run_scenario(scenario, seed, scale):
+    workload = prepare(scenario, seed, scale)
+    total, latencies = run_timed(workload)
+    replies = workload.bot.sent
+    peak = run_traced(prepare(scenario, seed, scale))
+    ops = len(latencies)
+    return {
+        'ops': ops,
+        'replies': replies,
+        'seconds': total,
+        'ops_per_second': ops / total,
+        'latency_us': {name: percentile(latencies, p) * 1e6
+                       for name, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+        'peak_memory_bytes': peak,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the size of every scenario")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    BotRequest.outbox = None
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['scenarios']
+
+    results = {}
+    print("{:<18} {:>8} {:>11} {:>9} {:>9} {:>9} {:>10}".format(
+        'scenario', 'ops', 'ops/s', 'p50 us', 'p99 us', 'max us', 'peak KiB'))
+    for scenario in args.scenarios:
+        result = results[scenario] = run_scenario(scenario, args.seed, args.scale)
+        latency = result['latency_us']
+        line = "{:<18} {:>8} {:>11.0f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f}".format(
+            scenario, result['ops'], result['ops_per_second'], latency['p50'], latency['p99'], latency['max'],
+            result['peak_memory_bytes'] / 2 ** 10)
+        if scenario in previous:
+            line += "  ({:+.1%} ops/s)".format(result['ops_per_second'] / previous[scenario]['ops_per_second'] - 1)
+        print(line)
+
+    if args.output:
+        report = {
+            'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'scale': args.scale,
+            'scenarios': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
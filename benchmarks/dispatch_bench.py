@@ -0,0 +1,114 @@
+"""Per-update overhead of routing a message to its command.
+
+Updates go through a real telegram.ext.Dispatcher, with replies dropped by a
+fake bot, so that the time measured is the one spent parsing the command,
+finding its handler, building the request object and checking permissions.
+Two setups are compared: one CommandHandler per command, as the bot used to
+register them, and the handlers registered by bot.add_handlers.
+
+Run from the repository root:
+    python -m benchmarks.dispatch_bench [--updates 20000] [--repeat 5]
+"""
+import argparse
+import queue
+import time
+import warnings
+
+import telegram
+from telegram.ext import CommandHandler, Dispatcher
+
+import bot
+import botfunctions
+from benchmarks.command_bench import FakeBot, ADMIN
+from utils.botrequest import BotRequest
+
+CHAT_ID = -1
+MEMBER = 10
+
+
+class NamedFakeBot(FakeBot):
+    # CommandHandler compares the username of the bot with the one of '/cmd@bot'
+    username = 'fake_qbot'
+    first_name = 'qBot'
+
+
+def command_handlers(dispatcher):
+    """Register one CommandHandler per command, checked in turn"""
+    for name, func in botfunctions.COMMANDS.items():
+        dispatcher.add_handler(CommandHandler(name, func))
+
+
+SETUPS = {
+    'handlers': command_handlers,
+    'add_handlers': bot.add_handlers,
+}
+
+# Name -> (text, user) of the updates of a case, made unique by 'i' when needed
+CASES = {
+    'text': (lambda i: 'hello there', MEMBER),
+    'unknown': (lambda i: '/unknown', MEMBER),
+    'help': (lambda i: '/help', MEMBER),
+    'queue': (lambda i: '/queue', MEMBER),
+    'add': (lambda i: '/add item {}'.format(i), MEMBER),
+    'next': (lambda i: '/next', ADMIN),
+    'insert': (lambda i: '/insert new {} 1'.format(i), ADMIN),
+    'denied': (lambda i: '/rm 1', MEMBER),
+}
+
+
+def make_dispatcher(setup):
+    with warnings.catch_warnings():
+        # Handlers run synchronously, no run_async thread pool is needed
+        warnings.simplefilter('ignore', UserWarning)
+        dispatcher = Dispatcher(NamedFakeBot(), queue.Queue(), workers=0)
+    SETUPS[setup](dispatcher)
+    chat_data = dispatcher.chat_data[CHAT_ID]
+    chat_data['is_frozen'] = False
+    chat_data['queue'] = botfunctions.queue.Queue()
+    chat_data['queue'].extend('item {}'.format(i) for i in range(100))
+    return dispatcher
+
+
+def make_updates(fake_bot, case, count):
+    make_text, user_id = CASES[case]
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': 'user{}'.format(user_id)}
+    chat = {'id': CHAT_ID, 'type': 'group', 'title': 'Chat'}
+    updates = []
+    for i in range(count):
+        text = make_text(i)
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text[0] == '/' else []
+        message = {'message_id': i + 1, 'date': 0, 'chat': chat, 'from': user, 'text': text, 'entities': entities}
+        updates.append(telegram.Update.de_json({'update_id': i + 1, 'message': message}, fake_bot))
+    return updates
+
+
+def run_case(setup, case, count):
+    """Return the mean microseconds per update"""
+    dispatcher = make_dispatcher(setup)
+    updates = make_updates(dispatcher.bot, case, count)
+    if case == 'next':
+        dispatcher.chat_data[CHAT_ID]['queue'].extend('more {}'.format(i) for i in range(count))
+    process = dispatcher.process_update
+    start = time.perf_counter()
+    for update in updates:
+        process(update)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=20000, help="updates per case")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per case, the best one is kept")
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    args = parser.parse_args()
+
+    BotRequest.outbox = None
+    print("{:<10} {:>14} {:>14} {:>9}".format('case', 'handlers us', 'add_handlers us', 'speedup'))
+    for case in args.cases:
+        results = {setup: min(run_case(setup, case, args.updates) for _ in range(args.repeat)) for setup in SETUPS}
+        print("{:<10} {:>14.2f} {:>14.2f} {:>8.2f}x".format(
+            case, results['handlers'], results['add_handlers'], results['handlers'] / results['add_handlers']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""Local fake of the Telegram Bot API, used to load test the bot without a
+network.
+
+It serves the handful of methods the bot uses, delivers synthetic updates
+through getUpdates, or POSTs them to the webhook once one is set, and records
+every message sent or edited by the bot.
+"""
+import http.client
+import itertools
+import json
+import queue
+import ssl
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from utils.sharding import update_chat_id
+
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': 'qBot', 'username': 'fake_qbot'}
+
+
+class _Throttled(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Bots stopped or killed by a benchmark drop their connections, that is not an error of the fake
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+class FakeTelegram:
+    """Fake Bot API server.
+    Args:
+        host, port: listen address. Port 0 picks a free port
+        latency: seconds every API call is delayed by, to mimic the network
+        admins: default list of admin user IDs of every group
+        flood_limit: if set, messages per second allowed in a chat before
+            answering with 429 Too Many Requests, as Telegram does
+        bot_is_admin: whether the bot is listed among the admins of groups
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, admins=(1,), flood_limit=None, bot_is_admin=True):
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.throttled = 0
+        self._last_sent = {}
+        self.admins = {}
+        self.default_admins = list(admins) + ([BOT_USER['id']] if bot_is_admin else [])
+        self.sent = []
+        self.edits = []
+        self.pinned = {}
+        self.pushed = []
+        self.calls = {}
+        self.webhook = None
+        self._deliveries = []
+        self.delivery_errors = 0
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._server = _Server((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """Base url to give to the bot, the token is appended to it"""
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/bot'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_deliveries()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Synthetic traffic
+    def make_update(self, chat_id, text, user_id=1, chat_type='group', first_name=None, username=None):
+        """Build the JSON of a text message update"""
+        user = {'id': user_id, 'is_bot': False, 'first_name': first_name or 'User{}'.format(user_id)}
+        if username is not None:
+            user['username'] = username
+        chat = {'id': chat_id, 'type': chat_type}
+        if chat_type == 'private':
+            chat['first_name'] = user['first_name']
+        else:
+            chat['title'] = 'Chat {}'.format(chat_id)
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': chat, 'from': user, 'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def make_chat_member_update(self, chat_id, user_id, status, old_status='member'):
+        """Build the JSON of a chat_member update, e.g. a promotion to
+        'administrator' or a demotion to 'member'"""
+        user = {'id': user_id, 'is_bot': user_id == BOT_USER['id'], 'first_name': 'User{}'.format(user_id)}
+        return {
+            'update_id': next(self._update_ids),
+            'chat_member': {
+                'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Chat {}'.format(chat_id)},
+                'from': {'id': 1, 'is_bot': False, 'first_name': 'User1'}, 'date': int(time.time()),
+                'old_chat_member': {'status': old_status, 'user': user},
+                'new_chat_member': {'status': status, 'user': user},
+            },
+        }
+
+    def push_update(self, update):
+        """Queue an update to be delivered through getUpdates or the webhook.
+        The time of text messages is recorded in 'pushed'"""
+        chat_id = update_chat_id(update)
+        with self._cond:
+            if 'message' in update:
+                self.pushed.append((time.monotonic(), chat_id, update['message'].get('text')))
+            if self._deliveries:
+                # Updates of a chat are delivered in order, by the same connection
+                self._deliveries[hash(chat_id) % len(self._deliveries)].put(update)
+            else:
+                self._updates.append(update)
+                self._cond.notify_all()
+
+    def set_admins(self, chat_id, user_ids):
+        self.admins[chat_id] = list(user_ids)
+
+    def wait_for_messages(self, count, timeout=60):
+        """Block until the bot has sent at least 'count' messages.
+        Return True if it did before the timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.sent) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # Webhook delivery
+    def _deliver(self, inbox, url, secret_token):
+        """POST the updates of a delivery queue to the webhook, retrying as
+        Telegram does until they are accepted"""
+        url = urlsplit(url)
+        path = url.path or '/'
+        headers = {'Content-Type': 'application/json'}
+        if secret_token:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+        conn = None
+        update = inbox.get()
+        while update is not None:
+            try:
+                if conn is None:
+                    if url.scheme == 'https':
+                        conn = http.client.HTTPSConnection(url.hostname, url.port,
+                                                           context=ssl._create_unverified_context())
+                    else:
+                        conn = http.client.HTTPConnection(url.hostname, url.port)
+                conn.request('POST', path, json.dumps(update), headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise http.client.HTTPException(response.status)
+            except (OSError, http.client.HTTPException):
+                with self._lock:
+                    self.delivery_errors += 1
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(0.1)
+                continue
+            update = inbox.get()
+        if conn is not None:
+            conn.close()
+
+    def _start_deliveries(self, url, secret_token, connections):
+        self._stop_deliveries()
+        deliveries = [queue.Queue() for _ in range(connections)]
+        for inbox in deliveries:
+            threading.Thread(target=self._deliver, args=(inbox, url, secret_token), daemon=True).start()
+        with self._cond:
+            self.webhook = url
+            self._deliveries = deliveries
+            # Updates pushed before the webhook was set
+            for update in self._updates:
+                deliveries[hash(update_chat_id(update)) % connections].put(update)
+            self._updates = []
+
+    def _stop_deliveries(self):
+        with self._cond:
+            deliveries, self._deliveries = self._deliveries, []
+            self.webhook = None
+        for inbox in deliveries:
+            inbox.put(None)
+
+    # API methods
+    def _set_webhook(self, params):
+        if not params.get('url'):
+            self._stop_deliveries()
+        else:
+            self._start_deliveries(params['url'], params.get('secret_token'), int(params.get('max_connections') or 40))
+        return True
+
+    def _delete_webhook(self, params):
+        self._stop_deliveries()
+        return True
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return list(self._updates[:100])
+
+    def _send_message(self, params):
+        chat_id = int(params['chat_id'])
+        if self.flood_limit:
+            now = time.monotonic()
+            with self._lock:
+                if now - self._last_sent.get(chat_id, -1) < 1 / self.flood_limit:
+                    self.throttled += 1
+                    raise _Throttled(1)
+                self._last_sent[chat_id] = now
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time.time()), 'from': BOT_USER,
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'Chat {}'.format(chat_id)},
+            'text': params['text'],
+        }
+        with self._cond:
+            self.sent.append((time.monotonic(), chat_id, params['text']))
+            self._cond.notify_all()
+        return message
+
+    def _edit_message_text(self, params):
+        chat_id = int(params['chat_id'])
+        with self._lock:
+            self.edits.append((time.monotonic(), chat_id, int(params['message_id']), params['text']))
+        return True
+
+    def _pin_chat_message(self, params):
+        with self._lock:
+            self.pinned[int(params['chat_id'])] = int(params['message_id'])
+        return True
+
+    def _unpin_chat_message(self, params):
+        with self._lock:
+            self.pinned.pop(int(params['chat_id']), None)
+        return True
+
+    def _get_chat_administrators(self, params):
+        chat_id = int(params['chat_id'])
+        return [
+            {'status': 'administrator', 'user': {'id': user_id, 'is_bot': False, 'first_name': 'Admin'},
+             'can_be_edited': False, 'is_anonymous': False, 'can_manage_chat': True,
+             'can_delete_messages': True, 'can_manage_voice_chats': True, 'can_restrict_members': True,
+             'can_promote_members': False, 'can_change_info': True, 'can_invite_users': True,
+             'can_pin_messages': True}
+            for user_id in self.admins.get(chat_id, self.default_admins)
+        ]
+
+    def dispatch(self, method, params):
+        """Return (ok, result) of an API call"""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        handler = {
+            'getme': lambda p: BOT_USER,
+            'deletewebhook': self._delete_webhook,
+            'setwebhook': self._set_webhook,
+            'getupdates': self._get_updates,
+            'sendmessage': self._send_message,
+            'editmessagetext': self._edit_message_text,
+            'pinchatmessage': self._pin_chat_message,
+            'unpinchatmessage': self._unpin_chat_message,
+            'getchatadministrators': self._get_chat_administrators,
+        }.get(method.lower())
+        if handler is None:
+            return False, {'error_code': 404, 'description': 'Not Found: method not found'}
+        try:
+            return True, handler(params)
+        except _Throttled as e:
+            return False, {'error_code': 429, 'description': 'Too Many Requests: retry after {}'.format(e.retry_after),
+                           'parameters': {'retry_after': e.retry_after}}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _params(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode()))
+                return url.path.rsplit('/', 1)[-1], params
+
+            def _reply(self, payload, status=200):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                method, params = self._params()
+                if fake.latency:
+                    time.sleep(fake.latency)
+                ok, result = fake.dispatch(method, params)
+                if ok:
+                    self._reply({'ok': True, 'result': result})
+                else:
+                    result['ok'] = False
+                    self._reply(result, result['error_code'])
+
+            do_GET = do_POST
+
+        return Handler
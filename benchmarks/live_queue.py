@@ -0,0 +1,91 @@
+"""Outgoing API calls of a busy chat: sending the queue again with /queue
+against a pinned /live message edited in place.
+
+Chats receive bursts of /add commands. In 'queue' mode members look at the
+queue with /queue after adding themselves, in 'live' mode they look at the
+chat's live message instead, which the outbox edits once per burst. The bot
+runs with the threaded runtime and its outbox against a local fake Telegram
+API server, which counts the calls.
+
+Run from the repository root:
+    python -m benchmarks.live_queue [--chats 20] [--bursts 5] [--burst-size 10] [--checks 10]
+"""
+import argparse
+import time
+from telegram.ext import Updater
+
+import bot
+from benchmarks.fake_telegram import FakeTelegram
+from utils.botrequest import BotRequest
+from utils.outbox import ThreadedOutbox
+
+TOKEN = '123456:fake'
+
+
+def wait_idle(fake, quiet=1.0, timeout=120):
+    """Wait until the bot made no call for 'quiet' seconds, besides polling
+    for updates"""
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        calls = sum(count for method, count in fake.calls.items() if method != 'getUpdates')
+        if calls == last:
+            return
+        last = calls
+        time.sleep(quiet)
+
+
+def run_mode(fake, mode, chats, bursts, burst_size, checks, gap, first_chat_id):
+    """Push the bursts of a mode. Return the API calls and bytes of text it caused"""
+    calls_before = dict(fake.calls)
+    sent_before, edits_before = len(fake.sent), len(fake.edits)
+    chat_ids = [-(first_chat_id + chat) for chat in range(chats)]
+    for chat_id in chat_ids:
+        fake.push_update(fake.make_update(chat_id, '/unfreeze'))
+        if mode == 'live':
+            fake.push_update(fake.make_update(chat_id, '/live'))
+    for burst in range(bursts):
+        for chat_id in chat_ids:
+            for i in range(burst_size):
+                fake.push_update(fake.make_update(chat_id, '/add item {}-{}'.format(burst, i), user_id=2 + i))
+                if mode == 'queue' and i < checks:
+                    fake.push_update(fake.make_update(chat_id, '/queue', user_id=2 + i))
+        time.sleep(gap)
+    wait_idle(fake)
+    calls = {method: count - calls_before.get(method, 0) for method, count in fake.calls.items()}
+    text = sum(len(text) for _, _, text in fake.sent[sent_before:])
+    text += sum(len(text) for _, _, _, text in fake.edits[edits_before:])
+    return calls, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--bursts', type=int, default=5)
+    parser.add_argument('--burst-size', type=int, default=10, help="/add commands per burst and chat")
+    parser.add_argument('--checks', type=int, default=10, help="/queue commands per burst in 'queue' mode")
+    parser.add_argument('--gap', type=float, default=3.0, help="seconds between bursts")
+    parser.add_argument('--edit-delay', type=float, default=2.0, help="debounce delay of the edits")
+    args = parser.parse_args()
+
+    print("{:<6} {:>12} {:>16} {:>11} {:>10}".format('mode', 'sendMessage', 'editMessageText', 'API calls', 'text KiB'))
+    with FakeTelegram() as fake:
+        updater = Updater(token=TOKEN, base_url=fake.base_url, workers=4, use_context=True)
+        bot.add_handlers(updater.dispatcher)
+        BotRequest.outbox = ThreadedOutbox(updater.bot.send_message, updater.bot.edit_message_text,
+                                           edit_delay=args.edit_delay).start()
+        updater.start_polling(poll_interval=0, timeout=1)
+        try:
+            for i, mode in enumerate(('queue', 'live')):
+                calls, text = run_mode(fake, mode, args.chats, args.bursts, args.burst_size, args.checks, args.gap,
+                                       first_chat_id=1 + i * args.chats)
+                sends, edits = calls.get('sendMessage', 0), calls.get('editMessageText', 0)
+                print("{:<6} {:>12} {:>16} {:>11} {:>10.1f}".format(mode, sends, edits, sends + edits, text / 2 ** 10))
+        finally:
+            updater.stop()
+            BotRequest.outbox.stop()
+            BotRequest.outbox = None
+
+
+if __name__ == '__main__':
+    main()
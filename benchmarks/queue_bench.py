@@ -0,0 +1,167 @@
+"""Micro-benchmark of the indexed Queue against the former list-backed one.
+
+The indexed Queue is also measured in fair-share order against arrival
+order, with two items per user and every popped item added back.
+
+Run from the repository root:
+    python -m benchmarks.queue_bench [--sizes 10000 100000 1000000] [--ops 1000] [--memory 1000000]
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from utils.queue import Queue
+
+
+class ListQueue:
+    """Plain list-backed queue. This is the original implementation of
+    utils.queue.Queue, kept as the reference of this benchmark."""
+    def __init__(self):
+        self._items = []
+        self._data = {}
+
+    def append(self, item, **data):
+        self._items.append(item)
+        if data:
+            self._data[item] = data
+
+    def insert(self, index, item, **data):
+        self._items.insert(index, item)
+        if data:
+            self._data[item] = data
+
+    def extend(self, items, **data):
+        for item in items:
+            self.append(item, **data)
+
+    def pop(self):
+        return self.remove(0)
+
+    def pop_many(self, count):
+        return [self.remove(0) for _ in range(min(count, len(self._items)))]
+
+    def remove_many(self, indices):
+        return [self.remove(index) for index in sorted(set(indices), reverse=True)][::-1]
+
+    def remove(self, index):
+        item = self._items.pop(index)
+        if item in self._data:
+            data = self._data.pop(item)
+        else:
+            data = None
+        return item, data
+
+    def clear(self):
+        self._items = []
+        self._data = {}
+
+    def index(self, item):
+        return self._items.index(item)
+
+    def is_empty(self):
+        return len(self) == 0
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _timeit(func, ops):
+    """Return the mean time per operation in microseconds"""
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) / ops * 1e6
+
+
+def run(queue_class, size, ops, seed=0):
+    rnd = random.Random(seed)
+    q = queue_class()
+    results = {'append': _timeit(lambda: [q.append(i) for i in range(size)], size)}
+
+    probes = [rnd.randrange(size) for _ in range(ops)]
+    results['contains'] = _timeit(lambda: [p in q for p in probes], ops)
+    results['index'] = _timeit(lambda: [q.index(p) for p in probes], ops)
+
+    positions = [rnd.randrange(size // 2) for _ in range(ops)]
+    results['insert'] = _timeit(lambda: [q.insert(p, size + i) for i, p in enumerate(positions)], ops)
+    results['remove'] = _timeit(lambda: [q.remove(p) for p in positions], ops)
+    results['pop'] = _timeit(lambda: [q.pop() for _ in range(ops)], ops)
+
+    # Bulk operations, per item
+    bulk = queue_class()
+    results['extend'] = _timeit(lambda: bulk.extend(range(size)), size)
+    indices = rnd.sample(range(size), ops)
+    results['remove_many'] = _timeit(lambda: bulk.remove_many(indices), ops)
+    return results
+
+
+def run_fair(fair, size, ops, seed=0):
+    rnd = random.Random(seed)
+    q = Queue()
+    q.set_fair(fair)
+    users = max(1, size // 2)
+    results = {'append': _timeit(lambda: [q.append(i, user_id=i % users + 1, timestamp=float(i))
+                                          for i in range(size)], size)}
+
+    def serve():
+        for i in range(ops):
+            entry = q.pop()
+            q.append(entry.item, user_id=entry.user_id, timestamp=float(size + i))
+    results['pop+add'] = _timeit(serve, ops)
+    probes = [rnd.randrange(size) for _ in range(ops)]
+    results['index'] = _timeit(lambda: [q.index(p) for p in probes], ops)
+    results['positions_of'] = _timeit(lambda: [q.positions_of(p % users + 1) for p in probes], ops)
+    return results
+
+
+def memory(queue_class, size):
+    """Return the bytes used by a queue of 'size' entries, each with the
+    ID of its user and its timestamp. Items themselves are not counted"""
+    items = ['item {}'.format(i) for i in range(size)]
+    tracemalloc.start()
+    q = queue_class()
+    for i, item in enumerate(items):
+        q.append(item, user_id=100000000 + i, timestamp=1600000000.0 + i)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--ops', type=int, default=1000)
+    parser.add_argument('--memory', type=int, default=1000000, help="entries of the memory comparison, 0 to skip")
+    args = parser.parse_args()
+
+    columns = ['append', 'contains', 'index', 'insert', 'remove', 'pop', 'extend', 'remove_many']
+    print("{:<10} {:>9}".format('queue', 'size') + ''.join("{:>12}".format(c) for c in columns))
+    for size in args.sizes:
+        for queue_class in (ListQueue, Queue):
+            results = run(queue_class, size, args.ops)
+            print("{:<10} {:>9}".format(queue_class.__name__, size)
+                  + ''.join("{:>10.2f}us".format(results[c]) for c in columns))
+
+    print()
+    columns = ['append', 'pop+add', 'index', 'positions_of']
+    print("{:<10} {:>9}".format('order', 'size') + ''.join("{:>14}".format(c) for c in columns))
+    for size in args.sizes:
+        for fair in (False, True):
+            results = run_fair(fair, size, args.ops)
+            print("{:<10} {:>9}".format('fair' if fair else 'arrival', size)
+                  + ''.join("{:>12.2f}us".format(results[c]) for c in columns))
+
+    if args.memory:
+        print()
+        for queue_class in (ListQueue, Queue):
+            print("{:<10} {:>9} entries with metadata: {:8.1f} MiB".format(
+                queue_class.__name__, args.memory, memory(queue_class, args.memory) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+"""Replay of recorded updates against the bot, for capacity planning.
+
+Updates recorded with RECORD_UPDATES in bot.py (utils/recorder.py) are
+pushed to a local fake Telegram server at the pace they were received, 10
+times faster, or all at once, and handled by the bot with the handlers in
+botfunctions.COMMANDS, in a fresh process for every speed. For every speed
+it reports:
+  - the offered and the handled updates/s: all at once, the throughput
+    ceiling of the bot
+  - latency percentiles per command, from the update reaching the fake
+    server to the command returning, and the wait before the command starts
+  - the time the commands spent looking up admins (getChatAdministrators)
+    and sending replies, and how long the replies took to be delivered after
+    the last command
+  - when the bot falls behind, which of them is the bottleneck
+Gaps longer than --max-gap seconds, as the nights of a long recording, are
+shortened to --max-gap.
+
+Run from the repository root:
+    python -m benchmarks.replay updates.jsonl [--speeds 1 10 max] [--runtime threaded] [--latency 0.05]
+--sample writes a synthetic recording to try it without one:
+    python -m benchmarks.replay --sample updates.jsonl [--chats 200] [--duration 60] [--rate 50]
+"""
+import argparse
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from utils.recorder import BOT_USER_ID, BOT_USERNAME, VERSION, read_recording
+
+TOKEN = '123456:fake'
+# Waiting longer than this before a command starts means the bot is behind the offered rate
+BEHIND_WAIT = 1.0
+# Commands of the synthetic recording, with their weights
+SAMPLE_COMMANDS = [('/add {item}', 40), ('/queue', 15), ('/next', 12), ('/whereami', 5), ('/rm 1', 4),
+                   ('/add @side {item}', 5), ('/queues', 2), ('/insert {item} 1', 3), ('/freeze', 2),
+                   ('/unfreeze', 2), ('/addmany\n{item}\n{item}x', 3), ('hello there', 7)]
+
+
+def write_sample(filename, chats, duration, rate, seed):
+    """Write a recording of 'duration' seconds of Poisson traffic at 'rate'
+    updates/s. A few chats get most of the traffic"""
+    rnd = random.Random(seed)
+    commands, weights = zip(*SAMPLE_COMMANDS)
+    start = time.time()
+    t = 0.0
+    with open(filename, 'w') as f:
+        f.write(json.dumps({'version': VERSION, 'started': start}) + '\n')
+        update_id = 0
+        for chat in range(chats):
+            update_id += 1
+            f.write(json.dumps({'t': start, 'update': _sample_update(update_id, -1 - chat, 1, '/unfreeze')}) + '\n')
+        while t < duration:
+            t += rnd.expovariate(rate)
+            update_id += 1
+            chat_id = -1 - min(int(rnd.paretovariate(1.2)) - 1, chats - 1)
+            text = rnd.choices(commands, weights)[0].format(item='w{:x}'.format(rnd.randrange(1 << 24)))
+            update = _sample_update(update_id, chat_id, rnd.randrange(1, 50), text)
+            f.write(json.dumps({'t': round(start + t, 3), 'update': update}) + '\n')
+    return update_id
+
+
+def _sample_update(update_id, chat_id, user_id, text):
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': chat_id, 'type': 'supergroup'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_schedule(records, speed, max_gap):
+    """Return the (seconds from the start, update) pairs to push. speed is a
+    factor, or None to push everything at once"""
+    schedule = []
+    offset = 0.0
+    previous = records[0][0] if records else 0
+    for t, update in records:
+        offset += min(max(t - previous, 0), max_gap)
+        previous = t
+        schedule.append((offset / speed if speed else 0.0, update))
+    return schedule
+
+
+def adapt_update(update, update_id, bot_user):
+    """Give the update a new ID, and the identity of the fake bot to the
+    recorded bot"""
+    update = dict(update, update_id=update_id)
+    message = update.get('message')
+    if message is not None:
+        words = message['text'].split(maxsplit=1)
+        if words and words[0].startswith('/') and words[0].endswith('@' + BOT_USERNAME):
+            text = message['text'].replace('@' + BOT_USERNAME, '@' + bot_user['username'], 1)
+            update['message'] = dict(message, text=text, entities=[
+                {'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}])
+        return update
+    for kind in ('chat_member', 'my_chat_member'):
+        member_update = update.get(kind)
+        if member_update is not None:
+            update[kind] = dict(member_update)
+            for field in ('old_chat_member', 'new_chat_member'):
+                member = member_update[field]
+                if member['user']['id'] == BOT_USER_ID:
+                    update[kind][field] = dict(member, user=dict(member['user'], id=bot_user['id']))
+    return update
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else None
+
+
+class CommandTimings:
+    """Wraps the commands of a dict to time them. Every call is recorded as
+    (command, update_id, start, end), in time.monotonic() seconds"""
+    def __init__(self, commands):
+        self.calls = []
+        for name, func in list(commands.items()):
+            commands[name] = self._wrap(name, func)
+
+    def _wrap(self, name, func):
+        calls = self.calls
+
+        def timed(update, context):
+            start = time.monotonic()
+            try:
+                return func(update, context)
+            finally:
+                calls.append((name, update.update_id, start, time.monotonic()))
+        return timed
+
+
+def start_bot(fake, runtime, workers):
+    """Start the bot on the fake server. Return the function stopping it"""
+    import bot
+    import botfunctions
+    from utils.botrequest import BotRequest
+    if runtime == 'threaded':
+        from telegram.ext import Updater
+        from utils.outbox import ThreadedOutbox
+        updater = Updater(token=TOKEN, base_url=fake.base_url, workers=workers, use_context=True,
+                          request_kwargs={'con_pool_size': workers + 8})
+        bot.add_handlers(updater.dispatcher)
+        if bot.OUTBOX is True:
+            BotRequest.outbox = ThreadedOutbox(updater.bot.send_message, updater.bot.edit_message_text).start()
+        updater.start_polling(poll_interval=0, timeout=1)
+
+        def stop():
+            updater.stop()
+            if BotRequest.outbox is not None:
+                BotRequest.outbox.stop()
+        return stop
+
+    import asyncio
+    from utils.aiobot import AsyncRuntime
+    runtime = AsyncRuntime(TOKEN, botfunctions.COMMANDS, base_url=fake.base_url, outbox=bot.OUTBOX)
+    thread = threading.Thread(target=asyncio.run, args=(runtime.poll(timeout=1),), daemon=True)
+    thread.start()
+
+    def stop():
+        runtime.stop()
+        thread.join()
+    return stop
+
+
+def wait_until(condition, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def wait_delivered(fake, timeout, quiet=0.5):
+    """Wait until the outbox is empty and the bot made no call besides
+    polling for 'quiet' seconds"""
+    from utils.botrequest import BotRequest
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        calls = sum(count for method, count in fake.calls.items() if method != 'getUpdates')
+        outbox = BotRequest.outbox
+        if calls == last and (outbox is None or not outbox.stats()['depth']):
+            return True
+        last = calls
+        time.sleep(quiet)
+    return False
+
+
+def child(args):
+    """Replay the recording at one speed and print the results as JSON"""
+    import bot
+    import botfunctions
+    from benchmarks.fake_telegram import BOT_USER, FakeTelegram
+    from utils.admins import ADMINS
+    from utils.dispatch import parse_command
+    from utils.metrics import METRICS
+
+    speed = None if args.child == 'max' else float(args.child)
+    bot.OUTBOX = not args.no_outbox
+    bot.RUN_ASYNC = args.run_async
+    METRICS.enable()
+    timings = CommandTimings(botfunctions.COMMANDS)
+    schedule = [(offset, adapt_update(update, i + 1, BOT_USER))
+                for i, (offset, update) in enumerate(make_schedule(read_recording(args.recording), speed,
+                                                                   args.max_gap))]
+    expected = 0
+    chat_users = {}
+    for _, update in schedule:
+        message = update.get('message')
+        if message is None:
+            continue
+        if message['chat']['type'] != 'private':
+            chat_users.setdefault(message['chat']['id'], []).append(message['from']['id'])
+        parsed = parse_command(message['text'])
+        if parsed and parsed[0] in botfunctions.COMMANDS and parsed[1] in ('', BOT_USER['username']):
+            expected += 1
+
+    with FakeTelegram(latency=args.latency, bot_is_admin=not args.bot_not_admin) as fake:
+        for chat_id, users in chat_users.items():
+            admins = list(dict.fromkeys(users)) if args.admins == 'all' else users[:1]
+            fake.set_admins(chat_id, admins + ([] if args.bot_not_admin else [BOT_USER['id']]))
+        stop = start_bot(fake, args.runtime, args.workers)
+        wait_until(lambda: fake.calls.get('getUpdates'), 30)
+        pushed = {}
+        start = time.monotonic()
+        for offset, update in schedule:
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pushed[update['update_id']] = time.monotonic()
+            fake.push_update(update)
+        push_end = time.monotonic()
+        done = wait_until(lambda: len(timings.calls) >= expected, args.timeout)
+        commands_end = max((end for _, _, _, end in timings.calls), default=push_end)
+        wait_delivered(fake, args.timeout)
+        last_reply = max([sent[0] for sent in fake.sent] + [edit[0] for edit in fake.edits], default=commands_end)
+        stop()
+        api_calls = dict(fake.calls)
+
+    histograms = METRICS.histograms()
+
+    def seconds(name):
+        return sum(histogram.sum for (metric, _), histogram in histograms.items() if metric == name)
+
+    per_command = {}
+    for name, update_id, started, ended in timings.calls:
+        stats = per_command.setdefault(name, {'latency': [], 'handler': []})
+        stats['latency'].append(ended - pushed[update_id])
+        stats['handler'].append(ended - started)
+    waits = [started - pushed[update_id] for _, update_id, started, _ in timings.calls]
+    print(json.dumps({
+        'speed': args.child, 'updates': len(schedule), 'commands': len(timings.calls), 'expected': expected,
+        'done': done, 'offered': schedule[-1][0] if schedule else 0, 'push': push_end - start,
+        'handled': commands_end - start, 'drain': max(last_reply - commands_end, 0),
+        'wait_p50': percentile(waits, 0.5), 'wait_p99': percentile(waits, 0.99),
+        'command_seconds': sum(end - begin for _, _, begin, end in timings.calls),
+        'admin_seconds': seconds('qbot_admin_lookup_seconds'), 'send_seconds': seconds('qbot_send_seconds'),
+        'admin_fetches': ADMINS.counters['fetches'], 'api_calls': api_calls,
+        'per_command': {name: {
+            'count': len(stats['latency']), 'p50': percentile(stats['latency'], 0.5),
+            'p90': percentile(stats['latency'], 0.9), 'p99': percentile(stats['latency'], 0.99),
+            'handler': sum(stats['handler']) / len(stats['handler'])} for name, stats in per_command.items()},
+    }), flush=True)
+
+
+def bottlenecks(result, runtime):
+    """Return what the bot waited on in a run: commands starting late because
+    of admin lookups or of the commands themselves, and replies delivered late.
+    Empty if it kept up"""
+    found = []
+    # The asyncio runtime looks up admins before running the command, the threaded one inside it
+    busy = result['command_seconds'] + (result['admin_seconds'] if runtime == 'asyncio' else 0)
+    if not result['done'] or result['wait_p99'] >= BEHIND_WAIT:
+        if result['admin_seconds'] > busy / 2:
+            found.append('admin lookups (getChatAdministrators)')
+        elif result['send_seconds'] > busy / 2:
+            found.append('sends from the commands')
+        else:
+            found.append('command handlers')
+    if result['drain'] >= BEHIND_WAIT:
+        found.append('outbound sends, {:.1f}s behind the commands'.format(result['drain']))
+    return found
+
+
+def report(result, runtime):
+    handled = result['commands'] / result['handled'] if result['handled'] else 0
+    busy = result['command_seconds'] + (result['admin_seconds'] if runtime == 'asyncio' else 0) or 1
+    api = result['api_calls']
+    print("speed {}: {} updates, {} commands{}".format(
+        result['speed'], result['updates'], result['commands'],
+        '' if result['done'] else ' ({} expected, timed out)'.format(result['expected'])))
+    offered = '{:.1f} updates/s'.format(result['updates'] / result['offered']) if result['offered'] else 'all at once'
+    print("  offered {}, handled {:.1f} commands/s, wait p50 {:.1f} ms p99 {:.1f} ms".format(
+        offered, handled, (result['wait_p50'] or 0) * 1000, (result['wait_p99'] or 0) * 1000))
+    print("  admin lookups {:.0f}% of command time, {} getChatAdministrators; sends {:.0f}%, {} sendMessage, "
+          "replies delivered {:.2f}s after the last command".format(
+              result['admin_seconds'] / busy * 100, api.get('getChatAdministrators', 0),
+              result['send_seconds'] / busy * 100, api.get('sendMessage', 0), result['drain']))
+    print("  bottleneck: {}".format(', '.join(bottlenecks(result, runtime)) or "none, the bot kept up"))
+    print("  {:<20} {:>7} {:>9} {:>9} {:>9} {:>11}".format('command', 'count', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                           'handler ms'))
+    for name, stats in sorted(result['per_command'].items(), key=lambda item: -item[1]['count']):
+        print("  {:<20} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>11.2f}".format(
+            name, stats['count'], stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000,
+            stats['handler'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recording', nargs='?', help="file written with RECORD_UPDATES")
+    parser.add_argument('--speeds', nargs='+', default=['1', '10', 'max'], help="speed-ups, or 'max'")
+    parser.add_argument('--runtime', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--workers', type=int, default=4, help="threads of the threaded runtime")
+    parser.add_argument('--run-async', action='store_true', help="run the commands on the workers (RUN_ASYNC)")
+    parser.add_argument('--no-outbox', action='store_true', help="send replies from the commands")
+    parser.add_argument('--latency', type=float, default=0.05, help="fake network latency in seconds")
+    parser.add_argument('--admins', choices=['first', 'all'], default='first',
+                        help="admins of a group: the first user seen in it, or every user")
+    parser.add_argument('--bot-not-admin', action='store_true',
+                        help="the bot is not an admin of the groups, admin lists are fetched and cached for 1h")
+    parser.add_argument('--max-gap', type=float, default=60, help="longest pause replayed, in recorded seconds")
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--sample', metavar='FILE', help="write a synthetic recording to FILE and exit")
+    parser.add_argument('--chats', type=int, default=200, help="chats of the synthetic recording")
+    parser.add_argument('--duration', type=float, default=60, help="seconds of the synthetic recording")
+    parser.add_argument('--rate', type=float, default=50, help="updates/s of the synthetic recording")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.sample:
+        count = write_sample(args.sample, args.chats, args.duration, args.rate, args.seed)
+        print("Wrote {} updates to {}".format(count, args.sample))
+        return
+    if not args.recording:
+        parser.error("a recording is required")
+    if args.child:
+        child(args)
+        return
+
+    for speed in args.speeds:
+        command = [sys.executable, '-m', 'benchmarks.replay', args.recording, '--child', speed]
+        command += ['--runtime', args.runtime, '--workers', str(args.workers), '--latency', str(args.latency),
+                    '--admins', args.admins, '--max-gap', str(args.max_gap), '--timeout', str(args.timeout)]
+        command += [flag for flag, on in (('--run-async', args.run_async), ('--no-outbox', args.no_outbox),
+                                          ('--bot-not-admin', args.bot_not_admin)) if on]
+        output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+        report(json.loads(output.strip().splitlines()[-1]), args.runtime)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Throughput of the sharded bot with 1, 2, 4 and 8 worker processes.
+
+A synthetic stream of commands for many group chats is POSTed to the webhook
+front end, from several client connections, and the time until every reply
+reaches a local fake Telegram server is measured. Updates of a chat are always
+sent by the same connection, so their order is preserved up to the workers.
+
+Run from the repository root:
+    python -m benchmarks.shard_bench [--chats 400] [--updates 10] [--latency 0.01]
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+
+import bot
+from benchmarks.fake_telegram import FakeTelegram
+from utils.sharding import ShardedBot
+
+TOKEN = '123456:fake'
+
+
+def make_stream(fake, chats, updates_per_chat):
+    """Return the updates of every chat, as a list per chat: an /unfreeze by
+    the admin then a mix of /add, /queue and /next. Every update gets one reply"""
+    stream = []
+    for chat in range(chats):
+        chat_id = -(1 + chat)
+        updates = [fake.make_update(chat_id, '/unfreeze', user_id=1)]
+        for i in range(updates_per_chat):
+            if i % 5 == 3:
+                updates.append(fake.make_update(chat_id, '/queue', user_id=2))
+            elif i % 5 == 4:
+                updates.append(fake.make_update(chat_id, '/next', user_id=1))
+            else:
+                updates.append(fake.make_update(chat_id, '/add item {}'.format(i), user_id=2 + i))
+        stream.append(updates)
+    return stream
+
+
+def post_all(address, path, chats):
+    """POST the updates of some chats, in order, on a keep-alive connection"""
+    conn = http.client.HTTPConnection(*address)
+    for updates in chats:
+        for update in updates:
+            conn.request('POST', path, json.dumps(update), {'Content-Type': 'application/json'})
+            conn.getresponse().read()
+    conn.close()
+
+
+def run(shards, chats, updates_per_chat, latency, clients, timeout):
+    with FakeTelegram(latency=latency) as fake:
+        stream = make_stream(fake, chats, updates_per_chat)
+        sharded = ShardedBot(TOKEN, shards, bot.add_handlers, base_url=fake.base_url, outbox=False,
+                             port=0, url_path='/webhook').start()
+        expected = sum(len(updates) for updates in stream)
+        start = time.perf_counter()
+        threads = [threading.Thread(target=post_all, args=(sharded.server.address, '/webhook', stream[i::clients]))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done = fake.wait_for_messages(expected, timeout)
+        elapsed = time.perf_counter() - start
+        sharded.stop(timeout=10)
+        return done, len(fake.sent), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=400)
+    parser.add_argument('--updates', type=int, default=10, help="commands per chat after /unfreeze")
+    parser.add_argument('--latency', type=float, default=0.01, help="fake network latency in seconds")
+    parser.add_argument('--clients', type=int, default=8, help="connections posting to the webhook")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    for shards in args.shards:
+        done, replies, elapsed = run(shards, args.chats, args.updates, args.latency, args.clients, args.timeout)
+        status = '' if done else ' (timed out)'
+        print("{} shard(s): {:>6} replies in {:7.2f}s: {:8.1f} updates/s{}".format(
+            shards, replies, elapsed, replies / elapsed, status))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Export and import of a million queued items with utils.snapshot.
+
+Builds the chat_data of many chats, with items carrying user IDs, timestamps
+and some notes, and measures:
+  - export: writing every chat to a snapshot
+  - import: reading every chat back from the memory-mapped snapshot
+  - load one: loading single chats through the index
+  - pickle: dumping and loading the same chats with pickle, as
+    PicklePersistence does with persistence/data.pck
+With --journal, the chats are also imported into a journal database and
+exported from it, as when moving a bot using the journal backend.
+
+Run from the repository root:
+    python -m benchmarks.snapshot_bench [--items 1000000] [--chats 1000] [--journal]
+"""
+import argparse
+import os
+import pickle
+import random
+import tempfile
+import time
+
+from utils.queue import Queue
+from utils.snapshot import SnapshotReader, SnapshotWriter, export_persistence, import_snapshot
+
+
+def make_chats(chats, items, rnd):
+    """Return chat_id -> chat_data, the items spread over the chats, some of
+    them in named queues"""
+    data = {}
+    per_chat = items // chats
+    now = time.time()
+    for chat_id in range(-chats, 0):
+        chat_data = {'is_frozen': rnd.random() < 0.1, 'is_protected': rnd.random() < 0.5}
+        queue = chat_data['queue'] = Queue()
+        named = chat_data['queue:extra'] = Queue()
+        for i in range(per_chat):
+            target = named if i % 10 == 0 else queue
+            target.append('item {} of {}'.format(i, chat_id), user_id=rnd.randrange(1, 10 ** 9),
+                          timestamp=now - rnd.uniform(0, 86400), note='note {}'.format(i) if i % 5 == 0 else None)
+        data[chat_id] = chat_data
+    return data
+
+
+def report(label, items, size, elapsed):
+    print("{:<12} {:6.2f}s  {:>10.0f} items/s  {:>8.1f} MB/s".format(
+        label, elapsed, items / elapsed, size / elapsed / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=1000000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--loads', type=int, default=100, help="single chats loaded through the index")
+    parser.add_argument('--journal', action='store_true', help="also import into and export from a journal")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    chats = make_chats(args.chats, args.items, rnd)
+    items = sum(len(value) for chat_data in chats.values() for value in chat_data.values()
+                if isinstance(value, Queue))
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, 'chats.qsnap')
+    print("{} items in {} chats".format(items, len(chats)))
+
+    start = time.perf_counter()
+    with SnapshotWriter(path) as writer:
+        for chat_id, chat_data in chats.items():
+            writer.write_chat(chat_id, chat_data)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(path)
+    report('export', items, size, elapsed)
+
+    start = time.perf_counter()
+    with SnapshotReader(path) as reader:
+        loaded = sum(1 for _ in reader)
+    report('import', items, size, time.perf_counter() - start)
+    assert loaded == len(chats)
+
+    with SnapshotReader(path) as reader:
+        chat_ids = rnd.sample(reader.chat_ids(), min(args.loads, len(chats)))
+        start = time.perf_counter()
+        for chat_id in chat_ids:
+            reader.load_chat(chat_id)
+        elapsed = time.perf_counter() - start
+    print("{:<12} {:8.2f} ms per chat of {} items".format('load one', elapsed / len(chat_ids) * 1000,
+                                                         items // len(chats)))
+
+    start = time.perf_counter()
+    data = pickle.dumps(chats, protocol=pickle.HIGHEST_PROTOCOL)
+    report('pickle dump', items, len(data), time.perf_counter() - start)
+    start = time.perf_counter()
+    pickle.loads(data)
+    report('pickle load', items, len(data), time.perf_counter() - start)
+    print("snapshot {:.1f} MB, pickle {:.1f} MB".format(size / 1e6, len(data) / 1e6))
+
+    if args.journal:
+        journal = os.path.join(directory.name, 'journal.db')
+        start = time.perf_counter()
+        import_snapshot(path, journal)
+        report('to journal', items, size, time.perf_counter() - start)
+        start = time.perf_counter()
+        export_persistence(journal, os.path.join(directory.name, 'journal.qsnap'))
+        report('from journal', items, size, time.perf_counter() - start)
+    directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Cold start of the bot: import time and latency of the first reply.
+
+Each run starts a fresh interpreter running the bot, with the threaded
+Updater or the asyncio runtime, against a local fake Telegram server that
+already holds a /add update. It reports:
+  - import: time spent importing the bot and its runtime, measured in the
+    new interpreter
+  - first reply: time from starting the interpreter to the fake server
+    receiving the reply to the /add
+The time spent formatting replies with the message templates is reported
+too, against str.format.
+
+Run from the repository root:
+    python -m benchmarks.startup_bench [--runs 5]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+TOKEN = '123456:fake'
+
+
+def child(mode, base_url):
+    """Body of the bot process: import, report the import time and serve"""
+    start = time.perf_counter()
+    import bot
+    import botfunctions
+    from utils.botrequest import BotRequest
+    if mode == 'threaded':
+        from telegram.ext import Updater
+        from utils.outbox import ThreadedOutbox
+    else:
+        from utils.aiobot import AsyncRuntime
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'import': elapsed, 'ext': 'telegram.ext' in sys.modules}), flush=True)
+    if mode == 'threaded':
+        updater = Updater(token=TOKEN, base_url=base_url, workers=bot.WORKERS, use_context=True)
+        bot.add_handlers(updater.dispatcher)
+        if bot.OUTBOX is True:
+            BotRequest.outbox = ThreadedOutbox(updater.bot.send_message, updater.bot.edit_message_text).start()
+        updater.start_polling(poll_interval=0, timeout=1)
+    else:
+        AsyncRuntime(TOKEN, botfunctions.COMMANDS, base_url=base_url, outbox=bot.OUTBOX).run()
+
+
+def run_once(mode, timeout):
+    """Return (import seconds, first reply seconds, telegram.ext imported)"""
+    from benchmarks.fake_telegram import FakeTelegram
+    with FakeTelegram() as fake:
+        fake.push_update(fake.make_update(1, '/add item', user_id=1, chat_type='private'))
+        start = time.monotonic()
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.startup_bench', '--child', mode, fake.base_url],
+                                   stdout=subprocess.PIPE, text=True)
+        try:
+            report = json.loads(process.stdout.readline())
+            if not fake.wait_for_messages(1, timeout):
+                raise RuntimeError("The bot did not reply within {}s".format(timeout))
+            first_reply = fake.sent[0][0] - start
+        finally:
+            process.kill()
+            process.wait()
+    return report['import'], first_reply, report['ext']
+
+
+def template_times(number):
+    """Return the mean microseconds to render the templates of a reply with
+    str.format and with the compiled templates"""
+    from utils import messages
+    fields = {'user': 'alice (Alice)', 'item': 'some item', 'index': 12}
+    template = messages.ADD_SUCCESS_GROUP
+    text = str(template)
+    template.format(**fields)
+    plain = timeit.timeit(lambda: text.format(**fields), number=number) / number * 1e6
+    compiled = timeit.timeit(lambda: template.format(**fields), number=number) / number * 1e6
+    return plain, compiled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="runs per runtime, the median is reported")
+    parser.add_argument('--modes', nargs='+', choices=['threaded', 'asyncio'], default=['threaded', 'asyncio'])
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'BASE_URL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    print("{:<9} {:>10} {:>15} {:>13}".format('runtime', 'import ms', 'first reply ms', 'telegram.ext'))
+    for mode in args.modes:
+        runs = [run_once(mode, args.timeout) for _ in range(args.runs)]
+        print("{:<9} {:>10.0f} {:>15.0f} {:>13}".format(
+            mode, statistics.median(run[0] for run in runs) * 1000, statistics.median(run[1] for run in runs) * 1000,
+            'imported' if runs[0][2] else 'not imported'))
+    plain, compiled = template_times(200000)
+    print("formatting a reply: str.format {:.2f} us, compiled template {:.2f} us".format(plain, compiled))
+
+
+if __name__ == '__main__':
+    main()
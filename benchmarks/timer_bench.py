@@ -0,0 +1,75 @@
+"""Cost of the timers of many chats in utils.scheduler.Scheduler.
+
+Schedules one turn timer per chat, reschedules each of them a few times, as
+/next does, cancels a share of them and fires the rest. Optionally saves them
+in a TimerStore, as the bot does with PERSISTENCY.
+
+Run from the repository root:
+    python -m benchmarks.timer_bench [--chats 1000000] [--reschedules 3] [--store]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from utils.scheduler import Scheduler, TimerStore
+
+
+def timed(label, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<12} {:>9} ops in {:6.2f}s  {:>8.2f} us/op".format(label, count, elapsed, elapsed / count * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=1000000)
+    parser.add_argument('--reschedules', type=int, default=3, help="reschedules per timer")
+    parser.add_argument('--cancel', type=float, default=0.2, help="share of the timers cancelled")
+    parser.add_argument('--store', action='store_true', help="save the timers in a SQLite TimerStore")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    directory = tempfile.TemporaryDirectory()
+    store = TimerStore(os.path.join(directory.name, 'timers.db')) if args.store else None
+    scheduler = Scheduler(store)
+    now = 1000000.0
+    chats = list(range(args.chats))
+
+    def schedule():
+        for chat_id in chats:
+            scheduler.schedule(chat_id, 'next', now + rnd.uniform(60, 3600))
+
+    def reschedule():
+        for _ in range(args.reschedules):
+            for chat_id in chats:
+                scheduler.schedule(chat_id, 'next', now + rnd.uniform(60, 3600))
+
+    cancelled = rnd.sample(chats, int(len(chats) * args.cancel))
+
+    def cancel():
+        for chat_id in cancelled:
+            scheduler.cancel(chat_id, 'next')
+
+    fired = []
+
+    def fire():
+        # One pop per simulated second, as the runner wakes up for the first due timer
+        for second in range(0, 3601):
+            fired.extend(scheduler.pop_due(now + second)[0])
+
+    timed('schedule', len(chats), schedule)
+    timed('reschedule', len(chats) * args.reschedules, reschedule)
+    timed('cancel', len(cancelled), cancel)
+    timed('fire', len(chats) - len(cancelled), fire)
+    print("{} timers fired, {} pending, {}".format(len(fired), len(scheduler), scheduler.stats()))
+    if store is not None:
+        store.close()
+    directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
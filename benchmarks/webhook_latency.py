@@ -0,0 +1,119 @@
+"""End-to-end command latency with polling and with the webhook.
+
+Commands for many group chats are pushed to a local fake Telegram server at a
+steady rate. It delivers them through getUpdates or POSTs them to the webhook,
+and the time from each push to the matching reply is measured. Every command
+gets exactly one reply, so the n-th reply of a chat answers its n-th command.
+
+Run from the repository root:
+    python -m benchmarks.webhook_latency [--chats 100] [--rounds 8] [--rate 50]
+"""
+import argparse
+import threading
+import time
+from collections import defaultdict
+from telegram.ext import Updater
+
+import bot
+from benchmarks.fake_telegram import FakeTelegram
+from utils.webhook import WebhookServer, dispatcher_callback, set_webhook
+
+TOKEN = '123456:fake'
+SECRET = 'benchmark-secret'
+COMMANDS = ['/add item {}', '/add item {}', '/queue', '/next']
+
+
+def make_stream(fake, chats, rounds):
+    """Return the updates to push, round by round across chats: an /unfreeze by
+    the admin then a cycle of /add, /add, /queue and /next"""
+    stream = [fake.make_update(-(1 + chat), '/unfreeze', user_id=1) for chat in range(chats)]
+    for i in range(rounds):
+        command = COMMANDS[i % len(COMMANDS)]
+        for chat in range(chats):
+            user_id = 1 if command == '/next' else 2 + i
+            stream.append(fake.make_update(-(1 + chat), command.format(i), user_id=user_id))
+    return stream
+
+
+def push_paced(fake, stream, rate):
+    start = time.monotonic()
+    for i, update in enumerate(stream):
+        delay = start + i / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        fake.push_update(update)
+
+
+def latencies(fake):
+    """Return command -> list of latencies, matching pushes and replies of each chat in order"""
+    pushed, sent = defaultdict(list), defaultdict(list)
+    for stamp, chat_id, text in fake.pushed:
+        pushed[chat_id].append((stamp, text.split()[0]))
+    for stamp, chat_id, text in fake.sent:
+        sent[chat_id].append(stamp)
+    result = defaultdict(list)
+    for chat_id, commands in pushed.items():
+        for (pushed_at, command), sent_at in zip(commands, sent[chat_id]):
+            result[command].append(sent_at - pushed_at)
+    return result
+
+
+def start_updater(fake, mode, workers, certfile, keyfile):
+    """Start the bot, return a function stopping it"""
+    updater = Updater(token=TOKEN, base_url=fake.base_url, workers=workers, use_context=True,
+                      request_kwargs={'con_pool_size': workers + 4})
+    bot.add_handlers(updater.dispatcher)
+    if mode == 'polling':
+        updater.start_polling(poll_interval=0, timeout=1)
+        return updater.stop
+    dispatcher = updater.dispatcher
+    server = WebhookServer(dispatcher_callback(dispatcher), port=0, url_path='/webhook', secret_token=SECRET,
+                           certfile=certfile, keyfile=keyfile).start()
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    host, port = server.address
+    scheme = 'https' if certfile else 'http'
+    set_webhook(updater.bot, '{}://{}:{}/webhook'.format(scheme, host, port), SECRET)
+
+    def stop():
+        server.stop()
+        dispatcher.stop()
+        thread.join()
+    return stop
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=8, help="commands per chat after /unfreeze")
+    parser.add_argument('--rate', type=float, default=50, help="updates pushed per second")
+    parser.add_argument('--latency', type=float, default=0.005, help="fake network latency in seconds")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    parser.add_argument('--certfile', help="serve the webhook over TLS with this certificate")
+    parser.add_argument('--keyfile')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    modes = ['polling', 'webhook'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        with FakeTelegram(latency=args.latency) as fake:
+            stream = make_stream(fake, args.chats, args.rounds)
+            stop = start_updater(fake, mode, args.workers, args.certfile, args.keyfile)
+            push_paced(fake, stream, args.rate)
+            done = fake.wait_for_messages(len(stream), args.timeout)
+            stop()
+            status = '' if done else ' (timed out)'
+            print("{}: {} replies{}".format(mode, len(fake.sent), status))
+            for command, values in sorted(latencies(fake).items()):
+                values.sort()
+                print("  {:<10} n={:<6} p50 {:7.1f} ms   p99 {:7.1f} ms".format(
+                    command, len(values), percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,49 @@
-from telegram.ext import Updater, CommandHandler, PicklePersistence
+from telegram import Update
 import logging
+import threading
+import time
 import botfunctions
+from utils.admins import ADMINS
+from utils.botrequest import BotRequest
+from utils.outbox import ThreadedOutbox
+from utils.scheduler import ThreadedScheduler, TimerStore
 
 PERSISTENCY = False
+# Persistence backend: 'journal' (incremental, utils/journal.py) or 'pickle'
+PERSISTENCE_BACKEND = 'journal'
+# Run the bot on the asyncio runtime (utils/aiobot.py) instead of the threaded Updater
+ASYNC_MODE = False
+# Queue replies per chat to stay within Telegram's rate limits (utils/outbox.py)
+OUTBOX = True
+# Run the commands on the Updater's WORKERS threads instead of one at a time. Commands of the same chat still
+# never overlap (utils/locks.py)
+RUN_ASYNC = False
+WORKERS = 4
+# Receive updates through a webhook (utils/webhook.py) instead of polling. WEBHOOK_URL is registered
+# with Telegram and must reach WEBHOOK_LISTEN:WEBHOOK_PORT. Requests without WEBHOOK_SECRET are refused.
+# TLS is enabled when WEBHOOK_CERT and WEBHOOK_KEY are set, leave them unset behind a TLS proxy
+WEBHOOK = False
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_URL = None
+WEBHOOK_SECRET = None
+WEBHOOK_CERT = None
+WEBHOOK_KEY = None
+# Record latencies, counters and queue sizes (utils/metrics.py), exported for Prometheus on
+# http://METRICS_LISTEN:METRICS_PORT/metrics and summarized by /stats. With SHARDS, each shard serves its own
+# metrics on METRICS_PORT + its index, and /stats shows the ones of the shard of the chat
+METRICS_ENABLED = False
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9100
+# Number of worker processes chats are sharded across (utils/sharding.py). 0 runs a single process.
+# Sharding always uses the webhook
+SHARDS = 0
+# Fire the timers of /timer, /ttl and /schedule_unfreeze (utils/scheduler.py). Pending timers are saved
+# with PERSISTENCY
+TIMERS = True
+# Record the incoming updates, anonymised, to this file (utils/recorder.py), to replay them with
+# benchmarks/replay.py. None disables recording. Updates are not recorded with SHARDS
+RECORD_UPDATES = None
 
 
 def read_token(fname):
@@ -17,28 +58,203 @@ def read_token(fname):
             return key
 
 
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CHAT_MEMBER, Update.MY_CHAT_MEMBER]
+
+
+def add_handlers(dispatcher):
+    """Register a single handler routing the commands in
+    botfunctions.COMMANDS, and keep the admin lists up to date with chat
+    member updates"""
+    from telegram.ext import ChatMemberHandler
+    from utils.dispatch import CommandDispatcher
+    handler = CommandDispatcher(botfunctions.COMMANDS, run_async=RUN_ASYNC)
+    dispatcher.add_handler(handler)
+    dispatcher.add_handler(ChatMemberHandler(ADMINS.handle_update, ChatMemberHandler.ANY_CHAT_MEMBER))
+    return handler
+
+
+def make_persistence(suffix='', dispatcher=True):
+    """Return the persistence of the bot, None without PERSISTENCY. With
+    dispatcher False, as for the asyncio runtime, the journal is returned as a
+    JournalStore, which does not import telegram.ext"""
+    if PERSISTENCY is not True:
+        return None
+    if PERSISTENCE_BACKEND == 'journal':
+        from utils import journal
+        # Chats idle for a day, or the least recent ones past a million queued items, are evicted from memory,
+        # unless a command or a timer of the chat is running
+        persistence_class = journal.JournalPersistence if dispatcher else journal.JournalStore
+        return persistence_class(filename='persistence/journal{}.db'.format(suffix), idle_timeout=24 * 60 * 60,
+                                 max_resident_items=1000000, in_use=botfunctions.CHAT_LOCKS.is_locked)
+    from utils.persistence import ChatPicklePersistence
+    return ChatPicklePersistence(filename='persistence/data{}.pck'.format(suffix),
+                                 store_user_data=False, store_bot_data=False, store_chat_data=True)
+
+
+def make_shard_persistence(index, shards):
+    """Persistence of a shard. Shards store their chats in separate files,
+    named after the shard count: changing SHARDS starts from empty files"""
+    return make_persistence('-{}of{}'.format(index, shards))
+
+
+def make_timer_store(suffix=''):
+    if PERSISTENCY is not True:
+        return None
+    return TimerStore('persistence/timers{}.db'.format(suffix))
+
+
+def start_scheduler(dispatcher, suffix=''):
+    """Fire the timers of the chats of the dispatcher from a thread"""
+    if TIMERS is not True:
+        return None
+    fire = botfunctions.timer_callback(dispatcher.bot, dispatcher.chat_data, dispatcher.persistence)
+    BotRequest.scheduler = ThreadedScheduler(fire, make_timer_store(suffix)).start()
+    return BotRequest.scheduler
+
+
+def start_shard_scheduler(dispatcher, index, shards):
+    """Scheduler of a shard, with its timers stored next to its chats"""
+    return start_scheduler(dispatcher, '-{}of{}'.format(index, shards))
+
+
+def make_recorder():
+    if RECORD_UPDATES is None:
+        return None
+    from utils.recorder import UpdateRecorder
+    return UpdateRecorder(RECORD_UPDATES)
+
+
+def add_recorder(dispatcher, recorder):
+    """Record every update before the handlers see it"""
+    from telegram.ext import TypeHandler
+
+    def record(update, context):
+        recorder.record(update.to_dict(), context.bot.id, context.bot.username)
+    dispatcher.add_handler(TypeHandler(Update, record), group=-1)
+
+
+def setup_metrics(persistence, port=METRICS_PORT):
+    if METRICS_ENABLED is not True:
+        return
+    from utils.metrics import METRICS
+    METRICS.enable()
+    METRICS.register_collector('qbot_admins', ADMINS.stats)
+    METRICS.register_collector('qbot_outbox', lambda: BotRequest.outbox.stats() if BotRequest.outbox else {})
+    METRICS.register_collector('qbot_timers', lambda: BotRequest.scheduler.stats() if BotRequest.scheduler else {})
+    journal = getattr(persistence, 'journal', None)
+    if journal is not None:
+        METRICS.register_collector('qbot_chats', journal.chats.stats)
+    METRICS.start_http_server(port, METRICS_LISTEN)
+
+
+def setup_shard_metrics(persistence, index, shards):
+    """Metrics of a shard, served on the port following the ones of the
+    previous shards"""
+    setup_metrics(persistence, METRICS_PORT + index)
+
+
+def webhook_kwargs(token):
+    """Arguments of the WebhookServer. The token is used as the url path"""
+    return {'listen': WEBHOOK_LISTEN, 'port': WEBHOOK_PORT, 'url_path': '/' + token,
+            'secret_token': WEBHOOK_SECRET, 'certfile': WEBHOOK_CERT, 'keyfile': WEBHOOK_KEY}
+
+
+def register_webhook(bot, token):
+    from utils.webhook import set_webhook
+    set_webhook(bot, WEBHOOK_URL.rstrip('/') + '/' + token, WEBHOOK_SECRET, ALLOWED_UPDATES)
+
+
+def wait_for_interrupt(alive=lambda: True):
+    try:
+        while alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_webhook(updater, token):
+    """Run the dispatcher of the updater on the updates received by webhook"""
+    from utils.webhook import WebhookServer, dispatcher_callback
+    dispatcher = updater.dispatcher
+    server = WebhookServer(dispatcher_callback(dispatcher), **webhook_kwargs(token))
+    thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    thread.start()
+    server.start()
+    register_webhook(updater.bot, token)
+    wait_for_interrupt()
+    server.stop()
+    dispatcher.stop()
+    thread.join()
+    if dispatcher.persistence is not None:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()
+
+
+def run_threaded(token):
+    from telegram.ext import Updater
+    persistence = make_persistence()
+    if persistence is not None:
+        # Make the bot persistent
+        updater = Updater(token=token, workers=WORKERS, use_context=True, persistence=persistence)
+    else:
+        updater = Updater(token=token, workers=WORKERS, use_context=True)
+    add_handlers(updater.dispatcher)
+    recorder = make_recorder()
+    if recorder is not None:
+        add_recorder(updater.dispatcher, recorder)
+    setup_metrics(persistence)
+    if OUTBOX is True:
+        BotRequest.outbox = ThreadedOutbox(updater.bot.send_message, updater.bot.edit_message_text).start()
+    start_scheduler(updater.dispatcher)
+    if WEBHOOK is True:
+        run_webhook(updater, token)
+    else:
+        updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        updater.idle()
+    if BotRequest.scheduler is not None:
+        BotRequest.scheduler.stop()
+    if BotRequest.outbox is not None:
+        BotRequest.outbox.stop()
+    if recorder is not None:
+        recorder.close()
+
+
+def run_async(token):
+    from utils.aiobot import AsyncRuntime
+    persistence = make_persistence(dispatcher=False)
+    setup_metrics(persistence)
+    recorder = make_recorder()
+    AsyncRuntime(token, botfunctions.COMMANDS, persistence=persistence, outbox=OUTBOX,
+                 timers=botfunctions.timer_callback if TIMERS is True else None,
+                 timer_store=make_timer_store(), recorder=recorder).run()
+    if recorder is not None:
+        recorder.close()
+
+
+def run_sharded(token):
+    from telegram import Bot
+    from utils.sharding import ShardedBot
+    sharded = ShardedBot(token, SHARDS, add_handlers, persistence_factory=make_shard_persistence, outbox=OUTBOX,
+                         scheduler_factory=start_shard_scheduler, metrics_factory=setup_shard_metrics,
+                         **webhook_kwargs(token))
+    sharded.start()
+    register_webhook(Bot(token), token)
+    wait_for_interrupt(lambda: all(worker.is_alive() for worker in sharded.workers))
+    sharded.stop()
+
+
 if __name__ == "__main__":
     # Setup updater
     token = read_token('.token')
     if token is None:
         print("Bot token was not found in file '{}'".format('.token'))
         exit(-1)
-    if PERSISTENCY is True:
-        # Make the bot persistent
-        persistence = PicklePersistence(filename='persistence/data.pck',
-                                        store_user_data=False, store_bot_data=False, store_chat_data=True)
-        updater = Updater(token=token, use_context=True, persistence=persistence)
-    else:
-        updater = Updater(token=token, use_context=True)
-    dispatcher = updater.dispatcher
-    # Command handlers
-    handlers = {}
-    for command, func in botfunctions.COMMANDS.items():
-        handler = CommandHandler(command, func)
-        dispatcher.add_handler(handler)
-        handlers[command] = handler
     # Logger
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-    updater.start_polling()
-    updater.idle()
+    if SHARDS > 0:
+        run_sharded(token)
+    elif ASYNC_MODE is True:
+        run_async(token)
+    else:
+        run_threaded(token)
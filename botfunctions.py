@@ -1,22 +1,49 @@
 import telegram
 import random
 import math
+import itertools
+import time
 from functools import wraps
-from utils import queue, messages, botrequest
+from utils import queue, messages
 from utils.botrequest import BotRequest
+from utils.locks import ChatLocks
+from utils.metrics import METRICS
 
 COMMANDS = {}
+# Commands of a chat run one at a time, even on parallel workers
+CHAT_LOCKS = ChatLocks()
 
 
 def command(cmd_dict=None, cmd_name=''):
     """Decorate a function with the standard signature as in
-    f(update, context), then call it as a command"""
+    f(update, context), then call it as a command. The permissions of a
+    'protected' function are checked in a row before calling it, without
+    going through the wrappers. Commands of the same chat never run
+    concurrently"""
     def make_callable(func):
+        permissions = getattr(func, 'permissions', ())
+        func = getattr(func, 'unprotected', func)
+
         @wraps(func)
         def func_callable(update, context):
-            bf = BotFunction(update, context)
-            bfargs = bf.context.args
-            return func(bf, *bfargs)
+            bf = BotFunction(update, context, cmd_name)
+            chat_id = update.effective_chat.id
+            with CHAT_LOCKS.lock(chat_id):
+                if not METRICS.enabled:
+                    if permissions and not check_permissions(bf, permissions):
+                        return
+                    return func(bf, *context.args)
+                try:
+                    with METRICS.timer('qbot_command_seconds', command=cmd_name):
+                        if permissions and not check_permissions(bf, permissions):
+                            return
+                        return func(bf, *context.args)
+                except Exception:
+                    METRICS.inc('qbot_command_errors_total', command=cmd_name)
+                    raise
+                finally:
+                    chat_queue = context.chat_data.get('queue')
+                    METRICS.set_gauge('qbot_queue_size', len(chat_queue) if chat_queue else None, chat=chat_id)
 
         # Add function to dict
         if cmd_dict is not None:
@@ -36,37 +63,80 @@ def protected(permission, senderror=True):
 
         senderror: if True, a default error message is sent. Otherwise
             'permission' can send its own message
+
+    The checks of stacked decorators are collected in the 'permissions'
+    attribute of the result, outermost first, and the undecorated function in
+    'unprotected'.
     """
     def protected_function(func):
-        @wraps(func)
-        def check_permissions(com, *args, **kwargs):
-            if permission(com):
-                func(com, *args, *kwargs)
-            else:
-                if senderror:
-                    user = com.update.message.from_user.username
-                    command = com.update.message.text
-                    com.send(messages.PERMISSION_NOT_GRANTED, user=user, command=command)
-        return check_permissions
+        permissions = ((permission, senderror),) + getattr(func, 'permissions', ())
+        unprotected = getattr(func, 'unprotected', func)
+
+        @wraps(unprotected)
+        def protected_callable(com, *args, **kwargs):
+            if check_permissions(com, permissions):
+                return unprotected(com, *args, **kwargs)
+        protected_callable.permissions = permissions
+        protected_callable.unprotected = unprotected
+        return protected_callable
     return protected_function
 
 
+def check_permissions(com, permissions):
+    """Evaluate (permission, senderror) pairs in order, as collected by
+    'protected'. Return True if all of them are granted"""
+    with METRICS.timer('qbot_permission_seconds', command=com.command_name):
+        for permission, senderror in permissions:
+            if not permission(com):
+                break
+        else:
+            return True
+    if senderror:
+        user = com.update.message.from_user.username
+        command = com.update.message.text
+        com.send(messages.PERMISSION_NOT_GRANTED, user=user, command=command)
+    return False
+
+
+def format_duration(seconds):
+    """Return a short human readable duration, as '2h 5m', to the minute"""
+    minutes = max(0, int(seconds)) // 60
+    if minutes == 0:
+        return '<1m'
+    if minutes < 60:
+        return '{}m'.format(minutes)
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return '{}h {}m'.format(hours, minutes)
+    days, hours = divmod(hours, 24)
+    return '{}d {}h'.format(days, hours)
+
+
+def parse_minutes(text):
+    """Return a number of minutes between 1 and a week, None if text is not one"""
+    if not text.isnumeric() or not 0 < int(text) <= 7 * 24 * 60:
+        return None
+    return int(text)
+
+
+def next_time_of_day(text, now):
+    """Return the timestamp of the first 'HH:MM', in UTC, after 'now'. None if
+    text is not a time of day"""
+    hours, _, minutes = text.partition(':')
+    if not (hours.isnumeric() and minutes.isnumeric()) or int(hours) > 23 or int(minutes) > 59:
+        return None
+    due = now - now % (24 * 60 * 60) + int(hours) * 60 * 60 + int(minutes) * 60
+    return due if due > now else due + 24 * 60 * 60
+
+
 class BotFunction(BotRequest):
     """Class with all bot commands"""
-    MAX_QUEUE_LINES = 25
+    __slots__ = ()
+    QUEUE_PAGE_SIZE = 100
     MAX_ITEM_LENGTH = 30
-
-    def __init__(self, update, context):
-        botrequest.BotRequest.__init__(self, update, context)
-        chat_data = self.context.chat_data
-        # A BotFunction object is created on every user request. chat_data is retained and common for every object
-        # relative to the same chat. No overriding must occur, otherwise data will be lost
-        if 'queue' not in chat_data:
-            self.context.chat_data['queue'] = queue.Queue()
-        if 'is_frozen' not in chat_data:
-            self.context.chat_data['is_frozen'] = True
-        if 'is_protected' not in chat_data:
-            self.context.chat_data['is_protected'] = True
+    MAX_QUEUE_NAME_LENGTH = 20
+    # Named queues are stored in chat_data next to the main one, under their name with this prefix
+    NAMED_QUEUE_PREFIX = 'queue:'
 
     def formatted_user(self):
         """Return user's full name and username in a human readable format"""
@@ -76,21 +146,74 @@ class BotFunction(BotRequest):
         else:
             return "{utag} ({uname})".format(uname=user.full_name, utag=user.username)
 
+    # A BotFunction object, holding no state of its own, is created on every user request. chat_data is retained
+    # and common for every object relative to the same chat. Its entries are only created when first written, so
+    # that chats that never used a queue cost nothing to keep and persist
     @property
     def queue(self):
-        return self.context.chat_data['queue']
+        chat_queue = self.context.chat_data.get('queue')
+        if chat_queue is None:
+            chat_queue = self.context.chat_data['queue'] = queue.Queue()
+        return chat_queue
 
     def has_queue(self):
         """Return True if the chat has a queue"""
-        return len(self.queue) > 0
+        return len(self.context.chat_data.get('queue', ())) > 0
+
+    def named_queue(self, name, create=False):
+        """Return the queue 'name' of the chat, the main one if name is None.
+        If the queue does not exist, it is created if 'create' is True, None
+        is returned otherwise"""
+        if name is None:
+            return self.queue if create else self.context.chat_data.get('queue')
+        key = self.NAMED_QUEUE_PREFIX + name
+        chat_queue = self.context.chat_data.get(key)
+        if chat_queue is None and create:
+            chat_queue = self.context.chat_data[key] = queue.Queue()
+        return chat_queue
+
+    def named_queues(self):
+        """Return the (name, queue) pairs of the named queues of the chat,
+        sorted by name"""
+        prefix = self.NAMED_QUEUE_PREFIX
+        return sorted((key[len(prefix):], value) for key, value in self.context.chat_data.items()
+                      if key.startswith(prefix))
+
+    def split_queue_name(self, args, bare=False):
+        """Split the queue a command is about off its arguments. The queue is
+        given as '@name' or, if 'bare', as the name of an existing queue.
+        Names start with a letter, so that they are never taken for a page or
+        a count.
+        Return:
+            (name, args) with the remaining arguments. name is None for the
+            main queue. args is None if the name is not valid, in which case
+            an error was sent
+        """
+        if not args:
+            return None, args
+        name = args[0].lower()
+        if name.startswith('@'):
+            name = name[1:]
+        elif not bare or not name[:1].isalpha() or self.named_queue(name) is None:
+            return None, args
+        if not name or len(name) > self.MAX_QUEUE_NAME_LENGTH or not name.replace('_', '').isalnum() \
+                or not name.isascii() or not name[0].isalpha():
+            self.send(messages.QUEUE_NAME_NOT_VALID, name=args[0], max_len=self.MAX_QUEUE_NAME_LENGTH)
+            return None, None
+        return name, args[1:]
 
     def clear_queue(self):
         """Clear queue"""
-        self.queue.clear()
+        with self.queue_op():
+            self.queue.clear()
+
+    def queue_op(self):
+        """Return a context manager timing a queue operation"""
+        return METRICS.timer('qbot_queue_op_seconds', command=self.command_name)
 
     @property
     def is_frozen(self):
-        return self.context.chat_data['is_frozen']
+        return self.context.chat_data.get('is_frozen', True)
 
     @is_frozen.setter
     def is_frozen(self, frozen):
@@ -98,7 +221,7 @@ class BotFunction(BotRequest):
 
     @property
     def is_protected(self):
-        return self.context.chat_data['is_protected']
+        return self.context.chat_data.get('is_protected', True)
 
     @is_protected.setter
     def is_protected(self, protected):
@@ -145,31 +268,174 @@ class BotFunction(BotRequest):
 
     @command(COMMANDS, 'queue')
     def print_queue(self, *args):
-        if self.has_queue():
-            text = self.queue.format()
-            # Check if test is too long
-            if 1 + len(self.queue) > self.MAX_QUEUE_LINES:
-                # Split the message into multiple submessages
-                sections = text.split('\n')
-                sub_msg_len = math.ceil(
-                    (len(self.queue) + 1) / self.MAX_QUEUE_LINES
-                )
-                for i in range(sub_msg_len):
-                    # Send each submessage on its own
-                    start = i*self.MAX_QUEUE_LINES
-                    end = min(len(sections), (i + 1)*self.MAX_QUEUE_LINES)
-                    message = '\n  '.join(sections[start:end])
-                    self.send(message)
-            else:
-                self.send(text)
+        """Show a page of the queue, or of the named queue given as first
+        argument. Only the requested page is rendered"""
+        name = None
+        if args and not args[0].isnumeric():
+            name, args = self.split_queue_name(('@' + args[0].lstrip('@'),) + args[1:])
+            if args is None:
+                return
+        chat_queue = self.named_queue(name)
+        if not chat_queue:
+            self.send(messages.QUEUE_EMPTY if name is None else messages.NAMED_QUEUE_EMPTY, queue=name)
+            return
+        if len(args) > 1:
+            self.send(messages.QUEUE_TOO_MANY_ARGUMENTS)
+            return
+        pages = math.ceil(len(chat_queue) / self.QUEUE_PAGE_SIZE)
+        if len(args) == 0:
+            page = 1
+        elif not args[0].isnumeric():
+            self.send(messages.QUEUE_PAGE_NOT_RECOGNIZED, page=args[0])
+            return
         else:
-            self.send(messages.QUEUE_EMPTY)
+            page = int(args[0])
+            if page <= 0 or page > pages:
+                self.send(messages.QUEUE_PAGE_NOT_IN_RANGE, page=page, pages=pages)
+                return
+
+        lines = self.page_lines(page, chat_queue)
+        if name is not None:
+            header = [messages.NAMED_QUEUE_PAGE_HEADER.format(queue=name, page=page, pages=pages)
+                      if pages > 1 else messages.NAMED_QUEUE_HEADER.format(queue=name)]
+            footer = [messages.NAMED_QUEUE_PAGE_FOOTER.format(queue=name, next=page + 1)] if page < pages else []
+        elif pages == 1:
+            header = [messages.QUEUE_HEADER]
+            footer = []
+        else:
+            header = [messages.QUEUE_PAGE_HEADER.format(page=page, pages=pages)]
+            footer = [messages.QUEUE_PAGE_FOOTER.format(next=page + 1)] if page < pages else []
+        if chat_queue.fair:
+            header.append(messages.QUEUE_FAIR_NOTE)
+        self.send_lines(itertools.chain(header, lines, footer))
+
+    def page_lines(self, page, chat_queue=None):
+        """Return the lines of a page of a queue, the main one by default,
+        starting from 1"""
+        # Pages are rendered once and cached by the queue. Wait times are refreshed every minute
+        now = time.time()
+        chat_queue = self.queue if chat_queue is None else chat_queue
+        with self.queue_op():
+            return chat_queue.page_lines(
+                page - 1, self.QUEUE_PAGE_SIZE, stamp=int(now // 60),
+                timestamp=lambda added: messages.QUEUE_ITEM_WAIT.format(wait=format_duration(now - added)),
+                note=lambda note: messages.QUEUE_ITEM_NOTE.format(note=note))
+
+    def live_text(self):
+        """Return the text of the live queue message: the first page, cut to
+        fit in a single message"""
+        if not self.has_queue():
+            return messages.LIVE_EMPTY
+        size = len(self.queue)
+        lines = [messages.LIVE_HEADER.format(count=size)]
+        # Keep room for the last line, with its count
+        room = self.MAX_MESSAGE_LENGTH - len(lines[0]) - len(messages.LIVE_MORE) - 20
+        for line in self.page_lines(1):
+            room -= len(line) + 1
+            if room < 0:
+                break
+            lines.append(line)
+        shown = len(lines) - 1
+        if shown < size:
+            lines.append(messages.LIVE_MORE.format(count=size - shown))
+        return '\n'.join(lines)
+
+    def refresh_live(self):
+        """Update the live queue message of the chat, if there is one. Edits
+        are debounced by the outbox"""
+        message_id = self.context.chat_data.get('live_message_id')
+        if message_id is not None:
+            self.edit(message_id, self.live_text())
+
+    def start_live(self, message_id):
+        self.context.chat_data['live_message_id'] = message_id
+        self.pin(message_id)
+
+    # Timers
+    def set_timer(self, kind, due):
+        """Set the timer 'kind' of the chat to fire at 'due', or cancel it if
+        due is None"""
+        chat_id = self.update.effective_chat.id
+        if due is None:
+            self.scheduler.cancel(chat_id, kind)
+        else:
+            self.scheduler.schedule(chat_id, kind, due)
+
+    def forget(self, key):
+        """Remove a setting from chat_data"""
+        if key in self.context.chat_data:
+            del self.context.chat_data[key]
+
+    def check_timers_available(self):
+        """Checker function for the commands setting timers"""
+        if self.scheduler is not None:
+            return True
+        self.send(messages.TIMERS_DISABLED)
+        return False
+
+    def restart_turn(self):
+        """Give the whole turn length to the item just called, if turns are timed"""
+        minutes = self.context.chat_data.get('turn_minutes')
+        if minutes is not None and self.scheduler is not None:
+            self.set_timer('next', time.time() + minutes * 60)
+
+    def schedule_expiry(self):
+        """Set the expiry timer to the time the oldest item expires"""
+        minutes = self.context.chat_data.get('entry_ttl')
+        oldest = None
+        if minutes is not None and self.has_queue():
+            oldest = min((entry.timestamp for entry in self.queue.entries() if entry.timestamp is not None),
+                         default=None)
+        self.set_timer('expire', None if oldest is None else oldest + minutes * 60)
+
+    def expire_added(self):
+        """Make sure the items just added expire, if items do. A pending
+        expiry timer is kept: it fires before the new items expire"""
+        minutes = self.context.chat_data.get('entry_ttl')
+        if minutes is not None and self.scheduler is not None \
+                and self.scheduler.due(self.update.effective_chat.id, 'expire') is None:
+            self.set_timer('expire', time.time() + minutes * 60)
+
+    def timed_next(self):
+        """Call the next item when a turn is over"""
+        minutes = self.context.chat_data.get('turn_minutes')
+        if minutes is None:
+            return
+        if self.has_queue():
+            with self.queue_op():
+                item = self.queue.pop().item
+            self.send(messages.TIMER_NEXT, item=item)
+            self.refresh_live()
+        self.set_timer('next', time.time() + minutes * 60)
+
+    def timed_unfreeze(self):
+        self.is_frozen = False
+        self.send(messages.SCHEDULED_UNFREEZE)
+
+    def timed_expire(self):
+        """Remove the items that waited longer than the chat's time to live"""
+        minutes = self.context.chat_data.get('entry_ttl')
+        if minutes is None:
+            return
+        if self.has_queue():
+            limit = time.time() - minutes * 60
+            expired = [index for index, entry in enumerate(self.queue.entries())
+                       if entry.timestamp is not None and entry.timestamp <= limit]
+            if expired:
+                with self.queue_op():
+                    removed = self.queue.remove_many(expired)
+                self.send(messages.TTL_EXPIRED, items=self.summarize_items([entry.item for entry in removed]))
+                self.refresh_live()
+        self.schedule_expiry()
 
     @command(COMMANDS, 'add')
     @protected(check_not_frozen, senderror=False)
     def add(self, *args):
-        """Append an item in queue. This can be done only if the queue is not
-        frozen."""
+        """Append an item in queue, or in the named queue given as '@name'
+        before the item. This can be done only if the queue is not frozen."""
+        name, args = self.split_queue_name(args)
+        if args is None:
+            return
         if len(args) == 0:
             # No arguments: push user name into the list
             item = self.update.message.from_user.full_name
@@ -185,73 +451,227 @@ class BotFunction(BotRequest):
                 self.send(messages.ITEM_TOO_LONG, item=item, max_len=self.MAX_ITEM_LENGTH)
                 return
 
+        if name is not None:
+            self.add_to_named_queue(name, item)
+            return
         if item in self.queue:
             self.send(messages.ITEM_ALREADY_IN_QUEUE, item=item, index=self.queue.index(item) + 1)
             return
 
-        self.queue.append(item)
+        with self.queue_op():
+            self.queue.append(item, user_id=self.update.message.from_user.id, timestamp=time.time())
         if self.chat_type == telegram.Chat.PRIVATE:
-            self.send(messages.ADD_SUCCESS_PRIVATE, item=item, index=len(self.queue))
+            self.send(messages.ADD_SUCCESS_PRIVATE, item=item, index=self.added_position(self.queue, item))
+        else:
+            self.send(messages.ADD_SUCCESS_GROUP, user=self.formatted_user(), item=item,
+                      index=self.added_position(self.queue, item))
+        self.expire_added()
+        self.refresh_live()
+
+    def add_to_named_queue(self, name, item):
+        """Append an item to a named queue, creating the queue if needed"""
+        chat_queue = self.named_queue(name, create=True)
+        if item in chat_queue:
+            self.send(messages.NAMED_ITEM_ALREADY_IN_QUEUE, item=item, queue=name, index=chat_queue.index(item) + 1)
+            return
+        with self.queue_op():
+            chat_queue.append(item, user_id=self.update.message.from_user.id, timestamp=time.time())
+        self.send(messages.NAMED_ADD_SUCCESS, user=self.formatted_user(), item=item, queue=name,
+                  index=self.added_position(chat_queue, item))
+
+    @staticmethod
+    def added_position(chat_queue, item):
+        """Return the position, from 1, of an item just added to a queue: the
+        last one, but in fair-share order"""
+        return chat_queue.index(item) + 1 if chat_queue.fair else len(chat_queue)
+
+    @command(COMMANDS, 'addmany')
+    @protected(check_not_frozen, senderror=False)
+    def addmany(self, *args):
+        """Append one item per line of the message, in a single pass. Items
+        already in queue or too long are skipped"""
+        text = self.update.message.text.split(None, 1)
+        lines = text[1].splitlines() if len(text) > 1 else []
+        items = []
+        seen = set()
+        skipped = 0
+        for line in lines:
+            item = ' '.join(line.split())
+            if not item:
+                continue
+            if len(item) > self.MAX_ITEM_LENGTH or item in seen or item in self.queue:
+                skipped += 1
+                continue
+            seen.add(item)
+            items.append(item)
+        if not items and not skipped:
+            self.send(messages.ADDMANY_NO_ITEMS)
+            return
+
+        with self.queue_op():
+            self.queue.extend(items, user_id=self.update.message.from_user.id, timestamp=time.time())
+        if items:
+            # The items share their user and time, so they are next to each other even in fair-share order
+            last = self.added_position(self.queue, items[-1])
+            self.send(messages.ADDMANY_SUCCESS, user=self.formatted_user(), count=len(items),
+                      first=last - len(items) + 1, last=last, skipped=self.summarize_skipped(skipped))
+            self.expire_added()
+            self.refresh_live()
         else:
-            self.send(messages.ADD_SUCCESS_GROUP, user=self.formatted_user(), item=item, index=len(self.queue))
+            self.send(messages.ADDMANY_NOTHING_ADDED, skipped=self.summarize_skipped(skipped))
+
+    @staticmethod
+    def summarize_skipped(skipped):
+        return messages.ADDMANY_SKIPPED.format(skipped=skipped) if skipped else ''
+
+    @staticmethod
+    def summarize_items(items, limit=10):
+        """Return a comma separated list of at most 'limit' items"""
+        summary = ', '.join(str(item) for item in items[:limit])
+        if len(items) > limit:
+            summary += messages.ITEMS_AND_MORE.format(count=len(items) - limit)
+        return summary
 
     @command(COMMANDS, 'next')
     @protected(check_not_protected, senderror=False)
     def next(self, *args):
-        """Pick next turn"""
-        if not self.has_queue():
-            self.send(messages.QUEUE_EMPTY)
+        """Pick next turn, from the main queue or from the named queue given
+        as first argument. If the next argument is a number, that many items
+        are picked at once"""
+        name, args = self.split_queue_name(args, bare=True)
+        if args is None:
+            return
+        chat_queue = self.named_queue(name)
+        if not chat_queue:
+            self.send(messages.QUEUE_EMPTY if name is None else messages.NAMED_QUEUE_EMPTY, queue=name)
             return
 
-        # Extract item from queue
-        item, _ = self.queue.pop()
+        count = 1
+        if args and args[0].isnumeric():
+            count = int(args[0])
+            args = args[1:]
+            if count == 0:
+                self.send(messages.NEXT_COUNT_NOT_VALID)
+                return
+
+        # Extract items from queue
+        with self.queue_op():
+            if count == 1:
+                items = [chat_queue.pop().item]
+            else:
+                items = [entry.item for entry in chat_queue.pop_many(count)]
 
         # Generate reply
         if len(args) == 0:
             # Default reply
             attached_message = ''
-            reply = random.choice(messages.NEXT_DEFAULT_MESSAGES)
+            reply = random.choice(messages.NEXT_DEFAULT_MESSAGES) if len(items) == 1 else messages.NEXT_MANY_DEFAULT
         else:
             # Custom reply
             attached_message = ' '.join(args)
             reply = messages.NEXT_CUSTOM_REPLY
-        self.send(reply, item=item, attached_message=attached_message)
+        self.send(reply, item=', '.join(items), attached_message=attached_message)
+        if name is None:
+            self.restart_turn()
+            self.refresh_live()
+
+    @command(COMMANDS, 'queues')
+    def list_queues(self, *args):
+        """List the named queues of the chat with their length"""
+        named_queues = self.named_queues()
+        if not named_queues:
+            self.send(messages.QUEUES_NONE)
+            return
+        lines = [messages.QUEUES_HEADER, messages.QUEUES_MAIN.format(count=len(self.named_queue(None) or ()))]
+        lines.extend(messages.QUEUES_LINE.format(queue=name, count=len(chat_queue))
+                     for name, chat_queue in named_queues)
+        self.send_lines(lines)
+
+    @command(COMMANDS, 'whereami')
+    def whereami(self, *args):
+        """Show the position of the items added by the user in every queue of
+        the chat. Positions come from the index of the items of each user kept
+        by the queues, no queue is walked"""
+        user_id = self.update.message.from_user.id
+        lines = []
+        for name, chat_queue in [(None, self.context.chat_data.get('queue'))] + self.named_queues():
+            if chat_queue is None:
+                continue
+            for index in chat_queue.positions_of(user_id):
+                where = messages.WHEREAMI_MAIN if name is None else messages.WHEREAMI_NAMED.format(queue=name)
+                lines.append(messages.WHEREAMI_LINE.format(item=chat_queue.entry(index).item, index=index + 1,
+                                                           queue=where))
+        if not lines:
+            self.send(messages.WHEREAMI_NOTHING, user=self.formatted_user())
+            return
+        self.send_lines([messages.WHEREAMI_HEADER.format(user=self.formatted_user())] + lines)
 
     @command(COMMANDS, 'clear')
     @protected(check_not_protected, senderror=False)
     def clear(self, *args):
+        """Clear the queue. A named queue, given as argument, is deleted"""
+        name, args = self.split_queue_name(args, bare=True)
+        if args is None:
+            return
+        if name is not None:
+            if self.named_queue(name) is None:
+                self.send(messages.NAMED_QUEUE_EMPTY, queue=name)
+                return
+            del self.context.chat_data[self.NAMED_QUEUE_PREFIX + name]
+            self.send(messages.NAMED_QUEUE_DELETED, queue=name)
+            return
         self.clear_queue()
         self.send(messages.CLEAR_SUCCESS)
+        self.refresh_live()
+
+    def parse_rows(self, args):
+        """Parse row numbers and ranges such as '3-17,20' into a set of
+        zero-based indexes. Return None and send an error if a row is not
+        valid"""
+        indexes = set()
+        for part in ','.join(args).split(','):
+            if not part:
+                continue
+            bounds = part.split('-')
+            if len(bounds) > 2 or not all(bound.isnumeric() for bound in bounds):
+                self.send(messages.RM_INDEX_NOT_RECOGNIZED, index=part)
+                return None
+            low, high = min(map(int, bounds)), max(map(int, bounds))
+            for index in (low, high):
+                if index <= 0 or index > len(self.queue):
+                    self.send(messages.RM_INDEX_NOT_IN_QUEUE, index=index)
+                    return None
+            indexes.update(range(low - 1, high))
+        return indexes
 
     @command(COMMANDS, 'rm')
     @protected(check_not_protected, senderror=False)
     def rm(self, *args):
-        """Remove item at provided element in list"""
+        """Remove the items at the provided rows, or ranges of rows, in list"""
         if not self.has_queue():
             self.send(messages.QUEUE_EMPTY)
             return
-        # Check (only the) index was provided
+        # Check an index was provided
         if len(args) < 1:
             self.send(messages.RM_INDEX_NOT_PROVIDED)
             return
-        elif len(args) > 1:
-            self.send(messages.RM_TOO_MANY_ARGUMENTS)
-            return
 
-        # Check if index is a number
-        index = args[0]
-        if not index.isnumeric():
-            self.send(messages.RM_INDEX_NOT_RECOGNIZED, index=index)
+        indexes = self.parse_rows(args)
+        if indexes is None:
             return
-        index = int(index)
-        # Check if index is in range
-        if index <= 0 or index > len(self.queue):
-            self.send(messages.RM_INDEX_NOT_IN_QUEUE, index=index)
+        if not indexes:
+            self.send(messages.RM_INDEX_NOT_PROVIDED)
             return
 
-        # Remove item and announce it
-        item, _ = self.queue.remove(index - 1)
-        self.send(messages.RM_SUCCESS, item=item)
+        # Remove items and announce them
+        with self.queue_op():
+            removed = self.queue.remove_many(indexes) if len(indexes) > 1 else [self.queue.remove(indexes.pop())]
+        if len(removed) == 1:
+            self.send(messages.RM_SUCCESS, item=removed[0].item)
+        else:
+            items = [entry.item for entry in removed]
+            self.send(messages.RM_MANY_SUCCESS, count=len(items), items=self.summarize_items(items))
+        self.refresh_live()
 
     @command(COMMANDS, 'insert')
     @protected(check_not_protected, senderror=False)
@@ -277,6 +697,9 @@ class BotFunction(BotRequest):
         if item in self.queue:
             self.send(messages.ITEM_ALREADY_IN_QUEUE, item=item, index=self.queue.index(item) + 1)
             return
+        if self.queue.fair:
+            self.send(messages.INSERT_QUEUE_FAIR, item=item)
+            return
 
         # Check index
         if not index.isnumeric():
@@ -288,11 +711,14 @@ class BotFunction(BotRequest):
             return
 
         # Insert item
-        self.queue.insert(index - 1, item)
+        with self.queue_op():
+            self.queue.insert(index - 1, item, user_id=self.update.message.from_user.id, timestamp=time.time())
         if self.chat_type == telegram.Chat.PRIVATE:
             self.send(messages.INSERT_SUCCESS_PRIVATE, item=item, index=index)
         else:
             self.send(messages.INSERT_SUCCESS_GROUP, user=self.formatted_user(), item=item, index=index)
+        self.expire_added()
+        self.refresh_live()
 
     @command(COMMANDS, 'freeze')
     @protected(BotRequest.is_request_by_admin)
@@ -318,4 +744,155 @@ class BotFunction(BotRequest):
     @protected(BotRequest.is_request_by_admin)
     def disable_protection(self, *args):
         self.is_protected = False
-        self.send(messages.PROTECTION_DISABLED)
\ No newline at end of file
+        self.send(messages.PROTECTION_DISABLED)
+
+    @command(COMMANDS, 'fair')
+    @protected(BotRequest.is_request_by_admin)
+    def fair(self, *args):
+        """Switch fair-share order on or off for the queue, or the named
+        queue given as first argument: items of the users who had fewer turns
+        are called first. Can only be requested by admins"""
+        name, args = self.split_queue_name(args, bare=True)
+        if args is None:
+            return
+        if len(args) != 1 or args[0].lower() not in ('on', 'off'):
+            self.send(messages.FAIR_NOT_VALID)
+            return
+        enabled = args[0].lower() == 'on'
+        with self.queue_op():
+            self.named_queue(name, create=True).set_fair(enabled)
+        if name is None:
+            self.send(messages.FAIR_ON if enabled else messages.FAIR_OFF)
+            self.refresh_live()
+        else:
+            self.send(messages.NAMED_FAIR_ON if enabled else messages.NAMED_FAIR_OFF, queue=name)
+
+    @command(COMMANDS, 'timer')
+    @protected(BotRequest.is_request_by_admin)
+    @protected(check_timers_available, senderror=False)
+    def timer(self, *args):
+        """Time the turns: the next item is called 'minutes' minutes after the
+        previous one, unless /next is sent first. '/timer off' stops it. Can
+        only be requested by admins"""
+        if len(args) != 1:
+            self.send(messages.TIMER_NOT_VALID)
+            return
+        if args[0].lower() == 'off':
+            self.forget('turn_minutes')
+            self.set_timer('next', None)
+            self.send(messages.TIMER_OFF)
+            return
+        minutes = parse_minutes(args[0])
+        if minutes is None:
+            self.send(messages.TIMER_NOT_VALID)
+            return
+        self.context.chat_data['turn_minutes'] = minutes
+        self.set_timer('next', time.time() + minutes * 60)
+        self.send(messages.TIMER_SET, minutes=minutes)
+
+    @command(COMMANDS, 'ttl')
+    @protected(BotRequest.is_request_by_admin)
+    @protected(check_timers_available, senderror=False)
+    def ttl(self, *args):
+        """Remove the items that waited in the queue for more than 'minutes'
+        minutes. '/ttl off' stops it. Can only be requested by admins"""
+        if len(args) != 1:
+            self.send(messages.TTL_NOT_VALID)
+            return
+        if args[0].lower() == 'off':
+            self.forget('entry_ttl')
+            self.set_timer('expire', None)
+            self.send(messages.TTL_OFF)
+            return
+        minutes = parse_minutes(args[0])
+        if minutes is None:
+            self.send(messages.TTL_NOT_VALID)
+            return
+        self.context.chat_data['entry_ttl'] = minutes
+        self.schedule_expiry()
+        self.send(messages.TTL_SET, minutes=minutes)
+
+    @command(COMMANDS, 'schedule_unfreeze')
+    @protected(BotRequest.is_request_by_admin)
+    @protected(check_timers_available, senderror=False)
+    def schedule_unfreeze(self, *args):
+        """Unfreeze the queue at the given time of day, in UTC.
+        '/schedule_unfreeze off' cancels it. Can only be requested by admins"""
+        if len(args) != 1:
+            self.send(messages.SCHEDULE_UNFREEZE_NOT_VALID)
+            return
+        if args[0].lower() == 'off':
+            self.set_timer('unfreeze', None)
+            self.send(messages.SCHEDULE_UNFREEZE_OFF)
+            return
+        due = next_time_of_day(args[0], time.time())
+        if due is None:
+            self.send(messages.SCHEDULE_UNFREEZE_NOT_VALID)
+            return
+        self.set_timer('unfreeze', due)
+        self.send(messages.SCHEDULE_UNFREEZE_SET, time=time.strftime('%H:%M', time.gmtime(due)))
+
+    @command(COMMANDS, 'live')
+    @protected(BotRequest.is_request_by_admin)
+    def live(self, *args):
+        """Post a pinned message showing the queue, edited after every change
+        instead of sending the queue again. '/live off' stops it. Can only be
+        requested by admins"""
+        if len(args) > 1 or (args and args[0].lower() != 'off'):
+            self.send(messages.LIVE_USAGE)
+            return
+        # A chat has a single live message: the previous one is retired
+        message_id = self.context.chat_data.get('live_message_id')
+        if message_id is not None:
+            del self.context.chat_data['live_message_id']
+            self.pin(message_id, pinned=False)
+        if args:
+            self.send(messages.LIVE_STOPPED if message_id is not None else messages.LIVE_NOT_ACTIVE)
+            return
+        self.send_now(self.live_text(), on_sent=self.start_live)
+
+    @command(COMMANDS, 'stats')
+    @protected(BotRequest.is_request_by_admin)
+    def stats(self, *args):
+        """Summarize the bot metrics. Can only be requested by admins"""
+        if not METRICS.enabled:
+            self.send(messages.STATS_DISABLED)
+            return
+        errors = {dict(labels)['command']: value for (name, labels), value in METRICS.counters().items()
+                  if name == 'qbot_command_errors_total'}
+        lines = [messages.STATS_HEADER]
+        for (name, labels), histogram in sorted(METRICS.histograms().items()):
+            if name != 'qbot_command_seconds':
+                continue
+            command_name = dict(labels)['command']
+            lines.append(messages.STATS_COMMAND.format(
+                command=command_name, count=histogram.count, errors=errors.get(command_name, 0),
+                p50=histogram.quantile(0.5) * 1000, p99=histogram.quantile(0.99) * 1000))
+        lines.extend(messages.STATS_VALUE.format(name=name, value=value)
+                     for name, value in sorted(METRICS.collect().items()))
+        self.send_lines(lines)
+
+
+TIMERS = {
+    'next': BotFunction.timed_next,
+    'unfreeze': BotFunction.timed_unfreeze,
+    'expire': BotFunction.timed_expire,
+}
+
+
+def timer_callback(bot, chat_data, persistence=None):
+    """Return the function firing the timers of the chats, to be given to a
+    utils.scheduler runner.
+    Args:
+        bot: bot sending the messages
+        chat_data: chat_id -> chat_data mapping, as Dispatcher.chat_data
+        persistence: if given, chats are saved after their timers fire
+    """
+    def fire(chat_id, kind):
+        # chat_data is looked up with the lock held, so that the chat can't be evicted in between
+        with CHAT_LOCKS.lock(chat_id), METRICS.timer('qbot_timer_seconds', kind=kind):
+            request = BotFunction.for_chat(bot, chat_id, chat_data[chat_id], 'timer_' + kind)
+            TIMERS[kind](request)
+        if persistence is not None:
+            persistence.update_chat_data(chat_id, request.context.chat_data)
+    return fire
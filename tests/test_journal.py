@@ -0,0 +1,75 @@
+"""Loading and eviction of the chats of a journal"""
+import os
+import threading
+
+from utils.journal import ChatJournal
+from utils.locks import ChatLocks
+from utils.queue import Queue
+
+
+def make_journal(tmp_path, chats=10, **kwargs):
+    """Return a journal of 'chats' chats of one item each, none of them in
+    memory"""
+    filename = os.path.join(str(tmp_path), 'journal.db')
+    journal = ChatJournal(filename)
+    for chat_id in range(chats):
+        journal.chats[chat_id]['is_frozen'] = False
+    journal.close()
+    return ChatJournal(filename, **kwargs)
+
+
+def test_chat_loaded_once_by_concurrent_threads(tmp_path):
+    journal = make_journal(tmp_path)
+    for chat_id in range(10):
+        barrier = threading.Barrier(8)
+        loaded = []
+
+        def load():
+            barrier.wait()
+            loaded.append(journal.chats[chat_id])
+        threads = [threading.Thread(target=load) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert all(chat_data is loaded[0] for chat_data in loaded)
+    assert journal.chats.counters['misses'] == 10
+    journal.close()
+
+
+def test_chats_in_use_are_not_evicted(tmp_path):
+    locks = ChatLocks()
+    journal = make_journal(tmp_path, max_resident_items=0, in_use=locks.is_locked)
+    for chat_id in range(10):
+        journal.chats[chat_id]
+    journal.chats.pin(2)
+    with locks.lock(5):
+        journal.chats.evict()
+        assert sorted(journal.chats) == [2, 5, 9]
+    journal.chats.unpin(2)
+    journal.chats.evict()
+    assert sorted(journal.chats) == [9]
+    journal.close()
+
+
+def test_compaction_between_a_change_and_its_record(tmp_path):
+    # A queue records its changes after making them, with the lock of the chat held
+    busy = set()
+    filename = os.path.join(str(tmp_path), 'journal.db')
+    journal = ChatJournal(filename, in_use=busy.__contains__)
+    journal.chats[1]['queue'] = Queue()
+    journal.chats[2]['is_frozen'] = False
+    chat_queue = journal.chats[1]['queue']
+    busy.add(1)
+    chat_queue._append('x', None, None, None)
+    journal.compact()
+    chat_queue.journal('append', 'x', None)
+    busy.clear()
+    journal.commit()
+
+    # As after a crash: closing would compact again
+    reopened = ChatJournal(filename)
+    assert list(reopened.chats[1]['queue']) == ['x']
+    assert reopened.chats[2] == {'is_frozen': False}
+    reopened.close()
+    journal.close()
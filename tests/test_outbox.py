@@ -0,0 +1,45 @@
+"""Errors of the requests sent by the outbox"""
+import time
+
+from telegram.error import BadRequest, ChatMigrated, TimedOut, Unauthorized
+
+from utils.outbox import Outbox
+
+
+def send_first(outbox, error):
+    """Submit two messages to a chat, fail the first one with 'error' and
+    return the next message ready to be sent"""
+    outbox.submit(1, 'first')
+    outbox.submit(1, 'second')
+    message, _ = outbox.next_ready()
+    assert message.text == 'first'
+    outbox.failed(message, error)
+    return outbox.next_ready()
+
+
+def test_rejected_message_is_dropped_at_once():
+    for error in (BadRequest('Chat not found'), Unauthorized('Forbidden: bot was blocked by the user'),
+                  ChatMigrated(-100123)):
+        outbox = Outbox()
+        message, _ = send_first(outbox, error)
+        assert message is not None and message.text == 'second'
+        assert outbox.counters['failed'] == 1
+        assert outbox.counters['retried'] == 0
+
+
+def test_timed_out_message_is_retried():
+    outbox = Outbox(backoff=0.5)
+    message, delay = send_first(outbox, TimedOut())
+    assert message is None and delay > 0
+    assert outbox.counters['retried'] == 1
+    message, _ = outbox.next_ready(time.monotonic() + 1)
+    assert message.text == 'first'
+
+
+def test_edit_of_deleted_message_is_dropped():
+    outbox = Outbox(edit_delay=0)
+    outbox.edit(1, 42, 'live queue')
+    message, _ = outbox.next_ready(time.monotonic() + 1)
+    outbox.failed(message, BadRequest('Message to edit not found'))
+    assert outbox.counters['failed'] == 1
+    assert outbox.depth == 0
@@ -0,0 +1,36 @@
+"""Chats holding several queues, saved and loaded through PicklePersistence"""
+import os
+
+from utils.persistence import ChatPicklePersistence
+from utils.queue import Queue
+
+
+def make_persistence(filename):
+    return ChatPicklePersistence(filename=filename, store_user_data=False, store_bot_data=False,
+                                 store_chat_data=True)
+
+
+def make_chat_data(chat_id):
+    chat_data = {'is_frozen': False, 'queue': Queue(), 'queue:extra': Queue()}
+    for i in range(5):
+        chat_data['queue'].append('item {} of {}'.format(i, chat_id), user_id=i + 1, timestamp=1000.0 + i)
+        chat_data['queue:extra'].append('extra {}'.format(i), note='note {}'.format(i))
+    return chat_data
+
+
+def test_chats_with_named_queues_are_saved(tmp_path):
+    filename = os.path.join(str(tmp_path), 'data.pck')
+    persistence = make_persistence(filename)
+    # As the dispatcher does on start
+    persistence.get_chat_data()
+    chats = {chat_id: make_chat_data(chat_id) for chat_id in range(-50, 0)}
+    for chat_id, chat_data in chats.items():
+        persistence.update_chat_data(chat_id, chat_data)
+        persistence.flush()
+
+    loaded = make_persistence(filename).get_chat_data()
+    assert sorted(loaded) == sorted(chats)
+    for chat_id, chat_data in chats.items():
+        assert loaded[chat_id]['is_frozen'] is False
+        for key in ('queue', 'queue:extra'):
+            assert list(loaded[chat_id][key].entries()) == list(chat_data[key].entries())
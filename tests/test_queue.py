@@ -0,0 +1,96 @@
+"""Random operations on a queue of small blocks, checked against a list"""
+import pickle
+import random
+
+from utils.queue import Queue
+
+ITEMS = ['item {}'.format(i) for i in range(12)]
+USERS = [None, 1, 2, 3]
+
+
+def format_note(note):
+    return '({})'.format(note)
+
+
+def expected_lines(reference, start, stop):
+    size = len(str(len(reference)))
+    lines = []
+    for i, (item, _, note) in enumerate(reference[start:stop], start + 1):
+        line = "  {index:>{size}}. {item}".format(index=i, size=size, item=item)
+        lines.append(line if note is None else line + ' ' + format_note(note))
+    return tuple(lines)
+
+
+def random_entry(rng):
+    return rng.choice(ITEMS), rng.choice(USERS), rng.choice([None, 'note'])
+
+
+def apply_random_operation(rng, queue, reference):
+    operation = rng.choice(['append', 'append', 'insert', 'extend', 'pop', 'remove', 'remove_many', 'pop_many',
+                            'pickle'])
+    if operation == 'append':
+        item, user_id, note = random_entry(rng)
+        queue.append(item, user_id=user_id, note=note)
+        reference.append((item, user_id, note))
+    elif operation == 'insert':
+        item, user_id, note = random_entry(rng)
+        index = rng.randint(-len(reference) - 2, len(reference) + 2)
+        queue.insert(index, item, user_id=user_id, note=note)
+        if index < 0:
+            index = max(0, index + len(reference))
+        reference.insert(index, (item, user_id, note))
+    elif operation == 'extend':
+        _, user_id, note = random_entry(rng)
+        items = [rng.choice(ITEMS) for _ in range(rng.randint(0, 10))]
+        queue.extend(items, user_id=user_id, note=note)
+        reference.extend((item, user_id, note) for item in items)
+    elif operation == 'pop' and reference:
+        assert queue.pop().item == reference.pop(0)[0]
+    elif operation == 'remove' and reference:
+        index = rng.randrange(-len(reference), len(reference))
+        assert queue.remove(index).item == reference.pop(index)[0]
+    elif operation == 'remove_many' and reference:
+        indices = [rng.randrange(-len(reference), len(reference)) for _ in range(rng.randint(1, 6))]
+        positions = sorted({index % len(reference) for index in indices})
+        removed = [entry.item for entry in queue.remove_many(indices)]
+        assert removed == [reference[i][0] for i in positions]
+        for i in reversed(positions):
+            del reference[i]
+    elif operation == 'pop_many':
+        count = rng.randint(0, 6)
+        assert [entry.item for entry in queue.pop_many(count)] == [item for item, _, _ in reference[:count]]
+        del reference[:count]
+    elif operation == 'pickle':
+        queue = pickle.loads(pickle.dumps(queue))
+    return queue
+
+
+def check_queue(rng, queue, reference):
+    items = [item for item, _, _ in reference]
+    assert list(queue) == items
+    assert len(queue) == len(reference)
+    assert [(entry.item, entry.user_id, entry.note) for entry in queue.entries()] == reference
+    for item in ITEMS:
+        assert (item in queue) == (item in items)
+        if item in items:
+            assert queue.index(item) == items.index(item)
+    for user_id in USERS[1:]:
+        owned = {item for item, owner, _ in reference if owner == user_id}
+        assert queue.positions_of(user_id) == sorted(items.index(item) for item in owned)
+    page_size = rng.randint(1, 5)
+    for page in range(len(reference) // page_size + 2):
+        start = page * page_size
+        assert queue.page_lines(page, page_size, note=format_note) == \
+            expected_lines(reference, start, start + page_size)
+
+
+def test_random_operations_match_a_list(monkeypatch):
+    # Small blocks, so that operations often split, empty and merge them
+    monkeypatch.setattr(Queue, '_LOAD', 4)
+    for seed in range(20):
+        rng = random.Random(seed)
+        queue = Queue()
+        reference = []
+        for _ in range(300):
+            queue = apply_random_operation(rng, queue, reference)
+            check_queue(rng, queue, reference)
@@ -0,0 +1,44 @@
+"""Snapshots imported into and exported from the persistence files"""
+import os
+
+from utils.queue import Queue
+from utils.snapshot import SnapshotReader, SnapshotWriter, export_persistence, import_snapshot
+
+
+def make_chats():
+    chats = {}
+    for chat_id in range(-20, 0):
+        chat_data = {'is_frozen': chat_id % 2 == 0, 'queue': Queue(), 'queue:topic': Queue(), 'turn_minutes': 5}
+        for i in range(10):
+            chat_data['queue'].append('item {}'.format(i), user_id=i + 1, timestamp=1000.0 + i)
+            chat_data['queue:topic'].append('topic {}'.format(i), note='note' if i % 3 == 0 else None)
+        chats[chat_id] = chat_data
+    return chats
+
+
+def assert_same_chats(loaded, chats):
+    assert sorted(loaded) == sorted(chats)
+    for chat_id, chat_data in chats.items():
+        assert sorted(loaded[chat_id]) == sorted(chat_data)
+        for key, value in chat_data.items():
+            if isinstance(value, Queue):
+                assert list(loaded[chat_id][key].entries()) == list(value.entries())
+            else:
+                assert loaded[chat_id][key] == value
+
+
+def test_import_into_pickle_persistence(tmp_path):
+    chats = make_chats()
+    snapshot = os.path.join(str(tmp_path), 'chats.qsnap')
+    with SnapshotWriter(snapshot) as writer:
+        for chat_id, chat_data in chats.items():
+            writer.write_chat(chat_id, chat_data)
+
+    target = os.path.join(str(tmp_path), 'data.pck')
+    assert import_snapshot(snapshot, target) == len(chats)
+
+    # Back to a snapshot through the pickle file
+    exported = os.path.join(str(tmp_path), 'exported.qsnap')
+    export_persistence(target, exported)
+    with SnapshotReader(exported) as reader:
+        assert_same_chats(dict(reader), chats)
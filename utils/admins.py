@@ -0,0 +1,94 @@
+"""Per-chat admin sets kept up to date by chat member updates.
+
+Telegram sends chat_member updates to bots that are administrators of a
+group, so in those groups the admin set is fetched once with
+getChatAdministrators and then changed incrementally as members are promoted
+or demoted. In groups where the bot is not an administrator no updates arrive
+and the admin list is refetched every hour as before.
+"""
+import threading
+
+import telegram
+
+from utils.mwt import MWT
+
+ADMIN_STATUSES = {telegram.ChatMember.ADMINISTRATOR, telegram.ChatMember.CREATOR}
+
+
+class AdminRegistry:
+    """Admin IDs of every group the bot is in"""
+    def __init__(self):
+        # Groups where the bot is an admin: set of admin IDs, kept up to date by updates
+        self._tracked = {}
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(['tracked_hits', 'fetches', 'member_updates'], 0)
+
+    @MWT(timeout=60 * 60, maxsize=10000, stale_while_revalidate=10 * 60, key=lambda self, bot, chat_id: chat_id)
+    def _fetch(self, bot, chat_id):
+        """Return the admin IDs of a group. Only groups where the bot is not
+        an admin are cached here, for 1 hour"""
+        with self._lock:
+            self.counters['fetches'] += 1
+        admin_ids = frozenset(admin.user.id for admin in bot.get_chat_administrators(chat_id))
+        self.store(chat_id, admin_ids, bot.id)
+        return admin_ids
+
+    def store(self, chat_id, admin_ids, bot_id):
+        """Store the admin IDs of a group, as fetched from getChatAdministrators.
+        They are tracked through updates if the bot itself is an admin"""
+        if bot_id in admin_ids:
+            with self._lock:
+                self._tracked[chat_id] = set(admin_ids)
+        else:
+            self._fetch.cache.put(frozenset(admin_ids), self, None, chat_id)
+
+    def is_known(self, chat_id):
+        """Return True if the admins of a group can be looked up without
+        calling the Bot API"""
+        return chat_id in self._tracked or self._fetch.cache.peek(self, None, chat_id) is not None
+
+    def admin_ids(self, bot, chat_id):
+        """Return the set of admin IDs of a group"""
+        admin_ids = self._tracked.get(chat_id)
+        if admin_ids is not None:
+            self.counters['tracked_hits'] += 1
+            return admin_ids
+        return self._fetch(bot, chat_id)
+
+    def forget(self, chat_id):
+        with self._lock:
+            self._tracked.pop(chat_id, None)
+        self._fetch.cache.invalidate(self, None, chat_id)
+
+    def on_chat_member(self, chat_member_updated, bot_id):
+        """Apply a chat_member or my_chat_member update"""
+        chat_id = chat_member_updated.chat.id
+        member = chat_member_updated.new_chat_member
+        self.counters['member_updates'] += 1
+        if member.user.id == bot_id:
+            # The bot itself was promoted, demoted or removed: updates start or
+            # stop arriving, refetch the admins on next use
+            self.forget(chat_id)
+            return
+        with self._lock:
+            admin_ids = self._tracked.get(chat_id)
+            if admin_ids is not None:
+                if member.status in ADMIN_STATUSES:
+                    admin_ids.add(member.user.id)
+                else:
+                    admin_ids.discard(member.user.id)
+                return
+        self._fetch.cache.invalidate(self, None, chat_id)
+
+    def handle_update(self, update, context):
+        """ChatMemberHandler callback"""
+        self.on_chat_member(update.chat_member or update.my_chat_member, context.bot.id)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['tracked_chats'] = len(self._tracked)
+        stats.update(('cache_' + key, value) for key, value in self._fetch.cache.stats().items())
+        return stats
+
+
+ADMINS = AdminRegistry()
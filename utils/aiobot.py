@@ -0,0 +1,305 @@
+"""Asyncio runtime for the bot.
+
+Commands in botfunctions never wait on the network themselves: the only
+blocking calls they make are sendMessage (fire and forget from the command's
+point of view) and getChatAdministrators (through utils.admins). The runtime
+therefore runs every update in a coroutine that
+  1. prefetches the admin list of group chats when it is not known,
+  2. runs the command, which schedules its replies on a shared HTTP
+     connection pool instead of blocking a worker thread,
+  3. awaits the replies.
+Updates of the same chat are processed in order, different chats run
+concurrently.
+"""
+import asyncio
+import contextvars
+import logging
+import weakref
+from collections import defaultdict
+
+import telegram
+from telegram.error import TelegramError, NetworkError, RetryAfter, BadRequest
+
+from utils.admins import ADMINS
+from utils.botrequest import BotRequest
+from utils.dispatch import parse_command
+from utils.metrics import METRICS
+from utils.outbox import AsyncOutbox
+from utils.scheduler import AsyncScheduler
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# Replies scheduled by the update currently being processed
+_pending_sends = contextvars.ContextVar('pending_sends')
+
+
+def _log_failure(task):
+    """Log the error of a request nobody awaits"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Request failed: %s", task.exception())
+
+
+class AsyncBotAPI:
+    """Minimal asynchronous Bot API client sharing one HTTP connection pool"""
+    def __init__(self, token, base_url='https://api.telegram.org/bot', pool_size=100, timeout=10):
+        if httpx is None:
+            raise ImportError("httpx is required to run the bot in asyncio mode")
+        self.url = '{}{}/'.format(base_url, token)
+        self.timeout = timeout
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+        )
+
+    async def call(self, method, http_timeout=None, **params):
+        """Call a Bot API method and return its result
+        Raises:
+            RetryAfter: the request was throttled by Telegram
+            BadRequest: the request was rejected, as editing a message with
+                the text it already has
+            TelegramError: any other API error
+        """
+        params = {key: value for key, value in params.items() if value is not None}
+        try:
+            response = await self._client.post(self.url + method, json=params,
+                                               timeout=http_timeout or self.timeout)
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise NetworkError(str(e)) from e
+        if not data.get('ok'):
+            retry_after = data.get('parameters', {}).get('retry_after')
+            if retry_after is not None:
+                raise RetryAfter(retry_after)
+            if data.get('error_code') == 400:
+                raise BadRequest(data.get('description', 'Bad Request'))
+            raise TelegramError(data.get('description', 'Unknown error'))
+        return data['result']
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class AsyncBot:
+    """Synchronous facade handed to commands as context.bot.
+
+    send_message schedules the request on the event loop and returns
+    immediately. get_chat_administrators answers from the admin lists
+    prefetched by the runtime.
+    """
+    defaults = None
+
+    def __init__(self, runtime):
+        self._runtime = runtime
+        self.id = None
+        self.username = None
+
+    def _call(self, method, **params):
+        task = asyncio.ensure_future(self._runtime.api.call(method, **params))
+        pending = _pending_sends.get(None)
+        if pending is not None:
+            pending.append(task)
+        else:
+            task.add_done_callback(_log_failure)
+        return task
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call('sendMessage', chat_id=chat_id, text=text, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self._call('editMessageText', chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+    def pin_chat_message(self, chat_id, message_id, disable_notification=None):
+        return self._call('pinChatMessage', chat_id=chat_id, message_id=message_id,
+                          disable_notification=disable_notification)
+
+    def unpin_chat_message(self, chat_id, message_id=None):
+        return self._call('unpinChatMessage', chat_id=chat_id, message_id=message_id)
+
+    def get_chat_administrators(self, chat_id):
+        return self._runtime.admins[chat_id]
+
+
+class AsyncContext:
+    """The subset of CallbackContext used by commands"""
+    __slots__ = ('bot', 'args', 'chat_data')
+
+    def __init__(self, bot, args, chat_data):
+        self.bot = bot
+        self.args = args
+        self.chat_data = chat_data
+
+
+class AsyncRuntime:
+    """Long-polling asyncio runtime.
+    Args:
+        token: bot token
+        commands: dict of command name -> handler, as botfunctions.COMMANDS
+        base_url: Bot API url, the token is appended to it
+        pool_size: size of the shared HTTP connection pool
+        max_concurrency: maximum number of updates processed at once
+        persistence: storage of chat_data with the get_chat_data,
+            update_chat_data and flush methods of a
+            telegram.ext.BasePersistence, such as utils.journal.JournalStore
+        outbox: if True, replies go through a rate limited AsyncOutbox
+        timers: function returning the callback firing the timers of the
+            chats, called as timers(bot, chat_data, persistence), as
+            botfunctions.timer_callback. If None, timers are disabled
+        timer_store: utils.scheduler.TimerStore saving the pending timers
+        recorder: utils.recorder.UpdateRecorder recording the updates
+    """
+    GROUP_TYPES = {telegram.Chat.GROUP, telegram.Chat.SUPERGROUP}
+    ALLOWED_UPDATES = [telegram.Update.MESSAGE, telegram.Update.CHAT_MEMBER, telegram.Update.MY_CHAT_MEMBER]
+
+    def __init__(self, token, commands, base_url='https://api.telegram.org/bot', pool_size=100,
+                 max_concurrency=1000, persistence=None, outbox=False, timers=None, timer_store=None,
+                 recorder=None):
+        self.token = token
+        self.commands = commands
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.persistence = persistence
+        self.chat_data = persistence.get_chat_data() if persistence is not None else defaultdict(dict)
+        # Last admin list fetched for each group
+        self.admins = {}
+        self.use_outbox = outbox
+        self.outbox = None
+        self.timers = timers
+        self.timer_store = timer_store
+        self.scheduler = None
+        self.recorder = recorder
+        self.api = None
+        self.bot = AsyncBot(self)
+        self._chat_locks = weakref.WeakValueDictionary()
+        self._admin_fetches = {}
+        self._running = False
+
+    def _chat_lock(self, chat_id):
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        return lock
+
+    async def _ensure_admins(self, chat_id):
+        """Fetch the admin list of a group, unless it is known to the admin
+        registry. Concurrent requests for the same chat share a single API call"""
+        if ADMINS.is_known(chat_id):
+            return
+        fetch = self._admin_fetches.get(chat_id)
+        if fetch is None:
+            fetch = self._admin_fetches[chat_id] = asyncio.ensure_future(
+                self.api.call('getChatAdministrators', chat_id=chat_id))
+            fetch.add_done_callback(lambda _: self._admin_fetches.pop(chat_id, None))
+        result = await fetch
+        admins = self.admins[chat_id] = [telegram.ChatMember.de_json(admin, None) for admin in result]
+        ADMINS.store(chat_id, frozenset(admin.user.id for admin in admins), self.bot.id)
+
+    async def process_update(self, data):
+        """Process a single update, given as the JSON dict sent by Telegram"""
+        update = telegram.Update.de_json(data, self.bot)
+        member_update = update.chat_member or update.my_chat_member
+        if member_update is not None:
+            ADMINS.on_chat_member(member_update, self.bot.id)
+            self.admins.pop(member_update.chat.id, None)
+            return
+        message = update.message
+        if message is None or message.text is None:
+            return
+        parsed = parse_command(message.text)
+        if parsed is None:
+            return
+        name, username, args = parsed
+        func = self.commands.get(name)
+        if func is None or (username and username.lower() != self.bot.username.lower()):
+            return
+        chat = update.effective_chat
+        async with self._chat_lock(chat.id):
+            if chat.type in self.GROUP_TYPES:
+                with METRICS.timer('qbot_admin_lookup_seconds'):
+                    await self._ensure_admins(chat.id)
+            context = AsyncContext(self.bot, args, self.chat_data[chat.id])
+            pending = []
+            token = _pending_sends.set(pending)
+            try:
+                func(update, context)
+            finally:
+                _pending_sends.reset(token)
+                if self.persistence is not None:
+                    self.persistence.update_chat_data(chat.id, context.chat_data)
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.warning("Could not reply in chat %s: %s", chat.id, result)
+
+    async def _process_safely(self, data, semaphore):
+        try:
+            await self.process_update(data)
+        except Exception:
+            logger.exception("Error while processing update %s", data.get('update_id'))
+        finally:
+            semaphore.release()
+
+    async def poll(self, timeout=30):
+        """Fetch updates with getUpdates and process them concurrently"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        offset = None
+        self._running = True
+        async with self:
+            while self._running:
+                try:
+                    updates = await self.api.call('getUpdates', offset=offset, timeout=timeout,
+                                                  allowed_updates=self.ALLOWED_UPDATES, http_timeout=timeout + 10)
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except TelegramError as e:
+                    logger.warning("getUpdates failed: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                for data in updates:
+                    offset = data['update_id'] + 1
+                    if self.recorder is not None:
+                        self.recorder.record(data, self.bot.id, self.bot.username)
+                    await semaphore.acquire()
+                    asyncio.ensure_future(self._process_safely(data, semaphore))
+
+    def stop(self):
+        self._running = False
+
+    async def __aenter__(self):
+        self.api = AsyncBotAPI(self.token, self.base_url, self.pool_size)
+        me = await self.api.call('getMe')
+        self.bot.id, self.bot.username = me['id'], me['username']
+        if self.use_outbox:
+            self.outbox = AsyncOutbox(self._send_message, self._edit_message).start()
+            BotRequest.outbox = self.outbox
+        if self.timers is not None:
+            # Timers run on the event loop between updates, a chat's data is never seen half updated
+            fire = self.timers(self.bot, self.chat_data, self.persistence)
+            self.scheduler = AsyncScheduler(fire, self.timer_store).start()
+            BotRequest.scheduler = self.scheduler
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.scheduler is not None:
+            BotRequest.scheduler = None
+            await self.scheduler.stop()
+        if self.outbox is not None:
+            BotRequest.outbox = None
+            await self.outbox.stop()
+        await self.api.close()
+        if self.persistence is not None:
+            self.persistence.flush()
+
+    async def _send_message(self, chat_id, text, **kwargs):
+        await self.api.call('sendMessage', chat_id=chat_id, text=text, **kwargs)
+
+    async def _edit_message(self, text, chat_id, message_id, **kwargs):
+        await self.api.call('editMessageText', chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+    def run(self):
+        asyncio.run(self.poll())
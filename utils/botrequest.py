@@ -1,45 +1,157 @@
+import asyncio
+import datetime
+import logging
+from types import SimpleNamespace
+
 import telegram
-from utils.mwt import MWT
+from telegram.error import TelegramError, BadRequest
+from utils.admins import ADMINS
+from utils.metrics import METRICS
+
+logger = logging.getLogger(__name__)
 
 
 class BotRequest:
     """Telegram bot requests handler"""
-    def __init__(self, update, context):
+    __slots__ = ('update', 'context', 'command_name', '_is_admin')
+    # Telegram rejects text messages longer than this
+    MAX_MESSAGE_LENGTH = 4096
+    # utils.outbox.Outbox queueing the replies. If None, replies are sent right away
+    outbox = None
+    # utils.scheduler.Scheduler holding the timers of the chats. If None, timers are not available
+    scheduler = None
+
+    def __init__(self, update, context, command_name=None):
         self.update = update
         self.context = context
+        # Name of the command being handled, used to label metrics
+        self.command_name = command_name
+        # Whether the request was sent by an admin, looked up once
+        self._is_admin = None
+
+    @classmethod
+    def for_chat(cls, bot, chat_id, chat_data, command_name=None):
+        """Return a request acting on a chat outside of any update, as when a
+        timer fires. It has no sender"""
+        # Group IDs are negative, user IDs positive
+        chat = telegram.Chat(chat_id, telegram.Chat.GROUP if chat_id < 0 else telegram.Chat.PRIVATE)
+        update = telegram.Update(0, message=telegram.Message(0, datetime.datetime.now(), chat))
+        return cls(update, SimpleNamespace(bot=bot, args=[], chat_data=chat_data), command_name)
 
     @property
     def chat_type(self):
         return self.update.effective_chat.type
 
+    def _post(self, text, coalesce=None, **kwargs):
+        """Deliver an already formatted text to the chat. Messages with the
+        same 'coalesce' key may be merged by the outbox"""
+        chat_id = self.update.effective_chat.id
+        with METRICS.timer('qbot_send_seconds', command=self.command_name):
+            if self.outbox is not None:
+                self.outbox.submit(chat_id, text, coalesce, **kwargs)
+            else:
+                self.context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+    def send_now(self, text, on_sent=None, **kwargs):
+        """Send a message right away, bypassing the outbox. on_sent is called
+        with the id of the message once it is known"""
+        chat_id = self.update.effective_chat.id
+        with METRICS.timer('qbot_send_seconds', command=self.command_name):
+            result = self.context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        if on_sent is None:
+            return
+        if asyncio.isfuture(result):
+            # Asyncio runtime: the request completes after the command returns
+            result.add_done_callback(
+                lambda task: task.cancelled() or task.exception() or on_sent(task.result()['message_id']))
+        else:
+            on_sent(result.message_id)
+
+    def edit(self, message_id, text, **kwargs):
+        """Replace the text of a message sent by the bot. Edits go through the
+        outbox, which debounces them"""
+        chat_id = self.update.effective_chat.id
+        if self.outbox is not None:
+            self.outbox.edit(chat_id, message_id, text, **kwargs)
+            return
+        try:
+            self.context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+        except BadRequest as e:
+            if 'not modified' not in e.message:
+                logger.warning("Could not edit message %s in chat %s: %s", message_id, chat_id, e)
+
+    def pin(self, message_id, pinned=True):
+        """Pin, or unpin, a message silently. Return False if the bot is not
+        allowed to. The return value is only meaningful in the threaded
+        runtime: in the asyncio runtime the request completes after the call,
+        True is returned and a failure is only logged"""
+        chat_id = self.update.effective_chat.id
+
+        def log_failure(task):
+            # The request may be scheduled after the replies of the update were awaited, as from on_sent
+            if not task.cancelled() and task.exception() is not None:
+                logger.info("Could not pin message %s in chat %s: %s", message_id, chat_id, task.exception())
+        try:
+            if pinned:
+                result = self.context.bot.pin_chat_message(chat_id, message_id, disable_notification=True)
+            else:
+                result = self.context.bot.unpin_chat_message(chat_id, message_id=message_id)
+        except TelegramError as e:
+            logger.info("Could not pin message %s in chat %s: %s", message_id, chat_id, e)
+            return False
+        if asyncio.isfuture(result):
+            result.add_done_callback(log_failure)
+        return True
+
     def send_md(self, message, **kwformat):
         """Send a message in chat with Markdown format"""
-        self.context.bot.send_message(
-            chat_id=self.update.effective_chat.id, text=message.format(**kwformat),
-            parse_mode=telegram.ParseMode.MARKDOWN,
-        )
+        self._post(message.format(**kwformat), message, parse_mode=telegram.ParseMode.MARKDOWN)
 
     def send(self, message, **kwformat):
         """Send a non formatted message in chat"""
-        self.context.bot.send_message(
-            chat_id=self.update.effective_chat.id, text=message.format(**kwformat)
-        )
+        self._post(message.format(**kwformat), message)
+
+    def send_lines(self, lines):
+        """Send an iterable of lines, packing as many consecutive lines as
+        possible in each message without exceeding MAX_MESSAGE_LENGTH. Lines
+        are sent verbatim."""
+        chunk = []
+        size = 0
+        for line in lines:
+            # Lines longer than a whole message are hard-split
+            while len(line) > self.MAX_MESSAGE_LENGTH:
+                if chunk:
+                    self._post('\n'.join(chunk))
+                    chunk = []
+                    size = 0
+                self._post(line[:self.MAX_MESSAGE_LENGTH])
+                line = line[self.MAX_MESSAGE_LENGTH:]
+            if chunk and size + 1 + len(line) > self.MAX_MESSAGE_LENGTH:
+                self._post('\n'.join(chunk))
+                chunk = []
+                size = 0
+            size += len(line) + (1 if chunk else 0)
+            chunk.append(line)
+        if chunk:
+            self._post('\n'.join(chunk))
 
     def is_request_by_admin(self):
         """Return true if request was sent from an admin - or if the chat is
-        private."""
+        private. Commands checking several permissions look it up once"""
+        if self._is_admin is None:
+            self._is_admin = self._lookup_admin()
+        return self._is_admin
+
+    def _lookup_admin(self):
         # Private chats have no admins
         if self.chat_type in {telegram.Chat.GROUP, telegram.Chat.SUPERGROUP}:
             user_id = self.update.message.from_user.id
             bot = self.context.bot
             chat_id = self.update.effective_chat.id
-            return user_id in _get_admin_ids(bot, chat_id)
+            with METRICS.timer('qbot_admin_lookup_seconds'):
+                admin_ids = ADMINS.admin_ids(bot, chat_id)
+            return user_id in admin_ids
         else:
             # It's a private chat
             return True
 
-
-@MWT(timeout=60 * 60)
-def _get_admin_ids(bot, chat_id):
-    """Return a list of admin IDs. Results are cached for 1 hour."""
-    return [admin.user.id for admin in bot.get_chat_administrators(chat_id)]
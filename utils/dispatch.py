@@ -0,0 +1,89 @@
+"""A single handler routing every command.
+
+With one CommandHandler per command, the dispatcher checks them in turn until
+one accepts the update, and each of them parses the message again.
+CommandDispatcher parses the command once and looks it up in a dict.
+
+CommandDispatcher subclasses telegram.ext.Handler, and importing telegram.ext
+takes longer than importing the rest of the bot. The class is only defined
+when first imported, so that the asyncio runtime, which only needs
+parse_command, starts without it.
+"""
+import telegram
+
+
+def parse_command(text):
+    """Split '/cmd@bot arg1 arg2' into ('cmd', 'bot', ['arg1', 'arg2']). The
+    bot is '' when the command is not addressed to a specific bot. Return
+    None if the text is not a command"""
+    if not text or text[0] != '/':
+        return None
+    words = text.split()
+    name, _, username = words[0][1:].partition('@')
+    return name.lower(), username, words[1:]
+
+
+def _define_command_dispatcher():
+    from telegram.ext import Handler
+
+    class CommandDispatcher(Handler):
+        """Handler calling commands[name](update, context) for the messages
+        starting with '/name', with context.args set to the following words.
+        Commands addressed to another bot, as in '/name@other_bot', are ignored.
+        Args:
+            commands: dict of command name -> handler, as botfunctions.COMMANDS
+            run_async: run the commands on the worker threads of the dispatcher
+                instead of its own thread. The commands must serialize the
+                updates of a chat themselves, as botfunctions.command does
+        """
+        __slots__ = ('commands',)
+
+        def __init__(self, commands, run_async=False):
+            # Commands are called by handle_update, there is no single callback
+            Handler.__init__(self, None, run_async=run_async)
+            self.commands = commands
+
+        def check_update(self, update):
+            """Return (handler, args) of the command in the update, None if there
+            is none"""
+            if not isinstance(update, telegram.Update) or update.message is None:
+                return None
+            parsed = parse_command(update.message.text)
+            if parsed is None:
+                return None
+            name, username, args = parsed
+            func = self.commands.get(name)
+            if func is None:
+                return None
+            if username and username.lower() != update.message.bot.username.lower():
+                return None
+            return func, args
+
+        def handle_update(self, update, dispatcher, check_result, context=None):
+            func, context.args = check_result
+            # Dispatchers without workers, as the ones of the shards, run everything in their thread
+            if self.run_async is True and dispatcher.workers > 0:
+                pin = getattr(dispatcher.chat_data, 'pin', None)
+                if pin is None or update.effective_chat is None:
+                    return dispatcher.run_async(func, update, context, update=update)
+                # Keep the chat_data of the context in memory until the command ran (see utils/journal.py)
+                chat_id = update.effective_chat.id
+                pin(chat_id)
+
+                def pinned(update, context):
+                    try:
+                        return func(update, context)
+                    finally:
+                        dispatcher.chat_data.unpin(chat_id)
+                return dispatcher.run_async(pinned, update, context, update=update)
+            return func(update, context)
+
+    return CommandDispatcher
+
+
+def __getattr__(name):
+    if name == 'CommandDispatcher':
+        global CommandDispatcher
+        CommandDispatcher = _define_command_dispatcher()
+        return CommandDispatcher
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,443 @@
+"""Incremental chat_data persistence.
+
+Instead of pickling every chat on each flush, each change to a chat (queue
+append/insert/remove/clear, flag changes such as is_frozen and is_protected)
+is appended as a small record to a journal table of a SQLite database in WAL
+mode. Every 'snapshot_interval' records the chats changed since the previous
+compaction are snapshotted and their journal records deleted, so that a
+restart only loads the snapshots and replays the journal tail.
+
+Chats are loaded lazily, the first time they are accessed, and evicted from
+memory when idle for too long or when too many queue items are resident.
+
+JournalPersistence is the telegram.ext persistence of the threaded bot. As
+it subclasses telegram.ext.BasePersistence, whose import takes longer than
+the rest of the bot, it is only defined when first imported: the asyncio
+runtime uses a JournalStore and starts without telegram.ext.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict, OrderedDict
+
+from utils.queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+def encode_value(value):
+    """Return a JSON serializable form of a chat_data value"""
+    if isinstance(value, Queue):
+        encoded = {'__queue__': [[entry.item, entry.data()] for entry in value.entries()]}
+        if value.fair:
+            # JSON object keys are strings: turns are kept as [user_id, turns] pairs
+            encoded['fair'] = True
+            encoded['turns'] = sorted(value.turns().items())
+        return encoded
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and '__queue__' in value:
+        queue = Queue()
+        for item, data in value['__queue__']:
+            queue.append(item, **(data or {}))
+        if value.get('fair'):
+            queue.set_fair(True, dict(value.get('turns') or ()))
+        return queue
+    return value
+
+
+def apply_record(chat_data, key, op, args):
+    """Apply a journal record to a plain chat_data dict"""
+    if op == 'set':
+        chat_data[key] = decode_value(args[0])
+    elif op == 'del':
+        chat_data.pop(key, None)
+    elif op in ('append', 'insert', 'extend'):
+        *position, item, data = args
+        getattr(chat_data[key], op)(*position, item, **(data or {}))
+    else:
+        getattr(chat_data[key], op)(*args)
+
+
+class JournaledChatData(dict):
+    """chat_data of a single chat, recording its changes to a ChatJournal.
+    Queues stored in it record their own changes too."""
+    def __init__(self, journal, chat_id, data=()):
+        dict.__init__(self, data)
+        self._journal = journal
+        self._chat_id = chat_id
+        for key, value in self.items():
+            self._watch(key, value)
+
+    def _watch(self, key, value):
+        if isinstance(value, Queue):
+            value.journal = self._journal.recorder(self._chat_id, key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._watch(key, value)
+        self._journal.record(self._chat_id, key, 'set', encode_value(value))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._journal.record(self._chat_id, key, 'del')
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class ChatDataMap(defaultdict):
+    """chat_id -> JournaledChatData mapping, as expected by the Dispatcher.
+
+    Chats missing from memory are loaded from the journal on first access.
+    Accesses are tracked in LRU order so that evict() can drop idle chats.
+    Chats in use are never evicted: the ones pinned with pin(), and the ones
+    for which in_use(chat_id) is True, as while a command of the chat runs.
+    Loads, accesses and evictions happen under the lock of the journal, so
+    that two threads never load the same chat into two objects.
+    """
+    def __init__(self, journal, idle_timeout=None, max_resident_items=None, in_use=None):
+        defaultdict.__init__(self, None)
+        self._journal = journal
+        self.idle_timeout = idle_timeout
+        self.max_resident_items = max_resident_items
+        self.in_use = in_use
+        self._lru = OrderedDict()
+        self._pins = {}
+        self._sizes = {}
+        self.resident_items = 0
+        self.counters = dict.fromkeys(['hits', 'misses', 'evictions'], 0)
+
+    def __getitem__(self, chat_id):
+        with self._journal._lock:
+            if dict.__contains__(self, chat_id):
+                self.counters['hits'] += 1
+                self._lru[chat_id] = time.monotonic()
+                self._lru.move_to_end(chat_id)
+                return dict.__getitem__(self, chat_id)
+            return self.__missing__(chat_id)
+
+    def __missing__(self, chat_id):
+        with self._journal._lock:
+            if dict.__contains__(self, chat_id):
+                # Loaded by another thread in the meantime
+                return dict.__getitem__(self, chat_id)
+            self.counters['misses'] += 1
+            chat_data = JournaledChatData(self._journal, chat_id, self._journal.load_chat(chat_id))
+            dict.__setitem__(self, chat_id, chat_data)
+            self._lru[chat_id] = time.monotonic()
+            self.resize(chat_id)
+        return chat_data
+
+    def resize(self, chat_id):
+        """Update the number of resident items accounted to a chat"""
+        chat_data = dict.get(self, chat_id)
+        if chat_data is None:
+            return
+        size = 1 + sum(len(value) for value in chat_data.values() if isinstance(value, Queue))
+        self.resident_items += size - self._sizes.get(chat_id, 0)
+        self._sizes[chat_id] = size
+
+    def _over_budget(self, now):
+        chat_id, last_access = next(iter(self._lru.items()))
+        if self.idle_timeout is not None and now - last_access > self.idle_timeout:
+            return True
+        return self.max_resident_items is not None and self.resident_items > self.max_resident_items
+
+    def pin(self, chat_id):
+        """Keep a chat in memory until as many unpin(), as while a command of
+        the chat waits for a worker thread"""
+        with self._journal._lock:
+            self._pins[chat_id] = self._pins.get(chat_id, 0) + 1
+
+    def unpin(self, chat_id):
+        with self._journal._lock:
+            count = self._pins.pop(chat_id)
+            if count > 1:
+                self._pins[chat_id] = count - 1
+
+    def _is_used(self, chat_id):
+        return chat_id in self._pins or (self.in_use is not None and self.in_use(chat_id))
+
+    def evict(self):
+        """Drop least recently used chats from memory while they are idle or
+        the resident items exceed the budget. The most recent chat and the
+        chats in use are kept"""
+        with self._journal._lock:
+            now = time.monotonic()
+            used = []
+            while len(self._lru) > 1 and self._over_budget(now):
+                chat_id, last_access = self._lru.popitem(last=False)
+                if self._is_used(chat_id):
+                    used.append((chat_id, last_access))
+                    continue
+                self._journal.release_chat(chat_id)
+                dict.pop(self, chat_id)
+                self.resident_items -= self._sizes.pop(chat_id)
+                self.counters['evictions'] += 1
+            # Back at the front, in the same order
+            for chat_id, last_access in reversed(used):
+                self._lru[chat_id] = last_access
+                self._lru.move_to_end(chat_id, last=False)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['resident_chats'] = len(self)
+        stats['resident_items'] = self.resident_items
+        return stats
+
+
+class ChatJournal:
+    """Journal of chat_data changes stored in a SQLite database.
+    Args:
+        filename: path of the database
+        snapshot_interval: number of records after which changed chats are
+            snapshotted and the journal truncated
+        idle_timeout, max_resident_items: eviction policy of the chats kept
+            in memory, see ChatDataMap. None disables the limit
+        in_use: function telling whether a chat is in use, see ChatDataMap
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            chat_id INTEGER PRIMARY KEY, seq INTEGER NOT NULL, state TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL,
+            key TEXT NOT NULL, op TEXT NOT NULL, args TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS journal_chat ON journal (chat_id, seq);
+    """
+
+    def __init__(self, filename, snapshot_interval=10000, idle_timeout=None, max_resident_items=None,
+                 in_use=None):
+        self.filename = filename
+        self.snapshot_interval = snapshot_interval
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._changed = set()
+        self._since_snapshot = 0
+        self.chats = ChatDataMap(self, idle_timeout, max_resident_items, in_use)
+
+    def recorder(self, chat_id, key):
+        """Return the journal callback of a queue stored in chat_data[key]"""
+        def record(op, *args):
+            self.record(chat_id, key, op, *args)
+        return record
+
+    def record(self, chat_id, key, op, *args):
+        """Buffer a change. It is written on the next commit"""
+        with self._lock:
+            self._buffer.append((chat_id, key, op, json.dumps(args)))
+            self._changed.add(chat_id)
+
+    def _write(self):
+        if not self._buffer:
+            return
+        with self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT INTO journal (chat_id, key, op, args) VALUES (?, ?, ?, ?)',
+                                   self._buffer)
+        self._since_snapshot += len(self._buffer)
+        self._buffer = []
+
+    def commit(self):
+        """Write the buffered records, then compact if the journal grew past
+        snapshot_interval"""
+        with self._lock:
+            self._write()
+            if self._since_snapshot >= self.snapshot_interval:
+                self.compact()
+
+    def _snapshot_rows(self, chat_ids, seq):
+        rows = []
+        for chat_id in chat_ids:
+            chat_data = dict.get(self.chats, chat_id, {})
+            state = {key: encode_value(value) for key, value in chat_data.items()}
+            rows.append((chat_id, seq, json.dumps(state)))
+        return rows
+
+    def _last_seq(self):
+        return self._conn.execute('SELECT MAX(seq) FROM journal').fetchone()[0] or 0
+
+    def compact(self):
+        """Snapshot the chats changed since the last compaction and drop their
+        journal records. Chats in use (see ChatDataMap) are left for the next
+        compaction: a queue records a change after making it, and a snapshot
+        taken in between would have the change applied twice on reload"""
+        with self._lock:
+            self._write()
+            if not self._changed:
+                return
+            seq = self._last_seq()
+            chat_ids = [chat_id for chat_id in self._changed if not self.chats._is_used(chat_id)]
+            rows = self._snapshot_rows(chat_ids, seq)
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany('INSERT OR REPLACE INTO snapshots (chat_id, seq, state) VALUES (?, ?, ?)', rows)
+                self._conn.executemany('DELETE FROM journal WHERE chat_id = ? AND seq <= ?',
+                                       [(chat_id, seq) for chat_id in chat_ids])
+            logger.info("Compacted journal: %d chats snapshotted, %d in use left for later", len(rows),
+                        len(self._changed) - len(rows))
+            self._changed.difference_update(chat_ids)
+            self._since_snapshot = 0
+
+    def load_chat(self, chat_id):
+        """Return the chat_data of a chat, as a plain dict, rebuilt from its
+        snapshot and the journal records following it"""
+        with self._lock:
+            self._write()
+            row = self._conn.execute('SELECT seq, state FROM snapshots WHERE chat_id = ?', (chat_id,)).fetchone()
+            if row is None:
+                seq, state = 0, {}
+            else:
+                seq = row[0]
+                state = {key: decode_value(value) for key, value in json.loads(row[1]).items()}
+            tail = self._conn.execute('SELECT key, op, args FROM journal WHERE chat_id = ? AND seq > ? ORDER BY seq',
+                                      (chat_id, seq))
+            for key, op, args in tail:
+                apply_record(state, key, op, json.loads(args))
+            return state
+
+    def release_chat(self, chat_id):
+        """Prepare a chat for eviction from memory. If it changed since the
+        last compaction, it is snapshotted so that reloading it is fast"""
+        with self._lock:
+            for value in dict.get(self.chats, chat_id, {}).values():
+                if isinstance(value, Queue):
+                    value.journal = None
+            if chat_id not in self._changed:
+                return
+            self._write()
+            seq = self._last_seq()
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.executemany('INSERT OR REPLACE INTO snapshots (chat_id, seq, state) VALUES (?, ?, ?)',
+                                       self._snapshot_rows([chat_id], seq))
+                self._conn.execute('DELETE FROM journal WHERE chat_id = ? AND seq <= ?', (chat_id, seq))
+            self._changed.discard(chat_id)
+
+    def chat_ids(self):
+        """Return the IDs of the chats stored in the database, sorted"""
+        with self._lock:
+            self._write()
+            rows = self._conn.execute('SELECT chat_id FROM snapshots UNION SELECT chat_id FROM journal ORDER BY 1')
+            return [row[0] for row in rows]
+
+    def replace_chats(self, chats):
+        """Store (chat_id, chat_data) pairs as the snapshots of their chats,
+        replacing their current state, in a single transaction. Replaced chats
+        are dropped from memory without being saved"""
+        with self._lock:
+            self._write()
+            seq = self._last_seq()
+            replaced = []
+            with self._conn:
+                self._conn.execute('BEGIN')
+                for chat_id, chat_data in chats:
+                    state = {key: encode_value(value) for key, value in chat_data.items()}
+                    self._conn.execute('INSERT OR REPLACE INTO snapshots (chat_id, seq, state) VALUES (?, ?, ?)',
+                                       (chat_id, seq, json.dumps(state)))
+                    self._conn.execute('DELETE FROM journal WHERE chat_id = ?', (chat_id,))
+                    replaced.append(chat_id)
+            for chat_id in replaced:
+                self._changed.discard(chat_id)
+                resident = dict.pop(self.chats, chat_id, None)
+                if resident is not None:
+                    for value in resident.values():
+                        if isinstance(value, Queue):
+                            value.journal = None
+                    self.chats._lru.pop(chat_id, None)
+                    self.chats.resident_items -= self.chats._sizes.pop(chat_id, 0)
+            return len(replaced)
+
+    def load(self):
+        """Return the chat_id -> chat_data mapping. Chats are loaded from the
+        database on first access"""
+        return self.chats
+
+    def close(self):
+        with self._lock:
+            self.compact()
+            self._conn.close()
+
+
+class JournalStore:
+    """chat_data stored in a ChatJournal, with the methods of
+    telegram.ext.BasePersistence the asyncio runtime uses. Changes are
+    committed after every update.
+    Args:
+        filename: path of the SQLite database
+        snapshot_interval, idle_timeout, max_resident_items, in_use: see ChatJournal
+    """
+    def __init__(self, filename='persistence/journal.db', snapshot_interval=10000, idle_timeout=None,
+                 max_resident_items=None, in_use=None):
+        self.journal = ChatJournal(filename, snapshot_interval, idle_timeout, max_resident_items, in_use)
+
+    def get_chat_data(self):
+        return self.journal.load()
+
+    def update_chat_data(self, chat_id, data):
+        # Changes were already recorded while they happened
+        self.journal.commit()
+        self.journal.chats.resize(chat_id)
+        self.journal.chats.evict()
+
+    def flush(self):
+        self.journal.close()
+
+
+def _define_journal_persistence():
+    from telegram.ext import BasePersistence
+
+    class JournalPersistence(JournalStore, BasePersistence):
+        """Persistence storing only chat_data, in a ChatJournal. Arguments
+        are the ones of JournalStore"""
+        def __init__(self, *args, **kwargs):
+            BasePersistence.__init__(self, store_user_data=False, store_chat_data=True, store_bot_data=False)
+            JournalStore.__init__(self, *args, **kwargs)
+
+        # Chat data never holds references to the bot, skip PTB's deep copy
+        def insert_bot(self, obj):
+            return obj
+
+        def replace_bot(self, obj):
+            return obj
+
+        def get_user_data(self):
+            return defaultdict(dict)
+
+        def get_bot_data(self):
+            return {}
+
+        def get_conversations(self, name):
+            return {}
+
+        def update_user_data(self, user_id, data):
+            pass
+
+        def update_bot_data(self, data):
+            pass
+
+        def update_conversation(self, name, key, new_state):
+            pass
+
+    return JournalPersistence
+
+
+def __getattr__(name):
+    if name == 'JournalPersistence':
+        global JournalPersistence
+        JournalPersistence = _define_journal_persistence()
+        return JournalPersistence
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,29 @@
+"""Per-chat serialization of the commands.
+
+Commands of different chats may run in parallel on the Updater's worker
+threads, but a command reads and changes the queue of its chat in several
+steps, such as checking that an item is not queued before adding it.
+ChatLocks maps every chat to one of a fixed number of locks (lock striping):
+the commands of a chat run one at a time, and chats on different stripes
+never wait for each other.
+"""
+import threading
+
+
+class ChatLocks:
+    """Fixed set of locks shared by all chats.
+    Args:
+        stripes: number of locks. Two chats wait for each other only if
+            they hash to the same lock
+    """
+    def __init__(self, stripes=1024):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def lock(self, chat_id):
+        """Return the lock serializing the commands of a chat"""
+        return self._locks[hash(chat_id) % len(self._locks)]
+
+    def is_locked(self, chat_id):
+        """Return True if the lock of a chat is held, by this chat or another
+        one on the same stripe"""
+        return self.lock(chat_id).locked()
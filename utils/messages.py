@@ -1,3 +1,5 @@
+from utils.templates import compile_templates
+
 EMOJI_RED_CROSS = '\U0000274C'
 EMOJI_SUCCESS = '\U0001F44D'
 EMOJI_FROZEN = '\U0001F9CA'
@@ -15,13 +17,16 @@ Basic:
 /start: start your conversation with the bot
 
 Queueing:
-/queue: show queue
-/add [item]: add item to the line. If no item is provided, the user's username is added in the queue
-/next [message]: announce the first element of the queue with an optional message
-/clear: clear queue
+/queue [name] [page]: show queue, or the queue 'name'. Long queues are split in pages
+/add [@name] [item]: add item to the line, or to the queue 'name'. If no item is provided, the user's username is added in the queue
+/addmany: add one item per line of the message, as in '/addmany' followed by a list
+/next [name] [count] [message]: announce the first element, or the first 'count' elements, of the queue with an optional message
+/clear [name]: clear queue, or delete the queue 'name'
+/queues: list the named queues of the chat
+/whereami: show where your items are in every queue
         
 Queue editing:
-/rm row-number: remove the row from the list
+/rm rows: remove the rows from the list. Rows can be numbers or ranges, as in '/rm 3-17,20'
 /insert item row-number: insert item in the specified row
 
 For group admins:
@@ -31,12 +36,42 @@ Group admins can always run any command, even when the queue is frozen. They als
 \U0001F512 /disable_protection:
 \U0001F512 /freeze: freeze queue. Items can't be added or inserted until /unfreeze is requested
 \U0001F512 /unfreeze: unfreeze queue
+\U0001F512 /timer minutes: time the turns, the next item is called after 'minutes' minutes unless /next comes first. '/timer off' stops it
+\U0001F512 /ttl minutes: items leave the queue if not served within 'minutes' minutes. '/ttl off' stops it
+\U0001F512 /schedule_unfreeze HH:MM: unfreeze the queue at the given time (UTC). '/schedule_unfreeze off' cancels it
+\U0001F512 /live [off]: post a pinned message showing the queue, updated after every change. '/live off' stops it
+\U0001F512 /fair [name] on|off: fair-share order for the queue, or the queue 'name': items of the users who had fewer turns are called first
+\U0001F512 /stats: show the bot statistics
 
 \U0001F512: Admins only in group chat, available in private chats.
 """
 
 QUEUE_EMPTY = "The queue is currently empty"
+QUEUE_HEADER = "Current queue:"
+QUEUE_PAGE_HEADER = "Current queue (page {page}/{pages}):"
+QUEUE_PAGE_FOOTER = "Send '/queue {next}' for the next page"
+QUEUE_ITEM_WAIT = "\U000023F3 {wait}"
+QUEUE_ITEM_NOTE = "- {note}"
+QUEUE_TOO_MANY_ARGUMENTS =  EMOJI_RED_CROSS + " TMI! Please only provide the page you want to see, as in '/queue page'"
+QUEUE_PAGE_NOT_RECOGNIZED = EMOJI_RED_CROSS + " I did not recognize '{page}' as a page number"
+QUEUE_PAGE_NOT_IN_RANGE =   EMOJI_RED_CROSS + " Page {page} does not exist. The queue has {pages} pages"
+QUEUE_NAME_NOT_VALID =      EMOJI_RED_CROSS + " '{name}' is not a valid queue name. Please use up to {max_len} letters, digits or underscores, starting with a letter"
+NAMED_QUEUE_EMPTY = "The queue '{queue}' is currently empty"
+NAMED_QUEUE_HEADER = "Queue '{queue}':"
+NAMED_QUEUE_PAGE_HEADER = "Queue '{queue}' (page {page}/{pages}):"
+NAMED_QUEUE_PAGE_FOOTER = "Send '/queue {queue} {next}' for the next page"
+QUEUE_FAIR_NOTE = "\U00002696 Fair-share order: items of the users who had fewer turns come first"
+QUEUES_NONE = "There are no named queues in this chat. Add an item to one with '/add @name item'"
+QUEUES_HEADER = "Queues of this chat:"
+QUEUES_MAIN = "  main queue: {count} items"
+QUEUES_LINE = "  {queue}: {count} items"
+WHEREAMI_NOTHING = "{user}, you have no items in the queues"
+WHEREAMI_HEADER = "{user}, your items are at:"
+WHEREAMI_LINE = "  {item}: position {index} in {queue}"
+WHEREAMI_MAIN = "the main queue"
+WHEREAMI_NAMED = "'{queue}'"
 ITEM_ALREADY_IN_QUEUE = EMOJI_RED_CROSS + " {item} is already in the queue at position {index}!"
+NAMED_ITEM_ALREADY_IN_QUEUE = EMOJI_RED_CROSS + " {item} is already in the queue '{queue}' at position {index}!"
 ITEM_TOO_LONG = EMOJI_RED_CROSS + " '{item}' is too long. Please use less than {max_len} characters."
 PERMISSION_NOT_GRANTED = EMOJI_LOCK + " Sorry {user}, you don't have the permission to '{command}'"
 QUEUE_IS_FROZEN =       EMOJI_FROZEN + " Sorry {user}, you can't '{action}' because the queue is frozen."
@@ -47,15 +82,23 @@ FORBIDDEN_ITEM_MESSAGE = EMOJI_RED_CROSS + " Can't add {item} to the list: there
 
 ADD_SUCCESS_PRIVATE = EMOJI_SUCCESS + " {item} added to the queue in position {index}"
 ADD_SUCCESS_GROUP = EMOJI_SUCCESS + " {user} added '{item}' to the queue at position {index}"
+NAMED_ADD_SUCCESS = EMOJI_SUCCESS + " {user} added '{item}' to the queue '{queue}' at position {index}"
 ADD_QUEUE_FROZEN = EMOJI_FROZEN + " Can't add '{item}': queue is frozen! Run '/unfreeze' to unfreeze it"
 
+ADDMANY_NO_ITEMS =      EMOJI_RED_CROSS + " Please write one item per line after '/addmany'"
+ADDMANY_SUCCESS =       EMOJI_SUCCESS + " {user} added {count} items to the queue at positions {first}-{last}{skipped}"
+ADDMANY_NOTHING_ADDED = EMOJI_RED_CROSS + " No item was added{skipped}"
+ADDMANY_SKIPPED =       " ({skipped} skipped: already in the queue or too long)"
+ITEMS_AND_MORE = " and {count} more"
+
 CLEAR_SUCCESS = EMOJI_SUCCESS + " Queue cleared!"
+NAMED_QUEUE_DELETED = EMOJI_SUCCESS + " Queue '{queue}' deleted!"
 
 RM_INDEX_NOT_PROVIDED =     EMOJI_RED_CROSS + " Please provide the row number that you want to delete, as in '/rm row'"
-RM_TOO_MANY_ARGUMENTS =     EMOJI_RED_CROSS + " TMI! Please only provide the row number of the item you want to remove."
 RM_INDEX_NOT_RECOGNIZED =   EMOJI_RED_CROSS + " I did not recognize '{index}' as a row number"
 RM_INDEX_NOT_IN_QUEUE =     EMOJI_RED_CROSS + " Row {index} does not exist. Consult the queue with the command '/queue'"
 RM_SUCCESS =                EMOJI_SUCCESS   + " Removed {item} from the queue"
+RM_MANY_SUCCESS =           EMOJI_SUCCESS   + " Removed {count} items from the queue: {items}"
 
 INSERT_NOT_ENOUGH_ARGUMENTS =   EMOJI_RED_CROSS + " Please provide the item and the row where you want to insert the item, as in '/insert item row-number'"
 INSERT_INDEX_NOT_RECOGNIZED =   RM_INDEX_NOT_RECOGNIZED
@@ -64,6 +107,7 @@ INSERT_QUEUE_EMPTY =            EMOJI_RED_CROSS + " Queue is currently empty. Pl
 INSERT_QUEUE_FROZEN =           EMOJI_FROZEN + " Can't insert '{item}': queue is frozen! Run '/unfreeze' to unfreeze it"
 INSERT_SUCCESS_PRIVATE =        EMOJI_SUCCESS + " {item} inserted at position {index}"
 INSERT_SUCCESS_GROUP =          EMOJI_SUCCESS + " {user} inserted '{item}' at position {index}"
+INSERT_QUEUE_FAIR =             EMOJI_RED_CROSS + " Can't insert '{item}': the queue is in fair-share order. Please use '/add item' instead"
 
 FREEZE_NOT_AN_ADMIN = EMOJI_RED_CROSS + " Sorry, you don't have the permission: only admins can freeze the queue!"
 FREEZE_SUCCESS = EMOJI_FROZEN + " Queue frozen!"
@@ -73,6 +117,12 @@ UNFREEZE_SUCCESS = "\U0001F525 Queue unfrozen!"
 
 PROTECTION_ENABLED = EMOJI_LOCK + " Protection enabled!"
 PROTECTION_DISABLED = EMOJI_OPEN_LOCK + " Protection disabled!"
+
+FAIR_NOT_VALID =    EMOJI_RED_CROSS + " Please send '/fair on' or '/fair off', or '/fair name on' for the queue 'name'"
+FAIR_ON = "\U00002696 The queue is now in fair-share order: items of the users who had fewer turns are called first"
+FAIR_OFF = "\U00002696 The queue is back in arrival order"
+NAMED_FAIR_ON = "\U00002696 The queue '{queue}' is now in fair-share order: items of the users who had fewer turns are called first"
+NAMED_FAIR_OFF = "\U00002696 The queue '{queue}' is back in arrival order"
 NEXT_DEFAULT_MESSAGES = [
     "{item}, it's your time to shine! \U00002728",
     "{item}'s turn has finally arrived \U0001F389",
@@ -80,4 +130,35 @@ NEXT_DEFAULT_MESSAGES = [
     "{item} has waited for long enough \U000023F0",
     "It's {item}'s turn \U0001F514"
 ]
-NEXT_CUSTOM_REPLY = "{item}: {attached_message}"
\ No newline at end of file
+NEXT_CUSTOM_REPLY = "{item}: {attached_message}"
+NEXT_MANY_DEFAULT = "It's your turn: {item} \U0001F514"
+NEXT_COUNT_NOT_VALID = EMOJI_RED_CROSS + " Please ask for at least one item, as in '/next 3'"
+
+TIMERS_DISABLED =   EMOJI_RED_CROSS + " Timers are not available on this bot"
+TIMER_NOT_VALID =   EMOJI_RED_CROSS + " Please provide the length of a turn in minutes, as in '/timer 5', or '/timer off'"
+TIMER_SET = "\U000023F0 Turns now last {minutes} minutes: the next item is called when time is up"
+TIMER_OFF = "\U000023F0 Turns are not timed anymore"
+TIMER_NEXT = "\U000023F0 Time's up! {item}, it's your turn"
+TTL_NOT_VALID =     EMOJI_RED_CROSS + " Please provide how many minutes items can wait, as in '/ttl 60', or '/ttl off'"
+TTL_SET = "\U0000231B Items now leave the queue if not served within {minutes} minutes"
+TTL_OFF = "\U0000231B Items don't expire anymore"
+TTL_EXPIRED = "\U0000231B Removed from the queue after waiting too long: {items}"
+SCHEDULE_UNFREEZE_NOT_VALID = EMOJI_RED_CROSS + " Please provide a time in UTC, as in '/schedule_unfreeze 14:30', or '/schedule_unfreeze off'"
+SCHEDULE_UNFREEZE_SET = "\U000023F0 The queue will be unfrozen at {time} UTC"
+SCHEDULE_UNFREEZE_OFF = "\U000023F0 Scheduled unfreeze cancelled"
+SCHEDULED_UNFREEZE = "\U0001F525 Queue unfrozen, as scheduled!"
+
+LIVE_HEADER = "\U0001F4CC Live queue, {count} items:"
+LIVE_EMPTY = "\U0001F4CC Live queue: the queue is currently empty"
+LIVE_MORE = "... and {count} more"
+LIVE_USAGE =        EMOJI_RED_CROSS + " Please send '/live' to start a live queue, or '/live off' to stop it"
+LIVE_STOPPED =      EMOJI_SUCCESS + " The live queue won't be updated anymore"
+LIVE_NOT_ACTIVE =   EMOJI_RED_CROSS + " There is no live queue in this chat. Send '/live' to start one"
+
+STATS_DISABLED = "Statistics are disabled"
+STATS_HEADER = "Bot statistics (latencies are bucket upper bounds):"
+STATS_COMMAND = "/{command}: {count} calls, {errors} errors, p50 {p50:g} ms, p99 {p99:g} ms"
+STATS_VALUE = "{name}: {value}"
+
+# Make every template compile its format() on first use (see utils/templates.py)
+compile_templates(globals())
@@ -0,0 +1,258 @@
+"""Hot-path metrics: latency histograms, counters and gauges, exported in the
+Prometheus text format.
+
+Metrics are disabled by default. While disabled, every recording call returns
+right away, so instrumented code only pays for a flag check.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Counts of observed values per bucket"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the q-quantile, None
+        if there are no observations. Values past the last bucket are
+        reported as infinite"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Registry of the bot metrics.
+    Args:
+        max_gauge_series: maximum number of label sets kept per gauge. The
+            least recently set ones are dropped past it
+    """
+    def __init__(self, max_gauge_series=1000):
+        self.enabled = False
+        self.max_gauge_series = max_gauge_series
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+    # Recording
+    def observe(self, name, value, **labels):
+        """Record a value in the histogram 'name'"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Return a context manager recording the time spent in it to the
+        histogram 'name'"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def inc(self, name, value=1, **labels):
+        """Increase the counter 'name'"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Set the gauge 'name'. Gauges set to None are dropped"""
+        if not self.enabled:
+            return
+        label_key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._gauges.setdefault(name, OrderedDict())
+            if value is None:
+                series.pop(label_key, None)
+                return
+            series[label_key] = value
+            series.move_to_end(label_key)
+            if len(series) > self.max_gauge_series:
+                series.popitem(last=False)
+
+    def register_collector(self, prefix, collect):
+        """Export the values of the dict returned by collect() as gauges
+        named prefix_key, read on every scrape"""
+        self._collectors.append((prefix, collect))
+
+    # Reading
+    def histograms(self):
+        """Return {(name, labels): Histogram}, a copy"""
+        with self._lock:
+            result = {}
+            for key, histogram in self._histograms.items():
+                copy = result[key] = Histogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.sum = histogram.sum
+                copy.count = histogram.count
+            return result
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def collect(self):
+        """Return {name: value} of the registered collectors"""
+        values = {}
+        for prefix, collect in self._collectors:
+            try:
+                for key, value in collect().items():
+                    values['{}_{}'.format(prefix, key)] = value
+            except Exception:
+                logger.exception("Metrics collector %s failed", prefix)
+        return values
+
+    def render(self):
+        """Return all the metrics in the Prometheus text exposition format"""
+        lines = []
+        by_name = {}
+        for (name, labels), histogram in sorted(self.histograms().items()):
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name, series in by_name.items():
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', _format_value(bound)),)),
+                                                         cumulative))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(histogram.sum)))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+        typed = set()
+        for (name, labels), value in sorted(self.counters().items()):
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        with self._lock:
+            gauges = {name: list(series.items()) for name, series in self._gauges.items()}
+        for name, series in sorted(gauges.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in series:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        for name, value in sorted(self.collect().items()):
+            if isinstance(value, (int, float)):
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    # Exporter
+    def start_http_server(self, port, listen='127.0.0.1'):
+        """Serve the metrics on http://listen:port/metrics from a thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((listen, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        return self._server.server_address[:2]
+
+    def stop_http_server(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+METRICS = Metrics()
@@ -1,38 +1,155 @@
-"""gist from https://gist.github.com/jh0ker/56f5b4fb7d015b1b9e4c74d4a91d4568"""
+"""Memoize With Timeout, originally from
+https://gist.github.com/jh0ker/56f5b4fb7d015b1b9e4c74d4a91d4568 and reworked
+into a bounded, thread-safe cache"""
+import logging
+import threading
 import time
+from collections import OrderedDict
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """A computation of a cache entry that other callers can wait for"""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
 
 
 class MWT(object):
-    """Memoize With Timeout"""
-    _caches = {}
-    _timeouts = {}
+    """Memoize With Timeout.
 
-    def __init__(self,timeout=2):
+    Results are cached for 'timeout' seconds in an LRU cache of at most
+    'maxsize' entries. Concurrent calls with the same key share a single
+    computation. If 'stale_while_revalidate' is set, an entry expired by less
+    than that many seconds is still returned while it is refreshed in the
+    background.
+    Args:
+        timeout: seconds results are considered fresh
+        maxsize: maximum number of cached results
+        stale_while_revalidate: seconds an expired result can still be served
+        key: function computing the cache key from the call arguments.
+            Defaults to all the positional and keyword arguments
+    """
+    def __init__(self, timeout=2, maxsize=1024, stale_while_revalidate=0, key=None):
         self.timeout = timeout
+        self.maxsize = maxsize
+        self.stale_while_revalidate = stale_while_revalidate
+        self.key = key
+        self.cache = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(['hits', 'stale_hits', 'misses', 'refreshes', 'evictions', 'errors'], 0)
+
+    def _make_key(self, args, kwargs):
+        if self.key is not None:
+            return self.key(*args, **kwargs)
+        return args, tuple(sorted(kwargs.items()))
 
     def collect(self):
         """Clear cache of results which have timed out"""
-        for func in self._caches:
-            cache = {}
-            for key in self._caches[func]:
-                if (time.time() - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
-            self._caches[func] = cache
+        with self._lock:
+            now = time.monotonic()
+            expired = [key for key, (_, stamp) in self.cache.items()
+                       if now - stamp >= self.timeout + self.stale_while_revalidate]
+            for key in expired:
+                del self.cache[key]
 
-    def __call__(self, f):
-        self.cache = self._caches[f] = {}
-        self._timeouts[f] = self.timeout
+    def peek(self, *args, **kwargs):
+        """Return the fresh cached result of a call without computing it,
+        None if there's none"""
+        with self._lock:
+            entry = self.cache.get(self._make_key(args, kwargs))
+            if entry is not None and time.monotonic() - entry[1] < self.timeout:
+                return entry[0]
+            return None
+
+    def put(self, value, *args, **kwargs):
+        """Cache 'value' as the result of a call"""
+        with self._lock:
+            self._store(self._make_key(args, kwargs), value)
+
+    def invalidate(self, *args, **kwargs):
+        """Drop the cached result of a call"""
+        with self._lock:
+            self.cache.pop(self._make_key(args, kwargs), None)
 
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+
+    def stats(self):
+        """Return the cache counters and its current size"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.cache)
+        return stats
+
+    def _store(self, key, value):
+        """Store a result. Must be called holding the lock"""
+        self.cache[key] = value, time.monotonic()
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def _compute(self, f, key, flight, args, kwargs):
+        """Run f and publish its result to the callers waiting on flight"""
+        try:
+            flight.value = f(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+        with self._lock:
+            self.counters['refreshes'] += 1
+            if flight.error is None:
+                self._store(key, flight.value)
+            else:
+                self.counters['errors'] += 1
+            del self._inflight[key]
+        flight.done.set()
+
+    def _refresh_in_background(self, f, key, flight, args, kwargs):
+        def refresh():
+            self._compute(f, key, flight, args, kwargs)
+            if flight.error is not None:
+                logger.warning("Background refresh of %s failed: %s", f.__name__, flight.error)
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def __call__(self, f):
+        @wraps(f)
         def func(*args, **kwargs):
-            kw = sorted(kwargs.items())
-            key = (args, tuple(kw))
-            try:
-                v = self.cache[key]
-                if (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                v = self.cache[key] = f(*args,**kwargs),time.time()
-            return v[0]
-        func.func_name = f.__name__
-
-        return func
\ No newline at end of file
+            key = self._make_key(args, kwargs)
+            with self._lock:
+                entry = self.cache.get(key)
+                if entry is not None:
+                    age = time.monotonic() - entry[1]
+                    if age < self.timeout:
+                        self.counters['hits'] += 1
+                        self.cache.move_to_end(key)
+                        return entry[0]
+                    if age < self.timeout + self.stale_while_revalidate:
+                        # Serve the stale value, refresh it once in background
+                        self.counters['stale_hits'] += 1
+                        if key not in self._inflight:
+                            flight = self._inflight[key] = _Flight()
+                            self._refresh_in_background(f, key, flight, args, kwargs)
+                        return entry[0]
+                self.counters['misses'] += 1
+                flight = self._inflight.get(key)
+                owner = flight is None
+                if owner:
+                    flight = self._inflight[key] = _Flight()
+            if owner:
+                self._compute(f, key, flight, args, kwargs)
+            else:
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        func.cache = self
+        return func
@@ -0,0 +1,422 @@
+"""Rate limited outgoing message queue.
+
+Telegram allows roughly one message per second in a chat and thirty messages
+per second overall. Messages submitted to an Outbox wait in a per-chat FIFO
+and are released by two token buckets, one per chat and a global one. While a
+message waits, the following messages of the same kind in the same chat are
+merged into it, so that a burst of confirmations becomes a single message.
+Throttled (RetryAfter) and failed network requests are retried with backoff.
+
+Edits of a message already sent are debounced: an edit waits 'edit_delay'
+seconds before being sent, and further edits of the same message in the
+meantime replace its text, so that a burst of changes becomes a single edit.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter, NetworkError, TelegramError, BadRequest, Unauthorized, ChatMigrated
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket refilled at 'rate' tokens per second, holding at most
+    'capacity' tokens"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def delay(self, now):
+        """Return how long to wait before a token is available"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutgoingMessage:
+    """A message to send, or an edit of the message 'message_id' if it is
+    not None. Edits are sent once 'due'"""
+    __slots__ = ('chat_id', 'text', 'kwargs', 'coalesce', 'attempts', 'message_id', 'due')
+
+    def __init__(self, chat_id, text, kwargs, coalesce, message_id=None, due=0):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.attempts = 0
+        self.message_id = message_id
+        self.due = due
+
+
+class _Chat:
+    __slots__ = ('pending', 'edits', 'bucket', 'busy', 'not_before')
+
+    def __init__(self, bucket):
+        self.pending = deque()
+        # message_id -> OutgoingMessage, the latest edit of each message
+        self.edits = {}
+        self.bucket = bucket
+        self.busy = False
+        self.not_before = 0
+
+    def next_edit(self):
+        """Return the edit due first, None if there are none"""
+        return min(self.edits.values(), key=lambda edit: edit.due, default=None)
+
+
+class Outbox:
+    """Per-chat outgoing message scheduler. This class only keeps the state,
+    see ThreadedOutbox and AsyncOutbox for the ones actually sending.
+    Args:
+        chat_rate, chat_burst: messages per second and burst size in a chat
+        global_rate, global_burst: messages per second and burst size overall
+        max_pending: messages waiting in a chat after which new ones are dropped
+        max_retries: attempts after which a failing message is dropped
+        backoff: base delay in seconds of the exponential backoff on errors
+        edit_delay: seconds an edit waits for newer edits of the same message
+    """
+    MAX_MESSAGE_LENGTH = 4096
+    # Submissions between two sweeps of idle chats
+    SWEEP_INTERVAL = 1024
+
+    def __init__(self, chat_rate=1.0, chat_burst=3, global_rate=30.0, global_burst=30,
+                 max_pending=100, max_retries=5, backoff=0.5, edit_delay=2.0):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.edit_delay = edit_delay
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._ready = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._sweep_countdown = self.SWEEP_INTERVAL
+        self.counters = dict.fromkeys(['submitted', 'sent', 'merged', 'dropped', 'retried', 'failed',
+                                       'edits', 'edits_sent', 'edits_merged'], 0)
+
+    def _wakeup(self):
+        """Notify the senders that a message may be ready"""
+
+    def _schedule(self, chat_id, when):
+        heapq.heappush(self._ready, (when, next(self._seq), chat_id))
+
+    def _sweep(self):
+        """Forget chats with nothing to send whose bucket is full again"""
+        now = time.monotonic()
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.busy and not chat.pending and not chat.edits
+                and chat.not_before <= now and chat.bucket.is_full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    def submit(self, chat_id, text, coalesce=None, **kwargs):
+        """Queue a message. Consecutive waiting messages with the same
+        'coalesce' key are merged into one. Return False if it was dropped"""
+        with self._lock:
+            self.counters['submitted'] += 1
+            chat = self._chat(chat_id)
+            pending = chat.pending
+            if coalesce is not None and pending:
+                last = pending[-1]
+                if last.coalesce == coalesce and last.kwargs == kwargs and last.attempts == 0:
+                    if last.text == text or last.text.endswith('\n' + text):
+                        # Same message twice in a row, send it once
+                        self.counters['merged'] += 1
+                        return True
+                    if len(last.text) + 1 + len(text) <= self.MAX_MESSAGE_LENGTH:
+                        last.text += '\n' + text
+                        self.counters['merged'] += 1
+                        return True
+            if len(pending) >= self.max_pending:
+                self.counters['dropped'] += 1
+                return False
+            pending.append(OutgoingMessage(chat_id, text, kwargs, coalesce))
+            self._depth += 1
+            if len(pending) == 1 and not chat.busy:
+                self._schedule(chat_id, chat.not_before)
+        self._wakeup()
+        return True
+
+    def edit(self, chat_id, message_id, text, **kwargs):
+        """Queue an edit of the message 'message_id', sent after edit_delay
+        seconds unless it is replaced by a newer edit of the same message"""
+        with self._lock:
+            self.counters['edits'] += 1
+            chat = self._chat(chat_id)
+            waiting = chat.edits.get(message_id)
+            if waiting is not None:
+                # Only the latest text matters, keep the original deadline
+                waiting.text = text
+                waiting.kwargs = kwargs
+                self.counters['edits_merged'] += 1
+                return True
+            due = time.monotonic() + self.edit_delay
+            chat.edits[message_id] = OutgoingMessage(chat_id, text, kwargs, None, message_id, due)
+            self._depth += 1
+            if not chat.busy:
+                self._schedule(chat_id, max(due, chat.not_before))
+        self._wakeup()
+        return True
+
+    def _chat(self, chat_id):
+        """Return the state of a chat, created if needed. Called with the lock held"""
+        self._sweep_countdown -= 1
+        if self._sweep_countdown <= 0:
+            self._sweep_countdown = self.SWEEP_INTERVAL
+            self._sweep()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+        return chat
+
+    def next_ready(self, now=None):
+        """Pop the next message allowed to be sent. Waiting messages go
+        before edits.
+        Return:
+            (message, None) if a message can be sent now, otherwise
+            (None, delay) where delay is the time to wait before calling
+            again, None if there's nothing to send
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._ready:
+                when, _, chat_id = self._ready[0]
+                if when > now:
+                    return None, when - now
+                chat = self._chats.get(chat_id)
+                if chat is None or chat.busy or not (chat.pending or chat.edits):
+                    heapq.heappop(self._ready)
+                    continue
+                edit = None if chat.pending else chat.next_edit()
+                delay = max(chat.bucket.delay(now), chat.not_before - now, edit.due - now if edit else 0)
+                if delay > 0:
+                    heapq.heapreplace(self._ready, (now + delay, next(self._seq), chat_id))
+                    continue
+                delay = self._global.delay(now)
+                if delay > 0:
+                    return None, delay
+                heapq.heappop(self._ready)
+                chat.bucket.take(now)
+                self._global.take(now)
+                chat.busy = True
+                self._depth -= 1
+                if edit is not None:
+                    return chat.edits.pop(edit.message_id), None
+                return chat.pending.popleft(), None
+            return None, None
+
+    def _release(self, chat_id, not_before=0):
+        chat = self._chats[chat_id]
+        chat.busy = False
+        chat.not_before = not_before
+        if chat.pending:
+            self._schedule(chat_id, not_before)
+        elif chat.edits:
+            self._schedule(chat_id, max(not_before, chat.next_edit().due))
+
+    def done(self, message):
+        """Mark a message returned by next_ready as sent"""
+        with self._lock:
+            self.counters['sent' if message.message_id is None else 'edits_sent'] += 1
+            self._release(message.chat_id)
+        self._wakeup()
+
+    def failed(self, message, error):
+        """Mark a message returned by next_ready as failed. Throttled or
+        network errors are retried, others drop the message. Rejected
+        requests are dropped at once, although BadRequest is a NetworkError:
+        retrying them would only hold up the messages of the chat"""
+        if message.message_id is not None and isinstance(error, BadRequest) \
+                and 'not modified' in error.message:
+            # The message already shows this text
+            self.done(message)
+            return
+        message.attempts += 1
+        if isinstance(error, (BadRequest, Unauthorized, ChatMigrated)):
+            delay = None
+        elif isinstance(error, RetryAfter):
+            delay = float(error.retry_after)
+        elif isinstance(error, NetworkError):
+            delay = self.backoff * 2 ** (message.attempts - 1)
+        else:
+            delay = None
+        with self._lock:
+            if delay is None or message.attempts >= self.max_retries:
+                logger.warning("Dropping message to chat %s: %s", message.chat_id, error)
+                self.counters['failed'] += 1
+                self._release(message.chat_id)
+            else:
+                self.counters['retried'] += 1
+                chat = self._chats[message.chat_id]
+                if message.message_id is None:
+                    chat.pending.appendleft(message)
+                    self._depth += 1
+                elif message.message_id not in chat.edits:
+                    # Unless a newer edit replaced it in the meantime
+                    chat.edits[message.message_id] = message
+                    self._depth += 1
+                self._release(message.chat_id, time.monotonic() + delay)
+        self._wakeup()
+
+    @property
+    def depth(self):
+        """Number of messages and edits waiting to be sent"""
+        return self._depth
+
+    def stats(self):
+        """Return queue depth and counters"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['depth'] = self._depth
+            stats['chats'] = len(self._chats)
+        return stats
+
+
+class ThreadedOutbox(Outbox):
+    """Outbox sending messages from a pool of threads.
+    Args:
+        send_message: function called as send_message(chat_id, text, **kwargs),
+            as telegram.Bot.send_message
+        edit_message: function called as
+            edit_message(text, chat_id=..., message_id=..., **kwargs), as
+            telegram.Bot.edit_message_text. Needed by edit()
+        workers: number of sending threads
+    """
+    def __init__(self, send_message, edit_message=None, workers=8, **kwargs):
+        Outbox.__init__(self, **kwargs)
+        self.send_message = send_message
+        self.edit_message = edit_message
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._wakeups = 0
+        self._threads = []
+        self._running = False
+
+    def _wakeup(self):
+        with self._cond:
+            self._wakeups += 1
+            self._cond.notify()
+
+    def _work(self):
+        while self._running:
+            wakeups = self._wakeups
+            message, delay = self.next_ready()
+            if message is None:
+                with self._cond:
+                    # Don't sleep if something was submitted in the meantime
+                    if self._running and wakeups == self._wakeups:
+                        self._cond.wait(delay)
+                continue
+            try:
+                if message.message_id is None:
+                    self.send_message(message.chat_id, message.text, **message.kwargs)
+                else:
+                    self.edit_message(message.text, chat_id=message.chat_id, message_id=message.message_id,
+                                      **message.kwargs)
+            except TelegramError as e:
+                self.failed(message, e)
+            except Exception as e:
+                logger.exception("Unexpected error while sending a message")
+                self.failed(message, e)
+            else:
+                self.done(message)
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='outbox-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the senders. Messages still waiting are not sent"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+class AsyncOutbox(Outbox):
+    """Outbox sending messages from asyncio tasks. Must be submitted to from
+    the event loop thread.
+    Args:
+        send_message: coroutine function called as
+            send_message(chat_id, text, **kwargs)
+        edit_message: coroutine function called as
+            edit_message(text, chat_id=..., message_id=..., **kwargs). Needed
+            by edit()
+        workers: number of concurrent sends
+    """
+    def __init__(self, send_message, edit_message=None, workers=32, **kwargs):
+        Outbox.__init__(self, **kwargs)
+        self.send_message = send_message
+        self.edit_message = edit_message
+        self.workers = workers
+        self._event = None
+        self._tasks = []
+
+    def _wakeup(self):
+        if self._event is not None:
+            self._event.set()
+
+    async def _work(self):
+        while True:
+            message, delay = self.next_ready()
+            if message is None:
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                if message.message_id is None:
+                    await self.send_message(message.chat_id, message.text, **message.kwargs)
+                else:
+                    await self.edit_message(message.text, chat_id=message.chat_id, message_id=message.message_id,
+                                            **message.kwargs)
+            except TelegramError as e:
+                self.failed(message, e)
+            except Exception as e:
+                logger.exception("Unexpected error while sending a message")
+                self.failed(message, e)
+            else:
+                self.done(message)
+
+    def start(self):
+        self._event = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        return self
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,18 @@
+"""PicklePersistence of the chat_data of the bot.
+
+PTB copies chat_data through replace_bot and insert_bot when storing and
+loading it, to swap references to the bot. chat_data never holds any, and the
+copy can't be trusted with Queue, which pickles as flat columns: the copies of
+two queues of a chat could end up sharing their internals. As with
+JournalPersistence, the copy is skipped.
+"""
+from telegram.ext import PicklePersistence
+
+
+class ChatPicklePersistence(PicklePersistence):
+    """PicklePersistence storing chat_data as it is"""
+    def insert_bot(self, obj):
+        return obj
+
+    def replace_bot(self, obj):
+        return obj
@@ -1,82 +1,720 @@
+from array import array
+from itertools import chain
+
+
+class Entry:
+    """An item in line, with the ID of the user who added it, the time it was
+    added at and an optional note. Missing fields are None"""
+    __slots__ = ('item', 'user_id', 'timestamp', 'note')
+    FIELDS = ('user_id', 'timestamp', 'note')
+
+    def __init__(self, item, user_id=None, timestamp=None, note=None):
+        self.item = item
+        self.user_id = user_id
+        self.timestamp = timestamp
+        self.note = note
+
+    def data(self):
+        """Return the fields that are set, by name"""
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+    def __eq__(self, other):
+        if not isinstance(other, Entry):
+            return NotImplemented
+        return (self.item, self.user_id, self.timestamp, self.note) == \
+            (other.item, other.user_id, other.timestamp, other.note)
+
+    def __repr__(self):
+        return 'Entry({!r}, {})'.format(self.item, ', '.join('{}={!r}'.format(k, v) for k, v in self.data().items()))
+
+
+class _Block:
+    """A contiguous run of entries of a Queue. The metadata of the entries is
+    kept in arrays parallel to the items, rather than in an object per entry:
+    missing user IDs and timestamps are stored as 0"""
+    __slots__ = ('items', 'users', 'times', 'notes', 'pos')
+
+    def __init__(self, items=None, users=None, times=None, notes=None):
+        self.items = items if items is not None else []
+        self.users = users if users is not None else array('q')
+        self.times = times if times is not None else array('d')
+        self.notes = notes if notes is not None else []
+        self.pos = 0
+
+    def insert(self, offset, item, user_id, timestamp, note):
+        self.items.insert(offset, item)
+        self.users.insert(offset, user_id or 0)
+        self.times.insert(offset, timestamp or 0.0)
+        self.notes.insert(offset, note)
+
+    def extend(self, items, user_id, timestamp, note):
+        self.items.extend(items)
+        self.users.extend([user_id or 0] * len(items))
+        self.times.extend([timestamp or 0.0] * len(items))
+        self.notes.extend([note] * len(items))
+
+    def entry(self, offset):
+        return Entry(self.items[offset], self.users[offset] or None, self.times[offset] or None, self.notes[offset])
+
+    def pop(self, offset):
+        entry = self.entry(offset)
+        del self.items[offset], self.users[offset], self.times[offset], self.notes[offset]
+        return entry
+
+    def split(self, half):
+        """Move the entries from 'half' on to a new block and return it"""
+        new_block = _Block(self.items[half:], self.users[half:], self.times[half:], self.notes[half:])
+        del self.items[half:], self.users[half:], self.times[half:], self.notes[half:]
+        return new_block
+
+
 class Queue:
-    """A queue of objects patiently waiting in line"""
+    """A queue of objects patiently waiting in line.
+
+    Items are stored in a list of small blocks. A hash index maps every item
+    to the block(s) holding it, so membership is O(1), and a Fenwick tree over
+    the block sizes turns positional lookups into O(log n) searches. Appending
+    and popping from the front only touch the first/last block and are O(1)
+    amortized. Items must be hashable.
+
+    Every entry can carry the ID of the user who added it, the time it was
+    added at and a note. They are stored in compact arrays next to the items
+    and returned as Entry records. The items of each user are indexed too, so
+    positions_of finds them without walking the queue.
+
+    Rendered pages are cached (see page_lines). A change at some index only
+    invalidates the cached pages from that index on.
+
+    In fair-share mode (see set_fair) entries are kept ordered by the turns
+    their user already took, then by the time they were added, instead of in
+    arrival order. The blocks hold them in that effective order, so pop,
+    index, positions_of and the rendered pages need nothing else.
+
+    If 'journal' is set, it is called as journal(operation, *args) after each
+    change, so that the change can be persisted (see utils/journal.py).
+    """
+    _LOAD = 512
+
     def __init__(self):
-        self._items = []
-        self._data = {}
+        self.journal = None
+        self.fair = False
+        self._reset()
+
+    def _reset(self):
+        # Turns taken by user ID, in fair-share mode
+        self._turns = {}
+        self._blocks = []
+        self._where = {}
+        self._owned = None
+        self._len = 0
+        self._tree = [0]
+        self._dirty = False
+        self._pages = {}
+        self._page_size = None
+
+    # Block bookkeeping
+    def _rebuild(self):
+        """Recompute block positions and the Fenwick tree of block sizes"""
+        n = len(self._blocks)
+        tree = [0] * (n + 1)
+        for i, block in enumerate(self._blocks):
+            block.pos = i
+            tree[i + 1] = len(block.items)
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._tree = tree
+        self._dirty = False
+
+    def _add(self, pos, delta):
+        """Update the size of block 'pos' in the Fenwick tree"""
+        if self._dirty:
+            return
+        tree = self._tree
+        i = pos + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, pos):
+        """Return the number of items stored before block 'pos'"""
+        tree = self._tree
+        total = 0
+        while pos > 0:
+            total += tree[pos]
+            pos &= pos - 1
+        return total
+
+    def _locate(self, index):
+        """Return (block, offset) of the item at a valid, positive index"""
+        if index == 0:
+            return self._blocks[0], 0
+        if self._dirty:
+            self._rebuild()
+        tree = self._tree
+        n = len(tree) - 1
+        pos = 0
+        step = 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= index:
+                pos = nxt
+                index -= tree[nxt]
+            step >>= 1
+        return self._blocks[pos], index
+
+    # _where maps an item to its block or, for items queued more than once,
+    # to the list of their blocks. Most items are unique, and a list per item
+    # would cost more than their metadata
+    def _register(self, item, block):
+        blocks = self._where.get(item)
+        if blocks is None:
+            self._where[item] = block
+        elif type(blocks) is list:
+            blocks.append(block)
+        else:
+            self._where[item] = [blocks, block]
+
+    def _unregister(self, item, block):
+        blocks = self._where[item]
+        if type(blocks) is not list:
+            del self._where[item]
+        else:
+            blocks.remove(block)
+            if len(blocks) == 1:
+                self._where[item] = blocks[0]
+
+    # _owned maps the ID of a user to the item they added or, once they have
+    # several entries, to a dict of their items with the number of times each
+    # of them is queued. It is None until positions_of() or fair-share mode
+    # first needs it, then kept up to date
+    def _own(self, user_id, item):
+        if user_id and self._owned is not None:
+            owned = self._owned
+            if user_id not in owned:
+                owned[user_id] = item
+                return
+            items = owned[user_id]
+            if type(items) is not dict:
+                items = owned[user_id] = {items: 1}
+            items[item] = items.get(item, 0) + 1
+
+    def _owned_items(self, user_id):
+        """Return the items added by a user, building the index if needed"""
+        if self._owned is None:
+            self._owned = {}
+            for block in self._blocks:
+                for item, owner in zip(block.items, block.users):
+                    self._own(owner, item)
+        if user_id not in self._owned:
+            return ()
+        items = self._owned[user_id]
+        return items if type(items) is dict else (items,)
+
+    def _disown(self, user_id, item):
+        if user_id and self._owned is not None:
+            items = self._owned[user_id]
+            if type(items) is not dict:
+                del self._owned[user_id]
+            elif items[item] > 1:
+                items[item] -= 1
+            else:
+                del items[item]
+                if len(items) == 1:
+                    ((other, count),) = items.items()
+                    if count == 1:
+                        self._owned[user_id] = other
+
+    def _split(self, block):
+        """Split an oversized block in two halves"""
+        new_block = block.split(len(block.items) // 2)
+        for item in new_block.items:
+            blocks = self._where[item]
+            if type(blocks) is not list:
+                self._where[item] = new_block
+            else:
+                blocks[blocks.index(block)] = new_block
+        self._blocks.insert(block.pos + 1, new_block)
+        self._dirty = True
+
+    def _drop_if_empty(self, block):
+        if not block.items:
+            if self._blocks[0] is block:
+                del self._blocks[0]
+            else:
+                if self._dirty:
+                    self._rebuild()
+                del self._blocks[block.pos]
+            self._dirty = True
+
+    def _normalize(self, index):
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError("queue index out of range")
+        return index
+
+    def _invalidate(self, index):
+        """Drop the cached pages from the one holding 'index' on"""
+        if self._pages:
+            first = index // self._page_size
+            for page in [page for page in self._pages if page >= first]:
+                del self._pages[page]
+
+    def _window(self, start, stop):
+        """Iterate over (block, first offset, last offset) of the entries in
+        [start, stop), without walking the entries before 'start'"""
+        stop = self._len if stop is None else min(stop, self._len)
+        if start >= stop:
+            return
+        block, offset = self._locate(start)
+        count = stop - start
+        blocks = self._blocks
+        for pos in range(block.pos if start else 0, len(blocks)):
+            block = blocks[pos]
+            end = min(len(block.items), offset + count)
+            yield block, offset, end
+            count -= end - offset
+            offset = 0
+            if count <= 0:
+                return
+
+    def _insert(self, index, item, user_id, timestamp, note):
+        """Insert an entry before the one at a valid index"""
+        if self._dirty:
+            self._rebuild()
+        self._invalidate(index)
+        block, offset = self._locate(index)
+        block.insert(offset, item, user_id, timestamp, note)
+        self._register(item, block)
+        self._own(user_id, item)
+        self._len += 1
+        self._add(block.pos, 1)
+        if len(block.items) > 2 * self._LOAD:
+            self._split(block)
+
+    # Fair-share mode. Entries are sorted by _fair_key, which only changes for
+    # the entries of the user of a popped entry: they are moved back then
+    def _fair_key(self, user_id, timestamp):
+        return self._turns.get(user_id, 0), timestamp or 0.0
 
-    def append(self, item, **data):
+    def _fair_index(self, key):
+        """Return the index after the entries whose key is not greater than
+        'key': a binary search over the first entries of the blocks, then
+        within a block"""
+        blocks = self._blocks
+        if not blocks:
+            return 0
+        last = blocks[-1]
+        if key >= self._fair_key(last.users[-1], last.times[-1]):
+            return self._len
+        low, high = 0, len(blocks)
+        while low < high:
+            middle = (low + high) // 2
+            block = blocks[middle]
+            if key < self._fair_key(block.users[0], block.times[0]):
+                high = middle
+            else:
+                low = middle + 1
+        if low == 0:
+            return 0
+        pos = low - 1
+        block = blocks[pos]
+        low, high = 0, len(block.items)
+        while low < high:
+            middle = (low + high) // 2
+            if key < self._fair_key(block.users[middle], block.times[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        if self._dirty:
+            self._rebuild()
+        return self._prefix(pos) + low
+
+    def _place(self, item, user_id, timestamp, note):
+        """Add an entry at its position in fair-share order"""
+        index = self._fair_index(self._fair_key(user_id, timestamp))
+        if index == self._len:
+            self._append(item, user_id, timestamp, note)
+        else:
+            self._insert(index, item, user_id, timestamp, note)
+
+    def _user_indexes(self, user_id):
+        """Return the indexes of all the entries added by a user"""
+        if self._dirty:
+            self._rebuild()
+        blocks = set()
+        for item in self._owned_items(user_id):
+            where = self._where[item]
+            blocks.update(where if type(where) is list else (where,))
+        indexes = []
+        for block in blocks:
+            first = self._prefix(block.pos)
+            offset = -1
+            while True:
+                try:
+                    offset = block.users.index(user_id, offset + 1)
+                except ValueError:
+                    break
+                indexes.append(first + offset)
+        return indexes
+
+    def _serve(self):
+        """Pop the first entry, count a turn for its user and move the other
+        entries of the user back to their new position"""
+        entry = self._remove(0)
+        if not entry.user_id:
+            return entry
+        self._turns[entry.user_id] = self._turns.get(entry.user_id, 0) + 1
+        moved = [self._remove(index) for index in sorted(self._user_indexes(entry.user_id), reverse=True)]
+        for other in reversed(moved):
+            self._place(other.item, other.user_id, other.timestamp, other.note)
+        return entry
+
+    def set_fair(self, enabled, turns=None):
+        """Switch fair-share ordering on or off. In fair-share mode items are
+        served in order of the turns their user already took, then of the
+        time they were added: pop counts a turn for the user of the item, and
+        their other items move back behind the users with fewer turns. Turns
+        are counted from when the mode is switched on, and reset by clear.
+        Missing timestamps count as 0. Switching the mode off keeps the
+        current order and forgets the turns.
+        Args:
+            enabled: True to switch fair-share mode on
+            turns: turns already taken by user ID, to restore a saved queue
+        """
+        if turns is not None or not (enabled and self.fair):
+            self._turns = dict(turns or {}) if enabled else {}
+        self.fair = bool(enabled)
+        if self.fair and self._len:
+            items, users, times, notes = self.columns()
+            order = sorted(range(self._len), key=lambda i: self._fair_key(users[i], times[i]))
+            turns = self._turns
+            self._reset()
+            self._turns = turns
+            self._load([items[i] for i in order], array('q', [users[i] for i in order]),
+                       array('d', [times[i] for i in order]), [notes[i] for i in order])
+        if self.journal is not None:
+            self.journal('set_fair', self.fair)
+
+    def turns(self):
+        """Return the turns taken by user ID in fair-share mode"""
+        return dict(self._turns)
+
+    # Public interface
+    def append(self, item, user_id=None, timestamp=None, note=None):
         """Append an item in the queue
         Args:
             item: the item to be appended
-            data: additional information bound to the item. For example it
-                is possible to associate to the object its time of insertion
-                in the queue"""
-        self._items.append(item)
-        if data:
-            self._data[item] = data
-
-    def insert(self, index, item, **data):
+            user_id: ID of the user adding the item
+            timestamp: time of insertion of the item in the queue
+            note: free text attached to the item"""
+        if self.fair:
+            self._place(item, user_id, timestamp, note)
+        else:
+            self._append(item, user_id, timestamp, note)
+        if self.journal is not None:
+            self.journal('append', item, Entry(item, user_id, timestamp, note).data())
+
+    def _append(self, item, user_id, timestamp, note):
+        self._invalidate(self._len)
+        if not self._blocks or len(self._blocks[-1].items) >= self._LOAD:
+            block = _Block()
+            self._blocks.append(block)
+            self._dirty = True
+        else:
+            block = self._blocks[-1]
+            self._add(len(self._blocks) - 1, 1)
+        block.insert(len(block.items), item, user_id, timestamp, note)
+        self._register(item, block)
+        self._own(user_id, item)
+        self._len += 1
+
+    def insert(self, index, item, user_id=None, timestamp=None, note=None):
         """Insert an item in the requested position in line.
         Args:
             index: insertion position
             item: item to be inserted
-            kwargs: additional information associated to the item
+            user_id, timestamp, note: see append
+        Raises:
+            ValueError: the queue is in fair-share mode, where the position
+                of an item follows from its user and time
          """
-        self._items.insert(index, item)
-        if data:
-            self._data[item] = data
+        if self.fair:
+            raise ValueError("items can't be inserted at a position in fair-share mode")
+        if index < 0:
+            index = max(0, index + self._len)
+        if index >= self._len:
+            self.append(item, user_id, timestamp, note)
+            return
+        self._insert(index, item, user_id, timestamp, note)
+        if self.journal is not None:
+            self.journal('insert', index, item, Entry(item, user_id, timestamp, note).data())
+
+    def extend(self, items, user_id=None, timestamp=None, note=None):
+        """Append several items in a single pass, filling whole blocks at once
+        Args:
+            items: iterable of items to be appended
+            user_id, timestamp, note: see append, shared by all the items"""
+        items = list(items)
+        if self.fair:
+            for item in items:
+                self._place(item, user_id, timestamp, note)
+        else:
+            self._extend(items, user_id, timestamp, note)
+        if self.journal is not None:
+            self.journal('extend', items, Entry(None, user_id, timestamp, note).data())
+
+    def _extend(self, items, user_id, timestamp, note):
+        self._invalidate(self._len)
+        blocks = self._blocks
+        start = 0
+        if blocks and len(blocks[-1].items) < self._LOAD:
+            start = self._LOAD - len(blocks[-1].items)
+            blocks[-1].extend(items[:start], user_id, timestamp, note)
+            for item in items[:start]:
+                self._register(item, blocks[-1])
+        for i in range(start, len(items), self._LOAD):
+            block = _Block()
+            block.extend(items[i:i + self._LOAD], user_id, timestamp, note)
+            blocks.append(block)
+            for item in block.items:
+                self._register(item, block)
+        if user_id:
+            for item in items:
+                self._own(user_id, item)
+        self._len += len(items)
+        self._dirty = True
 
     def pop(self):
         """Pick the first element in the queue
         Return:
-            (item, dict) First element of the queue and its data
+            Entry of the first element of the queue
         """
-        return self.remove(0)
+        if not self.fair:
+            return self.remove(0)
+        entry = self._serve()
+        if self.journal is not None:
+            self.journal('pop')
+        return entry
 
     def remove(self, index):
         """Remove the element in under the requested index
         Return:
-            (item, dict) popped item and its data
+            Entry of the removed element
         """
-        item = self._items.pop(index)
-        if item in self._data:
-            data = self._data.pop(item)
+        entry = self._remove(index)
+        if self.journal is not None:
+            self.journal('remove', index)
+        return entry
+
+    def _remove(self, index):
+        index = self._normalize(index)
+        self._invalidate(index)
+        block, offset = self._locate(index)
+        entry = block.pop(offset)
+        self._unregister(entry.item, block)
+        self._disown(entry.user_id, entry.item)
+        self._len -= 1
+        if index == 0:
+            self._add(0, -1)
         else:
-            data = None
-        return item, data
+            self._add(block.pos, -1)
+        self._drop_if_empty(block)
+        return entry
+
+    def pop_many(self, count):
+        """Pick the first 'count' elements in the queue, or all of them if
+        there are fewer
+        Return:
+            list of the Entry of the popped elements
+        """
+        if not self.fair:
+            return self.remove_many(range(min(count, self._len)))
+        # Every turn can move the other items of its user back
+        entries = [self._serve() for _ in range(min(count, self._len))]
+        if self.journal is not None:
+            self.journal('pop_many', count)
+        return entries
+
+    def remove_many(self, indices):
+        """Remove the elements under several indexes in a single pass: all
+        of them are located first, then positions are reindexed once.
+        Return:
+            list of the Entry of the removed elements, in queue order
+        """
+        indices = sorted({self._normalize(index) for index in indices})
+        if not indices:
+            return []
+        if self._dirty:
+            self._rebuild()
+        self._invalidate(indices[0])
+        offsets = {}
+        for index in indices:
+            block, offset = self._locate(index)
+            offsets.setdefault(block, []).append(offset)
+        removed = []
+        for block, block_offsets in offsets.items():
+            for offset in reversed(block_offsets):
+                entry = block.pop(offset)
+                removed.append((block.pos, offset, entry))
+                self._unregister(entry.item, block)
+                self._disown(entry.user_id, entry.item)
+        self._blocks = [block for block in self._blocks if block.items]
+        self._len -= len(indices)
+        self._dirty = True
+        removed.sort(key=lambda removal: removal[:2])
+        if self.journal is not None:
+            self.journal('remove_many', indices)
+        return [entry for _, _, entry in removed]
 
     def clear(self):
-        self._items = []
-        self._data = {}
+        self._reset()
+        if self.journal is not None:
+            self.journal('clear')
 
     def index(self, item):
         """Return the index of the item in line"""
-        return self._items.index(item)
+        blocks = self._where.get(item)
+        if blocks is None:
+            raise ValueError("{!r} is not in queue".format(item))
+        if self._dirty:
+            self._rebuild()
+        block = min(blocks, key=lambda b: b.pos) if type(blocks) is list else blocks
+        return self._prefix(block.pos) + block.items.index(item)
 
-    def format(self, **format_functions):
-        res = 'Current queue:\n'
+    def positions_of(self, user_id):
+        """Return the sorted indexes of the items added by a user. An item
+        queued more than once is reported at its first index"""
+        return sorted(self.index(item) for item in self._owned_items(user_id))
+
+    def entry(self, index):
+        """Return the Entry of the element under an index"""
+        block, offset = self._locate(self._normalize(index))
+        return block.entry(offset)
+
+    def entries(self, start=0, stop=None):
+        """Iterate over the Entry of the elements in [start, stop)"""
+        for block, first, last in self._window(start, stop):
+            for offset in range(first, last):
+                yield block.entry(offset)
+
+    def islice(self, start=0, stop=None):
+        """Iterate over the items in [start, stop) without walking the items
+        before 'start'"""
+        for block, first, last in self._window(start, stop):
+            yield from block.items[first:last]
+
+    def lines(self, start=0, stop=None, **format_functions):
+        """Lazily render the items in [start, stop), one line per item.
+        Args:
+            start, stop: window of the queue to render
+            format_functions: formatter for the Entry fields to show after
+                the item, by field name, e.g. timestamp=format_wait. Fields
+                without a formatter, or not set, are not shown
+        """
         index_length = len(str(len(self)))
-        for i, item in enumerate(self._items):
-            # Show item index
-            res += "  {index:>{size}}. {item}".format(index=i + 1, size=index_length, item=item)
-            for field in self._data.get(item, []):
-                formatter = format_functions.get(field, lambda f: str(f))
-                res += ' ' + formatter(self._data[item][field])
-            res += '\n'
-        return res
+        fields = [(field, format_functions[field]) for field in Entry.FIELDS if field in format_functions]
+        i = start
+        for block, first, last in self._window(start, stop):
+            for offset in range(first, last):
+                i += 1
+                line = "  {index:>{size}}. {item}".format(index=i, size=index_length, item=block.items[offset])
+                if fields:
+                    entry = block.entry(offset)
+                    values = [format_field(getattr(entry, field)) for field, format_field in fields
+                              if getattr(entry, field) is not None]
+                    if values:
+                        line = ' '.join([line] + values)
+                yield line
+
+    def page_lines(self, page, page_size, stamp=None, **format_functions):
+        """Return the rendered lines of a page, as a tuple. Pages are cached
+        until an item on them or before them changes, the width of the indexes
+        changes or a different 'stamp' is given.
+        Args:
+            page: zero-based page number
+            page_size: items per page
+            stamp: any value the rendering depends on, e.g. the current
+                minute when showing wait times
+            format_functions: see lines
+        """
+        if page_size != self._page_size:
+            self._pages = {}
+            self._page_size = page_size
+        key = (len(str(self._len)), stamp)
+        cached = self._pages.get(page)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        lines = tuple(self.lines(page * page_size, (page + 1) * page_size, **format_functions))
+        self._pages[page] = (key, lines)
+        return lines
+
+    def format(self, **format_functions):
+        lines = self.lines(**format_functions)
+        return 'Current queue:\n' + ''.join(line + '\n' for line in lines)
 
     def is_empty(self):
         return len(self) == 0
 
+    def columns(self):
+        """Return the items and their metadata as parallel sequences: a list
+        of items, an array('q') of user IDs, an array('d') of timestamps and a
+        list of notes. Missing user IDs and timestamps are 0"""
+        return (list(self),
+                array('q', chain.from_iterable(block.users for block in self._blocks)),
+                array('d', chain.from_iterable(block.times for block in self._blocks)),
+                list(chain.from_iterable(block.notes for block in self._blocks)))
+
+    @classmethod
+    def from_columns(cls, items, users, times, notes):
+        """Return a Queue from the parallel sequences returned by columns()"""
+        queue = cls()
+        queue._load(items, users, times, notes)
+        return queue
+
+    def _load(self, items, users, times, notes):
+        for i in range(0, len(items), self._LOAD):
+            block = _Block(items[i:i + self._LOAD], users[i:i + self._LOAD], times[i:i + self._LOAD],
+                           notes[i:i + self._LOAD])
+            self._blocks.append(block)
+            where = dict.fromkeys(block.items, block)
+            if len(where) == len(block.items) and self._where.keys().isdisjoint(where):
+                self._where.update(where)
+            else:
+                for item in block.items:
+                    self._register(item, block)
+        self._owned = None
+        self._len = len(items)
+        self._dirty = True
+
+    def __getstate__(self):
+        # Pickle as flat arrays, compatible with the former list-backed layout
+        items, users, times, notes = self.columns()
+        return {'_items': items, '_users': users, '_times': times, '_notes': notes, 'fair': self.fair,
+                '_turns': self._turns}
+
+    def __setstate__(self, state):
+        self.__init__()
+        items = state['_items']
+        # Queues pickled before entries had metadata only have items
+        users = state.get('_users') or array('q', bytes(8 * len(items)))
+        times = state.get('_times') or array('d', bytes(8 * len(items)))
+        notes = state.get('_notes') or [None] * len(items)
+        self._load(items, users, times, notes)
+        self.fair = state.get('fair', False)
+        self._turns = dict(state.get('_turns') or {})
+
     def __iter__(self):
-        return iter(self._items)
+        return chain.from_iterable([block.items for block in self._blocks])
 
     def __contains__(self, item):
-        return item in self._items
+        return item in self._where
 
     def __len__(self):
-        return len(self._items)
+        return self._len
 
     def __str__(self):
-        items = map(lambda obj: str(obj), self._items)
+        items = map(lambda obj: str(obj), self)
         return '[' + ', '.join(items) + ']'
@@ -0,0 +1,163 @@
+"""Recording of the incoming updates, anonymised, to replay them later with
+benchmarks/replay.py.
+
+Only what the bot looks at is kept: the type of the chats, the text of the
+messages and the status changes of chat members. User and chat IDs are
+replaced by pseudonyms, the same for the same ID, and so are the words of
+the messages but for commands and numbers, so that '/add Alice' twice still
+adds the same item twice and '/rm 3-5' still removes rows 3 to 5. Pseudonyms
+come from a keyed hash whose key is never written: a recording can't be
+mapped back to the users, and the recordings of two runs of the bot can't be
+joined. Names and usernames are left out.
+
+A recording is a JSON object per line: a header with the format version,
+then {"t": unix time, "update": update} for every update.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+VERSION = 1
+# The bot is recorded as the user 0, and commands addressed to it as '/cmd@bot'
+BOT_USER_ID = 0
+BOT_USERNAME = 'bot'
+# Arguments kept as they are: numbers, rows, ranges, times and 'off'
+_KEPT = re.compile(r'[\d,:.\-]+|off', re.IGNORECASE)
+_WORD = re.compile(r'\S+')
+_MEMBER_FIELDS = ('status', 'is_anonymous', 'until_date')
+
+
+class UpdateRecorder:
+    """Append the updates received by the bot to a file, anonymised.
+    Args:
+        filename: path of the recording. An existing file is overwritten
+        flush_interval: seconds between writes to the file
+    """
+    def __init__(self, filename, flush_interval=1.0):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self._key = os.urandom(32)
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._file.write(json.dumps({'version': VERSION, 'started': round(time.time(), 3)}) + '\n')
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self.recorded = 0
+
+    def _hash(self, value, size=8):
+        return int.from_bytes(hashlib.blake2b(value.encode(), key=self._key, digest_size=size).digest(), 'big')
+
+    def _id(self, value, bot_id):
+        """Pseudonym of a user or chat ID. A private chat has the ID of its
+        user, and keeps the pseudonym of its user"""
+        if value == bot_id:
+            return BOT_USER_ID
+        # 48 bits, to stay within the 52 significant bits Telegram guarantees
+        pseudonym = self._hash(str(abs(value)), 6) + 1
+        return pseudonym if value > 0 else -pseudonym
+
+    def _word(self, word):
+        """Pseudonym of a word: a letter and hex digits, as long as the word
+        and at least 8 characters"""
+        digest = hashlib.blake2b(word.encode(), key=self._key, digest_size=32).hexdigest()
+        return ('w' + digest * (len(word) // 64 + 1))[:max(len(word), 8)]
+
+    def _text(self, text, bot_username):
+        first = True
+
+        def replace(match):
+            nonlocal first
+            word = match.group()
+            if first and word.startswith('/'):
+                first = False
+                command, at, username = word.partition('@')
+                if not at:
+                    return command
+                if bot_username and username.lower() == bot_username.lower():
+                    return command + '@' + BOT_USERNAME
+                return command + '@' + self._word(username)
+            first = False
+            if _KEPT.fullmatch(word):
+                return word
+            if word.startswith('@') and len(word) > 1:
+                return '@' + self._word(word[1:])
+            return self._word(word)
+        return _WORD.sub(replace, text)
+
+    def _user(self, user, bot_id):
+        return {'id': self._id(user['id'], bot_id), 'is_bot': user.get('is_bot', False), 'first_name': 'User'}
+
+    def _chat(self, chat, bot_id):
+        return {'id': self._id(chat['id'], bot_id), 'type': chat['type']}
+
+    def anonymise(self, data, bot_id=None, bot_username=None):
+        """Return the anonymised copy of an update, given as the JSON dict sent
+        by Telegram, or None if the bot has no use for it"""
+        update = {'update_id': data['update_id']}
+        message = data.get('message')
+        if message is not None:
+            if message.get('text') is None or 'from' not in message:
+                return None
+            text = self._text(message['text'], bot_username)
+            update['message'] = {
+                'message_id': message['message_id'], 'date': message['date'],
+                'chat': self._chat(message['chat'], bot_id), 'from': self._user(message['from'], bot_id),
+                'text': text,
+            }
+            if text.startswith('/'):
+                update['message']['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                                  'length': len(text.split()[0])}]
+            return update
+        for kind in ('chat_member', 'my_chat_member'):
+            member_update = data.get(kind)
+            if member_update is None:
+                continue
+            members = {}
+            for field in ('old_chat_member', 'new_chat_member'):
+                member = member_update[field]
+                members[field] = {key: member[key] for key in _MEMBER_FIELDS if key in member}
+                members[field].update((key, value) for key, value in member.items()
+                                      if key.startswith('can_') or key == 'is_member')
+                members[field]['user'] = self._user(member['user'], bot_id)
+            update[kind] = dict(members, chat=self._chat(member_update['chat'], bot_id),
+                                date=member_update['date'], **{'from': self._user(member_update['from'], bot_id)})
+            return update
+        return None
+
+    def record(self, data, bot_id=None, bot_username=None):
+        """Record an update received by the bot.
+        Args:
+            data: the update, as the JSON dict sent by Telegram
+            bot_id, bot_username: the bot's own ID and username, recorded as
+                BOT_USER_ID and BOT_USERNAME
+        """
+        update = self.anonymise(data, bot_id, bot_username)
+        if update is None:
+            return
+        line = json.dumps({'t': round(time.time(), 3), 'update': update}) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.recorded += 1
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_recording(filename):
+    """Return the (unix time, update) pairs of a recording"""
+    with open(filename, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version', 0) > VERSION:
+            raise ValueError("{} is a recording of version {}, up to {} is supported".format(
+                filename, header['version'], VERSION))
+        return [(record['t'], record['update']) for record in map(json.loads, f)]
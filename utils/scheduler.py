@@ -0,0 +1,236 @@
+"""Timers of the chats, such as turn timers and scheduled unfreezes.
+
+All the timers of the bot live in a single heap ordered by due time, instead
+of one job each: scheduling, rescheduling and cancelling are O(log n) and one
+thread, or one asyncio task, sleeps until the first one is due. A chat has at
+most one timer of each kind. Rescheduling a timer leaves its old heap entry
+in place, it is skipped when popped.
+
+Pending timers can be saved in a TimerStore, a SQLite table, and are loaded
+back on restart. Timers due while the bot was down fire right away.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TimerStore:
+    """Pending timers saved in a SQLite database"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS timers (
+            chat_id INTEGER NOT NULL, kind TEXT NOT NULL, due REAL NOT NULL, PRIMARY KEY (chat_id, kind));
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+
+    def load(self):
+        """Return the list of (chat_id, kind, due) saved"""
+        return self._conn.execute('SELECT chat_id, kind, due FROM timers').fetchall()
+
+    def put(self, chat_id, kind, due):
+        self._conn.execute('INSERT OR REPLACE INTO timers (chat_id, kind, due) VALUES (?, ?, ?)',
+                           (chat_id, kind, due))
+
+    def delete(self, chat_id, kind):
+        self._conn.execute('DELETE FROM timers WHERE chat_id = ? AND kind = ?', (chat_id, kind))
+
+    def close(self):
+        self._conn.close()
+
+
+class Scheduler:
+    """Heap of the timers of every chat. This class only keeps the state, see
+    ThreadedScheduler and AsyncScheduler for the ones actually firing them.
+    Args:
+        store: TimerStore where pending timers are saved. If None, timers are
+            lost on restart
+    """
+    def __init__(self, store=None):
+        self.store = store
+        self._heap = []
+        # (chat_id, kind) -> due time of the live heap entry
+        self._timers = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(['scheduled', 'cancelled', 'fired'], 0)
+        if store is not None:
+            for chat_id, kind, due in store.load():
+                self._timers[chat_id, kind] = due
+                self._heap.append((due, next(self._seq), chat_id, kind))
+            heapq.heapify(self._heap)
+
+    def _wakeup(self):
+        """Notify the runner that the first timer may have changed"""
+
+    def schedule(self, chat_id, kind, due):
+        """Set the timer 'kind' of a chat to fire at 'due', a time.time()
+        timestamp, replacing the previous one"""
+        with self._lock:
+            self.counters['scheduled'] += 1
+            self._timers[chat_id, kind] = due
+            heapq.heappush(self._heap, (due, next(self._seq), chat_id, kind))
+            if len(self._heap) > 2 * len(self._timers) + 64:
+                self._compact()
+            if self.store is not None:
+                self.store.put(chat_id, kind, due)
+        self._wakeup()
+
+    def cancel(self, chat_id, kind):
+        """Cancel the timer 'kind' of a chat. Return True if it was pending"""
+        with self._lock:
+            if self._timers.pop((chat_id, kind), None) is None:
+                return False
+            self.counters['cancelled'] += 1
+            if self.store is not None:
+                self.store.delete(chat_id, kind)
+        return True
+
+    def due(self, chat_id, kind):
+        """Return when the timer 'kind' of a chat fires, None if it is not set"""
+        return self._timers.get((chat_id, kind))
+
+    def _compact(self):
+        """Drop the entries of rescheduled and cancelled timers"""
+        self._heap = [entry for entry in self._heap if self._timers.get((entry[2], entry[3])) == entry[0]]
+        heapq.heapify(self._heap)
+
+    def pop_due(self, now=None):
+        """Remove the timers due at 'now'.
+        Return:
+            (timers, delay): the list of (chat_id, kind) due, and the time to
+            wait for the next one, None if there are no timers
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap:
+                when, _, chat_id, kind = heap[0]
+                if self._timers.get((chat_id, kind)) != when:
+                    heapq.heappop(heap)
+                    continue
+                if when > now:
+                    break
+                heapq.heappop(heap)
+                del self._timers[chat_id, kind]
+                due.append((chat_id, kind))
+            if due:
+                self.counters['fired'] += len(due)
+                if self.store is not None:
+                    for chat_id, kind in due:
+                        self.store.delete(chat_id, kind)
+            delay = heap[0][0] - now if heap else None
+        return due, delay
+
+    def __len__(self):
+        return len(self._timers)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self._timers)
+        return stats
+
+
+class ThreadedScheduler(Scheduler):
+    """Scheduler firing the timers from a thread.
+    Args:
+        fire: function called as fire(chat_id, kind) when a timer is due
+    """
+    def __init__(self, fire, store=None):
+        Scheduler.__init__(self, store)
+        self.fire = fire
+        self._cond = threading.Condition()
+        self._wakeups = 0
+        self._thread = None
+        self._running = False
+
+    def _wakeup(self):
+        with self._cond:
+            self._wakeups += 1
+            self._cond.notify()
+
+    def _run(self):
+        while self._running:
+            wakeups = self._wakeups
+            timers, delay = self.pop_due()
+            for chat_id, kind in timers:
+                try:
+                    self.fire(chat_id, kind)
+                except Exception:
+                    logger.exception("Timer %s of chat %s failed", kind, chat_id)
+            if timers:
+                continue
+            with self._cond:
+                # Don't sleep if a timer was scheduled in the meantime
+                if self._running and wakeups == self._wakeups:
+                    self._cond.wait(delay)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class AsyncScheduler(Scheduler):
+    """Scheduler firing the timers from an asyncio task. Must be scheduled on
+    from the event loop thread.
+    Args:
+        fire: function called as fire(chat_id, kind) when a timer is due
+    """
+    def __init__(self, fire, store=None):
+        Scheduler.__init__(self, store)
+        self.fire = fire
+        self._event = None
+        self._task = None
+
+    def _wakeup(self):
+        if self._event is not None:
+            self._event.set()
+
+    async def _run(self):
+        while True:
+            timers, delay = self.pop_due()
+            for chat_id, kind in timers:
+                try:
+                    self.fire(chat_id, kind)
+                except Exception:
+                    logger.exception("Timer %s of chat %s failed", kind, chat_id)
+            if timers:
+                continue
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
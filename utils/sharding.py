@@ -0,0 +1,128 @@
+"""Sharding of chats across worker processes.
+
+A webhook front end receives the updates and routes each of them, by chat ID,
+to one of N worker processes. Every worker runs its own Dispatcher and owns
+the chat_data of its shard of chats, so updates of a chat are always handled
+by the same process, in order, while different shards run on different cores.
+"""
+import logging
+import multiprocessing
+import queue
+import warnings
+
+import telegram
+from telegram.ext import Dispatcher
+from telegram.utils.request import Request
+
+from utils.botrequest import BotRequest
+from utils.outbox import ThreadedOutbox
+from utils.webhook import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+UPDATE_TYPES = ('message', 'edited_message', 'chat_member', 'my_chat_member', 'callback_query')
+
+
+def update_chat_id(data):
+    """Return the chat ID of an update given as JSON, None if it has none"""
+    for update_type in UPDATE_TYPES:
+        payload = data.get(update_type)
+        if payload is not None:
+            if update_type == 'callback_query':
+                payload = payload.get('message') or {}
+            chat = payload.get('chat')
+            return chat['id'] if chat else None
+    return None
+
+
+def shard_of(data, shards):
+    """Return the index of the shard an update belongs to"""
+    chat_id = update_chat_id(data)
+    return 0 if chat_id is None else hash(chat_id) % shards
+
+
+def _run_worker(index, shards, token, base_url, setup, persistence_factory, scheduler_factory, metrics_factory,
+                outbox_kwargs, inbox):
+    """Main function of a worker process: dispatch the updates of its shard"""
+    bot = telegram.Bot(token, base_url=base_url, request=Request(con_pool_size=8))
+    persistence = persistence_factory(index, shards) if persistence_factory is not None else None
+    with warnings.catch_warnings():
+        # Handlers run synchronously in the worker, no run_async thread pool is needed
+        warnings.simplefilter('ignore', UserWarning)
+        dispatcher = Dispatcher(bot, queue.Queue(), workers=0, persistence=persistence)
+    setup(dispatcher)
+    if outbox_kwargs is not None:
+        BotRequest.outbox = ThreadedOutbox(bot.send_message, bot.edit_message_text, **outbox_kwargs).start()
+    scheduler = scheduler_factory(dispatcher, index, shards) if scheduler_factory is not None else None
+    if metrics_factory is not None:
+        metrics_factory(persistence, index, shards)
+    while True:
+        data = inbox.get()
+        if data is None:
+            break
+        try:
+            dispatcher.process_update(telegram.Update.de_json(data, bot))
+        except Exception:
+            logger.exception("Shard %d failed to process update %s", index, data.get('update_id'))
+    if scheduler is not None:
+        scheduler.stop(timeout=5)
+    if BotRequest.outbox is not None:
+        BotRequest.outbox.stop(timeout=5)
+    if persistence is not None:
+        persistence.flush()
+
+
+class ShardedBot:
+    """Webhook front end routing updates to 'shards' worker processes.
+    Args:
+        token: bot token
+        shards: number of worker processes
+        setup: function registering the handlers on a worker's Dispatcher,
+            as bot.add_handlers. Must be importable from the workers
+        base_url: Bot API url
+        persistence_factory: function returning the persistence of a worker,
+            called as persistence_factory(index, shards). Each worker must
+            have its own storage
+        scheduler_factory: function starting the timer scheduler of a
+            worker, called as scheduler_factory(dispatcher, index, shards).
+            Timers fire in the scheduler thread of the worker process owning
+            the chat, with the lock of the chat held as its commands do
+        metrics_factory: function enabling the metrics of a worker, called
+            as metrics_factory(persistence, index, shards). Each worker
+            must serve them on its own port
+        outbox: if True, each worker rate limits its replies, with a share
+            of the global rate limit
+        webhook_kwargs: listen address, url path, secret token and TLS files
+            of the webhook, see WebhookServer
+    """
+    def __init__(self, token, shards, setup, base_url=None, persistence_factory=None, scheduler_factory=None,
+                 metrics_factory=None, outbox=True, **webhook_kwargs):
+        self.shards = shards
+        self.inboxes = [multiprocessing.Queue() for _ in range(shards)]
+        outbox_kwargs = {'global_rate': 30.0 / shards, 'global_burst': max(1, 30 // shards)} if outbox else None
+        self.workers = [
+            multiprocessing.Process(
+                target=_run_worker, name='shard-{}'.format(i),
+                args=(i, shards, token, base_url, setup, persistence_factory, scheduler_factory, metrics_factory,
+                      outbox_kwargs, self.inboxes[i]))
+            for i in range(shards)
+        ]
+        self.server = WebhookServer(self.route, **webhook_kwargs)
+
+    def route(self, data):
+        """Queue an update to the worker owning its chat"""
+        self.inboxes[shard_of(data, self.shards)].put(data)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.server.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop receiving updates, let the workers drain their queues and stop"""
+        self.server.stop()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
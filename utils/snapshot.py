@@ -0,0 +1,405 @@
+"""Snapshots of the chats of the bot, to move them between hosts.
+
+A snapshot holds the queues of every chat, with the metadata of their items,
+the is_frozen and is_protected flags and the other settings of the chat. It
+is a binary file that does not depend on the classes of the bot, and reading
+it never unpickles anything. Chats are written one at a time, and read one at
+a time from the memory-mapped file: an index at its end gives the offset of
+every chat, so that a single chat is loaded without reading the others.
+
+Layout, little endian:
+    header  magic b'QBOTSNAP', u16 version, 6 reserved bytes
+    chats   one record per chat: u32 length of the rest of the record,
+            i64 chat_id, u8 flags, u32 length + JSON of the other settings,
+            u16 number of queues, then for each queue:
+                u16 length + UTF-8 key of the queue in chat_data
+                u8 queue flags: QUEUE_FAIR for fair-share mode (since version 2),
+                    followed by u32 number of users m, m i64 user IDs, m u32
+                    turns taken by each
+                u32 number of items n
+                n i64 user IDs, n f64 timestamps, 0 when missing
+                n u32 item lengths, u32 length + UTF-8 of the items
+                n u32 note lengths, NO_NOTE when missing, u32 length + UTF-8 of the notes
+    index   i64 chat_id, u64 offset of its record, for every chat
+    footer  u64 offset of the index, u64 number of chats, magic b'QBOTSEND'
+
+Items and notes are stored as one string per queue and sliced on load, with
+their lengths in characters. Each flag takes two bits of the flags byte:
+whether it is set in chat_data, and its value. Snapshots of version 1,
+without queue flags, are still read.
+
+Run from the repository root, with the bot stopped:
+    python -m utils.snapshot export persistence/journal.db chats.qsnap
+    python -m utils.snapshot import chats.qsnap persistence/journal.db
+    python -m utils.snapshot info chats.qsnap
+Persistence files ending in .db are journals (utils/journal.py), the other
+ones PicklePersistence files.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from itertools import accumulate
+
+from utils.queue import Queue
+
+MAGIC = b'QBOTSNAP'
+END_MAGIC = b'QBOTSEND'
+VERSION = 2
+NO_NOTE = 0xFFFFFFFF
+FLAGS = ('is_frozen', 'is_protected')
+QUEUE_FAIR = 1
+
+_HEADER = struct.Struct('<8sH6x')
+_FOOTER = struct.Struct('<QQ8s')
+_CHAT = struct.Struct('<qB')
+_INDEX = struct.Struct('<qQ')
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+
+
+class SnapshotError(Exception):
+    """The file is not a complete snapshot, or is one of a later version"""
+
+
+def _to_bytes(column):
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _from_bytes(typecode, data):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def _encode_text(text):
+    data = text.encode('utf-8', 'surrogatepass')
+    return [_U32.pack(len(data)), data]
+
+
+def _encode_texts(texts):
+    """Return the lengths and the joined text of a column of strings and
+    Nones"""
+    lengths = array('I', [NO_NOTE if text is None else len(text) for text in texts])
+    return [_to_bytes(lengths)] + _encode_text(''.join([text for text in texts if text is not None]))
+
+
+def _split(text, lengths):
+    if lengths.count(NO_NOTE) == len(lengths):
+        return [None] * len(lengths)
+    texts = []
+    start = 0
+    for length in lengths:
+        if length == NO_NOTE:
+            texts.append(None)
+        else:
+            texts.append(text[start:start + length])
+            start += length
+    return texts
+
+
+def encode_chat(chat_id, chat_data):
+    """Return the record of a chat, without its length, as a list of bytes"""
+    flags = 0
+    settings = {}
+    queues = []
+    for key, value in chat_data.items():
+        if isinstance(value, Queue):
+            queues.append((key, value))
+        elif key in FLAGS:
+            bit = 2 * FLAGS.index(key)
+            flags |= 1 << bit | bool(value) << bit + 1
+        else:
+            settings[key] = value
+    parts = [_CHAT.pack(chat_id, flags)] + _encode_text(json.dumps(settings)) + [_U16.pack(len(queues))]
+    for key, queue in queues:
+        key = key.encode('utf-8')
+        items, users, times, notes = queue.columns()
+        item_lengths = array('I', map(len, items))
+        parts += [_U16.pack(len(key)), key, _U8.pack(QUEUE_FAIR if queue.fair else 0)]
+        if queue.fair:
+            turns = sorted(queue.turns().items())
+            parts += [_U32.pack(len(turns)), _to_bytes(array('q', [user for user, _ in turns])),
+                      _to_bytes(array('I', [count for _, count in turns]))]
+        parts += [_U32.pack(len(items)), _to_bytes(users), _to_bytes(times), _to_bytes(item_lengths)]
+        parts += _encode_text(''.join(items))
+        parts += _encode_texts(notes)
+    return parts
+
+
+def decode_chat(view, offset, version=VERSION):
+    """Read the record of a chat at 'offset' of a snapshot of the given
+    version.
+    Return:
+        chat_id, its chat_data and the offset of the next record
+    """
+    (length,) = _U32.unpack_from(view, offset)
+    pos = offset + _U32.size
+    end = pos + length
+
+    def read(size):
+        nonlocal pos
+        pos += size
+        return view[pos - size:pos]
+
+    def read_text():
+        (size,) = _U32.unpack_from(view, pos)
+        read(_U32.size)
+        return str(read(size), 'utf-8', 'surrogatepass')
+
+    chat_id, flags = _CHAT.unpack_from(view, pos)
+    read(_CHAT.size)
+    chat_data = json.loads(read_text())
+    for i, flag in enumerate(FLAGS):
+        if flags >> 2 * i & 1:
+            chat_data[flag] = bool(flags >> 2 * i + 1 & 1)
+    (queues,) = _U16.unpack_from(view, pos)
+    read(_U16.size)
+    for _ in range(queues):
+        (size,) = _U16.unpack_from(view, pos)
+        read(_U16.size)
+        key = str(read(size), 'utf-8')
+        turns = None
+        if version >= 2:
+            (queue_flags,) = _U8.unpack_from(view, pos)
+            read(_U8.size)
+            if queue_flags & QUEUE_FAIR:
+                (users_count,) = _U32.unpack_from(view, pos)
+                read(_U32.size)
+                turn_users = _from_bytes('q', read(8 * users_count))
+                turns = dict(zip(turn_users, _from_bytes('I', read(4 * users_count))))
+        (count,) = _U32.unpack_from(view, pos)
+        read(_U32.size)
+        users = _from_bytes('q', read(8 * count))
+        times = _from_bytes('d', read(8 * count))
+        item_lengths = _from_bytes('I', read(4 * count))
+        text = read_text()
+        offsets = [0, *accumulate(item_lengths)]
+        items = [text[start:stop] for start, stop in zip(offsets, offsets[1:])]
+        note_lengths = _from_bytes('I', read(4 * count))
+        notes = _split(read_text(), note_lengths)
+        chat_data[key] = Queue.from_columns(items, users, times, notes)
+        if turns is not None:
+            chat_data[key].set_fair(True, turns)
+    if pos != end:
+        raise SnapshotError("Corrupted record of chat {} at offset {}".format(chat_id, offset))
+    return chat_id, chat_data, end
+
+
+class SnapshotWriter:
+    """Write chats to a new snapshot, one at a time. The file is written to
+    'filename.part' and only renamed to 'filename' by close(), so that a
+    failed export does not leave an incomplete snapshot behind"""
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename + '.part', 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self._index = []
+        self.items = 0
+
+    def write_chat(self, chat_id, chat_data):
+        parts = encode_chat(chat_id, chat_data)
+        self._index.append((chat_id, self._file.tell()))
+        self._file.write(_U32.pack(sum(map(len, parts))))
+        self._file.writelines(parts)
+        self.items += sum(len(value) for value in chat_data.values() if isinstance(value, Queue))
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        index_offset = self._file.tell()
+        self._file.writelines(_INDEX.pack(chat_id, offset) for chat_id, offset in self._index)
+        self._file.write(_FOOTER.pack(index_offset, len(self._index), END_MAGIC))
+        self._file.close()
+        os.replace(self.filename + '.part', self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self.filename + '.part')
+
+
+class SnapshotReader:
+    """Read the chats of a snapshot from the memory-mapped file. Iterating
+    yields the (chat_id, chat_data) pairs in file order, load_chat() loads a
+    single chat through the index"""
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size + _FOOTER.size:
+                raise SnapshotError("{} is not a snapshot".format(filename))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, version = _HEADER.unpack_from(self._view, 0)
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError("{} is not a snapshot".format(filename))
+        if version > VERSION:
+            self.close()
+            raise SnapshotError("{} is a snapshot of version {}, up to {} is supported".format(
+                filename, version, VERSION))
+        self.version = version
+        self._index_offset, self._count, end = _FOOTER.unpack_from(self._view, len(self._view) - _FOOTER.size)
+        if end != END_MAGIC:
+            self.close()
+            raise SnapshotError("{} is incomplete".format(filename))
+        self._offsets = None
+
+    def offsets(self):
+        """Return the chat_id -> record offset mapping, read from the index
+        on first use"""
+        if self._offsets is None:
+            index = self._view[self._index_offset:self._index_offset + self._count * _INDEX.size]
+            self._offsets = dict(_INDEX.iter_unpack(index))
+            index.release()
+        return self._offsets
+
+    def chat_ids(self):
+        return list(self.offsets())
+
+    def load_chat(self, chat_id):
+        """Return the chat_data of a chat. Raise KeyError if the snapshot does
+        not have it"""
+        return decode_chat(self._view, self.offsets()[chat_id], self.version)[1]
+
+    def __iter__(self):
+        offset = _HEADER.size
+        while offset < self._index_offset:
+            chat_id, chat_data, offset = decode_chat(self._view, offset, self.version)
+            yield chat_id, chat_data
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, chat_id):
+        return chat_id in self.offsets()
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _is_journal(filename):
+    return filename.endswith('.db')
+
+
+def _pickle_persistence(filename):
+    from utils.persistence import ChatPicklePersistence
+    return ChatPicklePersistence(filename=filename, store_user_data=False, store_bot_data=False,
+                                 store_chat_data=True, on_flush=True)
+
+
+def export_persistence(source, filename):
+    """Write the chats of a persistence file to a snapshot. Journal chats are
+    loaded one at a time.
+    Args:
+        source: journal database (.db) or PicklePersistence file
+        filename: path of the snapshot
+    Return:
+        the SnapshotWriter, closed, with the number of chats and items written
+    """
+    if not os.path.exists(source):
+        raise FileNotFoundError("No persistence file at {}".format(source))
+    with SnapshotWriter(filename) as writer:
+        if _is_journal(source):
+            from utils.journal import ChatJournal
+            journal = ChatJournal(source)
+            try:
+                for chat_id in journal.chat_ids():
+                    writer.write_chat(chat_id, journal.load_chat(chat_id))
+            finally:
+                journal.close()
+        else:
+            for chat_id, chat_data in _pickle_persistence(source).get_chat_data().items():
+                writer.write_chat(chat_id, chat_data)
+    return writer
+
+
+def import_snapshot(filename, target, chat_ids=None):
+    """Load the chats of a snapshot into a persistence file, created if
+    missing. Chats already in it are replaced, the other ones are kept.
+    Args:
+        filename: path of the snapshot
+        target: journal database (.db) or PicklePersistence file
+        chat_ids: only import these chats. None imports all of them
+    Return:
+        the number of chats imported
+    """
+    with SnapshotReader(filename) as reader:
+        if chat_ids is None:
+            chats = iter(reader)
+        else:
+            chats = ((chat_id, reader.load_chat(chat_id)) for chat_id in chat_ids)
+        if _is_journal(target):
+            from utils.journal import ChatJournal
+            journal = ChatJournal(target)
+            try:
+                return journal.replace_chats(chats)
+            finally:
+                journal.close()
+        persistence = _pickle_persistence(target)
+        persistence.get_chat_data()
+        count = 0
+        for chat_id, chat_data in chats:
+            persistence.update_chat_data(chat_id, chat_data)
+            count += 1
+        persistence.flush()
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="write the chats of a persistence file to a snapshot")
+    export_parser.add_argument('source', help="journal database (.db) or PicklePersistence file")
+    export_parser.add_argument('snapshot')
+    import_parser = commands.add_parser('import', help="load the chats of a snapshot into a persistence file")
+    import_parser.add_argument('snapshot')
+    import_parser.add_argument('target', help="journal database (.db) or PicklePersistence file")
+    import_parser.add_argument('--chat', type=int, nargs='+', dest='chat_ids', help="only import these chats")
+    info_parser = commands.add_parser('info', help="list the chats of a snapshot")
+    info_parser.add_argument('snapshot')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'export':
+        writer = export_persistence(args.source, args.snapshot)
+        print("Exported {} chats, {} items to {} in {:.2f}s".format(
+            len(writer), writer.items, args.snapshot, time.perf_counter() - start))
+    elif args.command == 'import':
+        count = import_snapshot(args.snapshot, args.target, args.chat_ids)
+        print("Imported {} chats into {} in {:.2f}s".format(count, args.target, time.perf_counter() - start))
+    else:
+        with SnapshotReader(args.snapshot) as reader:
+            print("{}: version {}, {} chats".format(args.snapshot, reader.version, len(reader)))
+            for chat_id, chat_data in reader:
+                queues = ', '.join('{} {}{}'.format(key, len(value), ' fair' if value.fair else '')
+                                   for key, value in chat_data.items() if isinstance(value, Queue))
+                flags = ', '.join('{}={}'.format(flag, chat_data[flag]) for flag in FLAGS if flag in chat_data)
+                print("  {}: {}{}".format(chat_id, queues or 'no queues', '; ' + flags if flags else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Message templates parsed once.
+
+str.format parses its template on every call. A Template is a str whose
+format method is compiled from the template, as an f-string, the first time
+it is used, so that replies only pay for the substitution and startup does
+not pay for templates never sent. Templates are still strings: they compare,
+hash, concatenate and escape as the original text.
+"""
+import keyword
+import string
+
+_FORMATTER = string.Formatter()
+
+
+def compile_format(text):
+    """Return a function rendering 'text' as text.format(**fields) does, or
+    None if the template uses fields an f-string can't express, as positional
+    or nested ones"""
+    body = []
+    fields = []
+    for literal, field, spec, conversion in _FORMATTER.parse(text):
+        body.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        if not field.isidentifier() or keyword.iskeyword(field) or conversion or '{' in spec:
+            return None
+        body.append('{' + field + (':' + spec if spec else '') + '}')
+        if field not in fields:
+            fields.append(field)
+    if not fields:
+        rendered = str.format(text)
+        return lambda **_: rendered
+    # Unknown keywords are ignored, as with str.format
+    source = 'def render(*, {}, **_):\n    return f{!r}\n'.format(', '.join(fields), ''.join(body))
+    namespace = {}
+    exec(compile(source, '<template {!r}>'.format(text[:40]), 'exec'), namespace)
+    return namespace['render']
+
+
+class Template(str):
+    """A str whose format() is compiled on first use. Fields are only passed
+    by keyword"""
+    def format(self, **fields):
+        render = compile_format(self)
+        if render is None:
+            render = str(self).format
+        # The instance attribute is found before this method from now on
+        self.format = render
+        return render(**fields)
+
+
+def compile_templates(namespace):
+    """Turn the upper case str constants of a module namespace, and the lists
+    of them, into Templates"""
+    for name, value in list(namespace.items()):
+        if not name.isupper():
+            continue
+        if isinstance(value, str):
+            namespace[name] = Template(value)
+        elif isinstance(value, list) and all(isinstance(item, str) for item in value):
+            namespace[name] = [Template(item) for item in value]
@@ -0,0 +1,108 @@
+"""Minimal webhook server: receives the updates POSTed by Telegram and hands
+their decoded JSON to a callback.
+
+PTB 13 webhooks can't check the secret token Telegram sends in the
+X-Telegram-Bot-Api-Secret-Token header, so this server is used instead.
+"""
+import hmac
+import json
+import logging
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """HTTP server accepting updates on 'url_path'.
+    Args:
+        listen, port: listen address. Port 0 picks a free port
+        url_path: path updates are POSTed to
+        on_update: function called with the JSON dict of every update, from
+            the server threads
+        secret_token: if set, requests without this secret token are refused
+        certfile, keyfile: certificate and private key files. If given, the
+            server uses TLS
+    """
+    SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+    def __init__(self, on_update, listen='127.0.0.1', port=8443, url_path='/', secret_token=None,
+                 certfile=None, keyfile=None):
+        self.on_update = on_update
+        self.url_path = url_path if url_path.startswith('/') else '/' + url_path
+        self.secret_token = secret_token
+        self._server = ThreadingHTTPServer((listen, port), self._make_handler())
+        self._server.daemon_threads = True
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            # Handshake in the request threads, not in the accepting one
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True,
+                                                      do_handshake_on_connect=False)
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                if self.path != server.url_path:
+                    self._reply(404)
+                    return
+                if server.secret_token is not None and not hmac.compare_digest(
+                        self.headers.get(server.SECRET_HEADER, ''), server.secret_token):
+                    self._reply(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    data = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self._reply(400)
+                    return
+                try:
+                    server.on_update(data)
+                except Exception:
+                    logger.exception("Error while handling update %s", data.get('update_id'))
+                self._reply(200)
+
+        return Handler
+
+
+def dispatcher_callback(dispatcher):
+    """Return an on_update callback queuing the updates to a Dispatcher"""
+    def on_update(data):
+        dispatcher.update_queue.put(telegram.Update.de_json(data, dispatcher.bot))
+    return on_update
+
+
+def set_webhook(bot, url, secret_token=None, allowed_updates=None):
+    """Register the webhook url with Telegram"""
+    api_kwargs = {'secret_token': secret_token} if secret_token is not None else None
+    return bot.set_webhook(url=url, allowed_updates=allowed_updates, api_kwargs=api_kwargs)